@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+"""
+Benchmark the per-request overhead of running the MDQ example pipeline with compiled and uncompiled plumbings.
+
+Usage: bench_pipeline.py <metadata.xml> [rounds]
+
+The pipeline is examples/edugain-mdq.fd without the sign step. Every request looks up a single entity, as an MDQ
+client would. The uncompiled run creates a new plumbing for each request which parses every step (and every nested
+pipeline) again - what happened for each request before plumbings were compiled.
+"""
+import importlib
+import sys
+import time
+
+import yaml
+
+from pyff.pipes import Plumbing
+from pyff.repo import MDRepository
+from pyff.store import MemoryStore
+from pyff.utils import parse_xml, hash_id
+
+PIPELINE = """
+- when request:
+  - select:
+  - pipe:
+    - when accept application/samlmetadata+xml application/xml:
+      - first
+      - finalize:
+          cacheDuration: PT12H
+          validUntil: P10D
+      - emit application/samlmetadata+xml
+      - break
+    - when accept application/json:
+      - discojson
+      - emit application/json
+      - break
+"""
+
+
+class Accept(dict):
+    def get(self, item, default=None):
+        return item in self
+
+
+def _state(entity_id, accept):
+    return {'request': True,
+            'headers': {'Content-Type': None},
+            'accept': Accept({accept: True}),
+            'select': hash_id(entity_id),
+            'match': None,
+            'path': None,
+            'stats': {}}
+
+
+def _bench(md, pipeline, entity_ids, accept, rounds, compiled):
+    pl = Plumbing(pipeline, pid="mdq").compile()
+    start = time.time()
+    for _ in range(rounds):
+        for entity_id in entity_ids:
+            if not compiled:
+                pl = Plumbing(pipeline, pid="mdq")
+            pl.process(md, state=_state(entity_id, accept))
+    n = rounds * len(entity_ids)
+    return (time.time() - start) / n
+
+
+def main():
+    fn = sys.argv[1]
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    importlib.import_module('pyff.builtins')  # registers the pipes used by PIPELINE, as md.py does
+    store = MemoryStore()
+    store.update(parse_xml(fn), tid=fn)
+    md = MDRepository(store=store)
+    entity_ids = [e.get('entityID') for e in store.lookup('entities')]
+    pipeline = yaml.safe_load(PIPELINE)
+
+    for accept in ('application/xml', 'application/json'):
+        t_uncompiled = _bench(md, pipeline, entity_ids, accept, rounds, compiled=False)
+        t_compiled = _bench(md, pipeline, entity_ids, accept, rounds, compiled=True)
+        print("{}: {:d} requests uncompiled {:.3f}ms compiled {:.3f}ms per request (saves {:.3f}ms)".format(
+            accept, rounds * len(entity_ids), t_uncompiled * 1000, t_compiled * 1000,
+            (t_uncompiled - t_compiled) * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+"""
+Benchmark MemoryStore.search and select match with and without the text index.
+
+Usage: bench_search.py <metadata.xml> [copies]
+
+The entities in metadata.xml are replicated (with rewritten entityIDs) until the store holds about as many entities
+as eduGAIN. Results from the indexed and scanning stores are compared for every query.
+"""
+import sys
+import time
+from copy import deepcopy
+
+from pyff.samlmd import iter_entities, entity_match_strings
+from pyff.store import MemoryStore, StoreCache
+from pyff.utils import parse_xml, root
+
+QUERIES = ['u', 'un', 'uni', 'univ', 'university', 'aarhus', 'sdu.dk', 'https://', 'copenhagen business', 'xyzzy']
+
+
+class ScanningMemoryStore(MemoryStore):
+    def text_candidates(self, q, prefix=False):
+        return None
+
+
+def _replicate(t, copies):
+    entities = list(iter_entities(t))
+    relt = root(t)
+    for i in range(1, copies):
+        for e in entities:
+            ne = deepcopy(e)
+            ne.set('entityID', "{}#{:d}".format(e.get('entityID'), i))
+            relt.append(ne)
+    return t
+
+
+def _bench(store, fn, rounds=5):
+    start = time.time()
+    for _ in range(rounds):
+        res = [fn(store, q) for q in QUERIES]
+    return (time.time() - start) / rounds, res
+
+
+def _search(store, q):
+    return store.search(q)
+
+
+def _match(store, q):
+    candidates = store.match_candidates([q], prefix=True)
+    entities = store.lookup('entities')
+    if candidates is not None:
+        entities = [e for e in entities if e.get('entityID') in candidates]
+    return sorted(e.get('entityID') for e in entities
+                  if any(tpart.lower().startswith(q) for tstr in entity_match_strings(e) for tpart in tstr.split()))
+
+
+def main():
+    fn = sys.argv[1]
+    copies = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    t = _replicate(parse_xml(fn), copies)
+
+    indexed = MemoryStore()
+    scanning = ScanningMemoryStore()
+    start = time.time()
+    indexed.update(t)
+    print("indexed update of {:d} entities: {:.2f}s".format(indexed.size(), time.time() - start))
+    start = time.time()
+    scanning.update(t)
+    print("scanning update of {:d} entities: {:.2f}s".format(scanning.size(), time.time() - start))
+
+    # disable the result cache so every round does the work
+    indexed._result_cache = StoreCache(maxsize=0)
+    scanning._result_cache = StoreCache(maxsize=0)
+    for name, f in (('search', _search), ('select match', _match)):
+        t_idx, r_idx = _bench(indexed, f)
+        t_scan, r_scan = _bench(scanning, f)
+        assert (r_idx == r_scan), "{} results differ".format(name)
+        print("{}: {:d} queries indexed {:.4f}s scanning {:.4f}s ({:.1f}x)".format(
+            name, len(QUERIES), t_idx, t_scan, t_scan / t_idx if t_idx else float('inf')))
+
+
+if __name__ == '__main__':
+    main()
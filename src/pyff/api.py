@@ -4,15 +4,18 @@ import pyramid.httpexceptions as exc
 from .exceptions import ResourceException
 from .constants import config
 import importlib
-from .pipes import plumbing
-from .samlmd import entity_display_name
+from .pipes import plumbing, Plumbing, entity_memo
 from six.moves.urllib_parse import quote_plus
-from six import b
+from six import b, binary_type
 from .logs import get_log
 from json import dumps
 from datetime import datetime, timedelta
-from .utils import dumptree, duration2timedelta, hash_id, json_serializer, b2u
+from .utils import dumptree, duration2timedelta, hash_id, json_serializer, total_seconds
 from .repo import MDRepository
+from .profiling import histogram
+from .store import XMLStream
+from .samlmd import validation_provenance
+from . import signing
 import pkg_resources
 from accept_types import AcceptableType
 from lxml import etree
@@ -42,7 +45,13 @@ def status_handler(request):
                    jobs=[dict(id=j.id, next_run_time=j.next_run_time)
                          for j in request.registry.scheduler.get_jobs()],
                    threads=[t.name for t in threading.enumerate()],
-                   store=dict(size=request.registry.md.store.size()))
+                   store=dict(size=request.registry.md.store.size(),
+                              generation=request.registry.md.store.generation,
+                              cache=request.registry.md.store.cache_info()),
+                   responses=dict((p.pid, p.responses.info()) for p in request.registry.plumbings),
+                   entity_memo=entity_memo().info(),
+                   validation_provenance=validation_provenance().info(),
+                   signers=signing.info())
     response = Response(dumps(_status, default=json_serializer))
     response.headers['Content-Type'] = 'application/json'
     return response
@@ -77,10 +86,12 @@ def _is_xml(data):
     return isinstance(data, (etree._Element, etree._ElementTree))
 
 
-def _fmt(data, accepter):
+def _fmt(data, accepter, req=None):
     if data is None or len(data) == 0:
         return "", 'text/plain'
     if _is_xml(data) and _is_xml_type(accepter):
+        if req is not None:
+            return req.md.store.serialize(data, origin=req.origin), 'application/samlmetadata+xml'
         return dumptree(data), 'application/samlmetadata+xml'
     if isinstance(data, (dict, list)) and accepter.get('application/json'):
         return dumps(data, default=json_serializer), 'application/json'
@@ -174,10 +185,11 @@ def process_handler(request):
                      'path': path,
                      'stats': {}}
 
-            r = p.process(request.registry.md,
-                          state=state,
-                          raise_exceptions=True,
-                          scheduler=request.registry.scheduler)
+            req = Plumbing.Request(p, request.registry.md,
+                                   state=state,
+                                   raise_exceptions=True,
+                                   scheduler=request.registry.scheduler)
+            r = req.process(p, cache=(entry == 'request'))
             log.debug(r)
             if r is None:
                 r = []
@@ -185,12 +197,19 @@ def process_handler(request):
             response = Response()
             response.headers.update(state.get('headers', {}))
             ctype = state.get('headers').get('Content-Type', None)
-            if not ctype:
-                r, t = _fmt(r, accepter)
-                ctype = t
-
-            response.text = b2u(r)
-            response.size = len(r)
+            if isinstance(r, XMLStream):
+                # sent in chunks as it is serialized
+                response.app_iter = r
+                response.content_length = None
+            else:
+                if not ctype:
+                    r, t = _fmt(r, accepter, req)
+                    ctype = t
+                if isinstance(r, binary_type):
+                    response.body = r
+                else:
+                    response.text = r
+                response.size = len(r)
             response.content_type = ctype
             cache_ttl = int(state.get('cache', 0))
             response.expires = (datetime.now() + timedelta(seconds=cache_ttl))
@@ -287,8 +306,9 @@ elements.
         if a is not None and '://' not in a:
             _links(a)
 
-    for entity in request.registry.md.store.lookup('entities'):
-        entity_display = entity_display_name(entity)
+    store = request.registry.md.store
+    for entity in store.lookup('entities'):
+        entity_display = store.entity_record(entity).display_name()
         _links("/entities/%s" % hash_id(entity.get('entityID')),
                title=entity_display)
 
@@ -303,6 +323,40 @@ elements.
     return response
 
 
+def profile_handler(request):
+    response = Response(dumps(histogram.info(), default=json_serializer))
+    response.headers['Content-Type'] = 'application/json'
+    return response
+
+
+def certs_handler(request):
+    expiring_within = request.params.get('expiring_within', None)
+    certs = request.registry.md.store.certificates()
+    if expiring_within is None:
+        lst = sorted(certs, key=lambda c: c.not_after)
+    else:
+        try:
+            seconds = int(expiring_within)
+        except ValueError:
+            delta = duration2timedelta(expiring_within)
+            if delta is None:
+                raise exc.exception_response(400)
+            seconds = total_seconds(delta)
+        lst = certs.expiring(seconds)
+
+    def _info(c):
+        return dict(fingerprint=c.fingerprint,
+                    subject=c.subject,
+                    not_after=datetime.utcfromtimestamp(c.not_after),
+                    key_type=c.key_type,
+                    key_size=c.key_size,
+                    entities=list(certs.entities(c.fingerprint)))
+
+    response = Response(dumps([_info(c) for c in lst], default=json_serializer))
+    response.headers['Content-Type'] = 'application/json'
+    return response
+
+
 def resources_handler(request):
     def _info(r):
         nfo = r.info
@@ -321,6 +375,23 @@ def resources_handler(request):
     return response
 
 
+def icon_handler(request):
+    icon_store = request.registry.md.icon_store
+    if not hasattr(icon_store, 'get'):
+        raise exc.exception_response(404)
+
+    icon = icon_store.get(request.matchdict['hash'])
+    if icon is None:
+        raise exc.exception_response(404)
+
+    data, content_type, etag = icon
+    response = Response(body=data, content_type=content_type, conditional_response=True)
+    response.etag = etag
+    response.cache_control.public = True
+    response.cache_control.max_age = config.cache_ttl_icons
+    return response
+
+
 def pipeline_handler(request):
     response = Response(dumps(request.registry.plumbings,
                               default=json_serializer))
@@ -431,9 +502,18 @@ def mkapp(*args, **kwargs):
         ctx.add_route('status', '/api/status', request_method='GET')
         ctx.add_view(status_handler, route_name='status')
 
+        ctx.add_route('profile', '/api/profile', request_method='GET')
+        ctx.add_view(profile_handler, route_name='profile')
+
+        ctx.add_route('certs', '/api/certs', request_method='GET')
+        ctx.add_view(certs_handler, route_name='certs')
+
         ctx.add_route('resources', '/api/resources', request_method='GET')
         ctx.add_view(resources_handler, route_name='resources')
 
+        ctx.add_route('icon', '/api/icons/{hash}', request_method='GET')
+        ctx.add_view(icon_handler, route_name='icon')
+
         ctx.add_route('pipeline', '/api/pipeline', request_method='GET')
         ctx.add_view(pipeline_handler, route_name='pipeline')
 
@@ -446,7 +526,7 @@ def mkapp(*args, **kwargs):
 
         start = datetime.utcnow() + timedelta(seconds=1)
         log.debug(start)
-        if config.update_frequency > 0:
+        if config.update_frequency > 0 and not config.snapshot_dir:  # with snapshots the loader does the updates
             ctx.registry.scheduler.add_job(call,
                                            'interval',
                                            id="call/update",
@@ -2,29 +2,31 @@
 These are the built-in "pipes" - functions that can be used to put together a processing pipeling for pyFF.
 """
 
-import base64
 import hashlib
-import json
 import sys
+import time
 import traceback
-from copy import deepcopy
-from datetime import datetime
+from datetime import datetime, timedelta
 from distutils.util import strtobool
 import operator
 import os
 import re
 import xmlsec
 from iso8601 import iso8601
+from lxml import etree
 from lxml.etree import DocumentInvalid
 
 from .constants import NS, config
 from .decorators import deprecated
 from .logs import get_log
-from .pipes import Plumbing, PipeException, PipelineCallback, pipe
+from .pipes import Plumbing, PipeException, PipelineCallback, pipe, request_key
+from .store import XMLStream
+from .signing import signer
 from .utils import total_seconds, dumptree, safe_write, root, with_tree, duration2timedelta, xslt_transform, \
-    validate_document, hash_id, ensure_dir
+    validate_document, hash_id, ensure_dir, is_ip_address, process_pool, process_pool_size, safe_symlink, is_text
 from .samlmd import sort_entities, iter_entities, annotate_entity, set_entity_attributes, \
-    discojson_t, set_pubinfo, set_reginfo, find_in_document, entitiesdescriptor, set_nodecountry, resolve_entities
+    set_pubinfo, set_reginfo, find_in_document, entitiesdescriptor, set_nodecountry, resolve_entities, \
+    entity_match_strings, entity_certificates, certificate_info, EntityStream, validate_entities
 from six.moves.urllib_parse import urlparse
 from .exceptions import MetadataException
 import six
@@ -38,7 +40,7 @@ FILESPEC_REGEX = "([^ \t\n\r\f\v]+)\s+as\s+([^ \t\n\r\f\v]+)"
 log = get_log(__name__)
 
 
-@pipe
+@pipe(read_only=True)
 def dump(req, *opts):
     """
     Print a representation of the entities set on stdout. Useful for testing.
@@ -61,7 +63,7 @@ def _map(req, *opts):
         loop over the entities in a selection
 
         :param req:
-        :param opts:
+        :param opts: Options: 'processes' runs the statements in a pool of worker processes
         :return: None
 
         **Examples**
@@ -71,24 +73,127 @@ def _map(req, *opts):
             - map:
                - ...statements...
 
-        Executes a set of statements in parallell (using a thread pool).
+        Executes a set of statements in parallell (using a thread pool) for each entity. The statements run on the
+        entity element itself, so changes made to the entity (eg by setattr outside of a fork) are visible in the
+        working document.
+
+        .. code-block:: yaml
+
+            - map processes:
+               - ...statements...
+
+        Executes the statements in a persistent pool of worker processes (of size map_processes, by default one
+        per cpu) which isn't limited by the GIL. Entities are sent to the workers serialized, in chunks, and each
+        worker compiles the statements once. Entities that were changed by the statements are parsed again and
+        replace the originals in the working document. The workers have their own, empty, metadata store so this
+        mode is meant for statements that only work on the entity itself - eg sign, publish or discojson as in
+        examples/batch-mdq-loop.fd - and statements that select from the store will not find anything.
 
     """
 
+    if 'processes' in opts:
+        _map_processes(req)
+        return
+
     def _p(e):
         entity_id = e.get('entityID')
-        ip = Plumbing(pipeline=req.args, pid="{}.each[{}]".format(req.plumbing.pid, entity_id))
+        ip = req.nested("{}.each[{}]".format(req.plumbing.pid, entity_id))
         ireq = Plumbing.Request(ip, req.md, t=e, scheduler=req.scheduler)
         ireq.set_id(entity_id)
         ireq.set_parent(req)
-        return ip.iprocess(ireq)
+        return _mapped(e, ip.iprocess(ireq))
 
     from multiprocessing.pool import ThreadPool
-    pool = ThreadPool()
-    result = pool.map(_p, iter_entities(req.t), chunksize=10)
+    entities = list(iter_entities(req.t))
+    pool = ThreadPool(processes=config.worker_pool_size)
+    try:
+        result = pool.map(_p, entities, chunksize=10)
+    finally:
+        pool.close()
+    for e, ne in zip(entities, result):
+        if ne is not e:
+            _replace_entity(req, e, ne)
     log.info("processed {} entities".format(len(result)))
 
 
+def _mapped(e, t):
+    # the statements may return a new element (eg the memoized output of a per_entity pipe) instead of changing
+    # e in place - a result that isn't a document (eg the output of emit) leaves e
+    if isinstance(t, etree._ElementTree):
+        t = t.getroot()
+    if etree.iselement(t):
+        return t
+    return e
+
+
+def _replace_entity(req, e, ne):
+    parent = e.getparent()
+    if parent is None:
+        req.t = ne
+    else:
+        ne.tail = e.tail
+        parent.replace(e, ne)
+
+
+_map_worker_md = None
+_map_worker_plumbings = dict()
+
+
+def _map_worker(task):
+    global _map_worker_md
+    (root_pipeline, root_pid, pipeline, pid, entities) = task
+    if _map_worker_md is None:
+        from .repo import MDRepository
+        _map_worker_md = MDRepository()
+    key = (root_pid, repr(root_pipeline), pid, repr(pipeline))
+    if key not in _map_worker_plumbings:
+        _map_worker_plumbings[key] = (Plumbing(root_pipeline, root_pid).compile(),
+                                      Plumbing(pipeline, pid).compile())
+    root_pl, pl = _map_worker_plumbings[key]
+    scope = Plumbing.Request(root_pl, _map_worker_md)
+
+    result = []
+    for data in entities:
+        e = etree.fromstring(data)
+        entity_id = e.get('entityID')
+        ireq = Plumbing.Request(pl.alias("{}[{}]".format(pid, entity_id)), _map_worker_md, t=e)
+        ireq.set_id(entity_id)
+        ireq.set_parent(scope)
+        out = etree.tostring(_mapped(e, pl.iprocess(ireq)), with_tail=False)
+        result.append(out if out != data else None)
+    return result
+
+
+def _map_processes(req):
+    top = req
+    while top.parent is not None:
+        top = top.parent
+
+    entities = list(iter_entities(req.t))
+    if not entities:
+        return
+    pool = process_pool()
+    nproc = process_pool_size()
+    chunksize = max(1, min(100, len(entities) // (nproc * 4)))
+    pid = "{}.each".format(req.plumbing.pid)
+    tasks = []
+    for i in range(0, len(entities), chunksize):
+        tasks.append((top.plumbing.pipeline, top.plumbing.pid, req.args, pid,
+                      [etree.tostring(e, with_tail=False) for e in entities[i:i + chunksize]]))
+
+    n = 0
+    changed = 0
+    for result in pool.imap(_map_worker, tasks):
+        for data in result:
+            e = entities[n]
+            n += 1
+            if data is None:
+                continue
+            _replace_entity(req, e, etree.fromstring(data))
+            changed += 1
+    log.info("processed {} entities ({} changed) in {} worker processes".format(n, changed, nproc))
+
+
 @pipe(name="then")
 def _then(req, *opts):
     """
@@ -99,7 +204,7 @@ def _then(req, *opts):
     return req.t
 
 
-@pipe(name="log_entity")
+@pipe(name="log_entity", read_only=True)
 def _log_entity(req, *opts):
     """
     log the request id as it is processed (typically the entity_id)
@@ -108,7 +213,7 @@ def _log_entity(req, *opts):
     return req.t
 
 
-@pipe(name="print")
+@pipe(name="print", read_only=True)
 def _print_t(req, *opts):
     """
 
@@ -133,7 +238,7 @@ def _print_t(req, *opts):
         print(req.t)
 
 
-@pipe
+@pipe(read_only=True)
 def end(req, *opts):
     """
     Exit with optional error code and message.
@@ -162,12 +267,15 @@ def end(req, *opts):
     sys.exit(code)
 
 
-@pipe
+@pipe(read_only=True, parallel=True)
 def fork(req, *opts):
     """
     Make a copy of the working tree and process the arguments as a pipleline. This essentially resets the working
     tree and allows a new plumbing to run. Useful for producing multiple outputs from a single source.
 
+    The copy is made lazily: the inner plumbing shares the working tree until the first pipe that may modify it
+    is run, so branches that start with a select or only run read-only pipes (eg publish or emit) never copy.
+
     :param req: The request
     :param opts: Options (unused)
     :return: None
@@ -190,6 +298,28 @@ def fork(req, *opts):
     The second fork in this example is strictly speaking not necessary since the main plumbing is still active
     but it may help to structure your plumbings this way.
 
+    **Parallel forks**
+
+    Adding 'parallel' to the options runs the inner plumbing in a thread pool (of size worker_pool_size) while the
+    parent plumbing continues. Consecutive parallel forks run concurrently and the first step after them that
+    isn't a parallel fork - or the end of the plumbing - waits for all of them. Branches share the working tree
+    read-only until they modify it, exactly like sequential forks. If any branch fails the others still run to
+    completion and the exception (or a PipeException listing all of them) is raised when they are joined.
+
+    .. code-block:: yaml
+
+        - select
+        - fork parallel:
+            - publish: /tmp/all.xml
+        - fork parallel:
+            - select: "!//md:EntityDescriptor[md:IDPSSODescriptor]"
+            - publish: /tmp/idps.xml
+        - stats
+
+    Parallel forks are merged (see below) into the parent working document in the order they appear in the
+    plumbing once all of them have finished, so a parallel 'fork merge' doesn't see what the forks before it
+    merged.
+
     **Merging**
 
     Normally the result of the "inner" plumbing is disgarded - unless published or emit:ed to a calling client
@@ -224,22 +354,30 @@ def fork(req, *opts):
                 attribute: value
 
     """
-    nt = None
+    ip = req.nested("%s.fork" % req.plumbing.pid)
+    ireq = Plumbing.Request(ip, req.md, scheduler=req.scheduler)
     if req.t is not None:
-        nt = deepcopy(req.t)
-
-    ip = Plumbing(pipeline=req.args, pid="%s.fork" % req.plumbing.pid)
-    ireq = Plumbing.Request(ip, req.md, t=nt, scheduler=req.scheduler)
+        ireq.share(req.t)
     ireq.set_id(req.id)
     ireq.set_parent(req)
-    ip.iprocess(ireq)
-
-    if req.t is not None and ireq.t is not None and len(root(ireq.t)) > 0:
-        if 'merge' in opts:
-            sn = "pyff.merge_strategies:replace_existing"
-            if opts[-1] != 'merge':
-                sn = opts[-1]
-            req.md.store.merge(req.t, ireq.t, strategy_name=sn)
+    ireq.origin = req.origin
+    opts = [o for o in opts if o != 'parallel']
+
+    def _merge():
+        if req.t is not None and ireq.t is not None and len(root(ireq.t)) > 0:
+            if 'merge' in opts:
+                sn = "pyff.merge_strategies:replace_existing"
+                if opts[-1] != 'merge':
+                    sn = opts[-1]
+                req.own()
+                req.md.store.merge(req.t, ireq.t, strategy_name=sn)
+                req.origin = None
+
+    if req.step is not None and req.step.parallel:
+        req.submit(lambda: ip.iprocess(ireq), done=_merge)
+    else:
+        ip.iprocess(ireq)
+        _merge()
 
     return req.t
 
@@ -255,7 +393,7 @@ def _any(lst, d):
     return False
 
 
-@pipe(name='break')
+@pipe(name='break', read_only=True)
 def _break(req, *opts):
     """
     Break out of a pipeline.
@@ -281,7 +419,7 @@ def _break(req, *opts):
     return req.t
 
 
-@pipe(name='pipe')
+@pipe(name='pipe', read_only=True)  # the nested steps own() the working document themselves, cf pipe()
 def _pipe(req, *opts):
     """
     Run the argument list as a pipleine.
@@ -321,12 +459,12 @@ def _pipe(req, *opts):
         - two
 
     """
-    ot = Plumbing(pipeline=req.args, pid="%s.pipe" % req.plumbing.id).iprocess(req)
+    ot = req.nested("%s.pipe" % req.plumbing.id).iprocess(req)
     req.done = False
     return ot
 
 
-@pipe
+@pipe(read_only=True)  # the nested steps own() the working document themselves, cf pipe()
 def when(req, condition, *values):
     """
     Conditionally execute part of the pipeline.
@@ -353,11 +491,11 @@ def when(req, condition, *values):
     """
     c = req.state.get(condition, None)
     if c is not None and (not values or _any(values, c)):
-        return Plumbing(pipeline=req.args, pid="%s.when" % req.plumbing.id).iprocess(req)
+        return req.nested("%s.when" % req.plumbing.id).iprocess(req)
     return req.t
 
 
-@pipe
+@pipe(read_only=True)
 def info(req, *opts):
     """
     Dumps the working document on stdout. Useful for testing.
@@ -375,7 +513,7 @@ def info(req, *opts):
     return req.t
 
 
-@pipe
+@pipe(preserves_entities=True, streams=True)
 def sort(req, *opts):
     """
     Sorts the working entities by the value returned by the given xpath.
@@ -401,12 +539,16 @@ def sort(req, *opts):
 
     opts = dict(list(zip(opts[0:1], [" ".join(opts[1:])])))
     opts.setdefault('order_by', None)
+    if isinstance(req.t, EntityStream):
+        if opts['order_by'] is None or not opts['order_by'].startswith('/'):
+            return req.t.sorted(opts['order_by'])
+        req.t = req.t.document()  # absolute xpath expressions are evaluated in the aggregate
     sort_entities(req.t, opts['order_by'])
 
     return req.t
 
 
-@pipe
+@pipe(read_only=True)
 def publish(req, *opts):
     """
     Publish the working document in XML form.
@@ -434,12 +576,21 @@ def publish(req, *opts):
              hash_link: false
              update_store: true
              ext: .xml
+             compress: []
 
     If output is an existing directory, publish will write the working tree to a filename in the directory
     based on the @entityID or @Name attribute. Unless 'raw' is set to true the working tree will be serialized
     to a string before writing. If true, 'hash_link' will generate a symlink based on the hash id (sha1) for
     compatibility with MDQ. Unless false, 'update_store' will cause the the current store to be updated with
     the published artifact. Setting 'ext' allows control over the file extension.
+
+    Unless 'raw' is set to true the working tree is schema validated before it is published. Entities that are
+    known to be valid (cf :py:class:`pyff.samlmd.ValidationProvenance`) - eg unmodified copies of entities in the
+    store - are not validated again.
+
+    Files (and symlinks) that already have the published content are left untouched. Setting 'compress' to a list
+    of formats ('gz' and/or 'br', the latter requires brotli) also writes precompressed copies of the file (eg
+    idp.xml.gz) for web servers that serve them (eg the gzip_static directive of nginx).
     """
 
     if req.t is None:
@@ -461,12 +612,16 @@ def publish(req, *opts):
     req.args.setdefault('update_store', True)
     req.args.setdefault('hash_link', False)
     req.args.setdefault('urlencode_filenames', False)
+    req.args.setdefault('compress', [])
+    if is_text(req.args['compress']):
+        req.args['compress'] = req.args['compress'].split()
+    compress = req.args['compress']
 
     output_file = req.args.get("output", None)
 
     if not req.args.get('raw'):
         try:
-            validate_document(req.t)
+            validate_entities(req.t, digests=dict((e, req.entity_digest(e)) for e in iter_entities(req.t)))
         except DocumentInvalid as ex:
             log.error(ex.error_log)
             raise PipeException("XML schema validation failed")
@@ -488,23 +643,23 @@ def publish(req, *opts):
         out = output_file
         data = req.t
         if not req.args.get('raw'):
-            data = dumptree(req.t)
+            data = req.md.store.serialize(req.t, origin=req.origin)
 
         if os.path.isdir(output_file):
             file_name = "{}{}".format(enc(req.id), req.args.get('ext'))
             out = os.path.join(output_file, file_name)
-            safe_write(out, data, mkdirs=True)
+            safe_write(out, data, mkdirs=True, compress=compress)
             if req.args.get('hash_link'):
                 link_name = "{}{}".format(enc(hash_id(req.id)), req.args.get('ext'))
                 link_path = os.path.join(output_file, link_name)
-                if os.path.exists(link_path):
-                    os.unlink(link_path)
-                os.symlink(file_name, link_path)
+                safe_symlink(file_name, link_path)
+                for ext in compress:
+                    safe_symlink("{}.{}".format(file_name, ext), "{}.{}".format(link_path, ext))
         else:
-            safe_write(out, data, mkdirs=True)
+            safe_write(out, data, mkdirs=True, compress=compress)
 
         if req.args.get('update_store'):
-            req.store.update(req.t, tid=resource_name)  # TODO maybe this is not the right thing to do anymore
+            req.store.update(req.own(), tid=resource_name)  # TODO maybe this is not the right thing to do anymore
     return req.t
 
 
@@ -648,7 +803,7 @@ def _select_args(req):
     return args
 
 
-@pipe
+@pipe(read_only=True, streams=True)
 def select(req, *opts):
     """
     Select a set of EntityDescriptor elements as the working document.
@@ -710,6 +865,11 @@ def select(req, *opts):
     would allow you to use /foo-2.0.json to refer to the JSON-version of all IdPs in the current repository.
     Note that you should not include an extension in your "as foo-bla-something" since that would make your
     alias invisible for anything except the corresponding mime type.
+
+    When the 'streaming' setting is enabled, a select without an alias doesn't assemble the aggregate. The selected
+    entities are passed on to filter, first and sort as a stream (cf :py:class:`pyff.samlmd.EntityStream`) and the
+    aggregate is assembled - copied and validated - only from the entities that remain when the first pipe that needs
+    a document (eg sign, finalize or emit) runs.
     """
     args = _select_args(req)
     name = req.plumbing.id
@@ -728,24 +888,20 @@ def select(req, *opts):
         if isinstance(match, six.string_types):
             query = [match.lower()]
 
-        def _strings(elt):
-            lst = []
-            for attr in ['{%s}DisplayName' % NS['mdui'],
-                         '{%s}ServiceName' % NS['md'],
-                         '{%s}OrganizationDisplayName' % NS['md'],
-                         '{%s}OrganizationName' % NS['md'],
-                         '{%s}Keywords' % NS['mdui'],
-                         '{%s}Scope' % NS['shibmd']]:
-                lst.extend([s.text for s in elt.iter(attr)])
-            lst.append(elt.get('entityID'))
-            return [item for item in lst if item is not None]
-
         def _ip_networks(elt):
             return [ipaddr.IPNetwork(x.text) for x in elt.iter('{%s}IPHint' % NS['mdui'])]
 
+        ip_hits = dict()
+        if is_ip_address(match.strip()):
+            ip_hits[match.strip()] = req.md.store.ip_lookup(match.strip())
+
         def _match(q, elt):
             q = q.strip()
-            if ':' in q or '.' in q:
+            if q in ip_hits and ip_hits[q] is not None:
+                net = ip_hits[q].get(elt.get('entityID'), None)
+                if net is not None:
+                    return net
+            elif q in ip_hits:
                 try:
                     nets = _ip_networks(elt)
                     for net in nets:
@@ -757,7 +913,7 @@ def select(req, *opts):
                     pass
 
             if q is not None and len(q) > 0:
-                tokens = _strings(elt)
+                tokens = entity_match_strings(elt)
                 for tstr in tokens:
                     for tpart in tstr.split():
                         if tpart.lower().startswith(q):
@@ -765,10 +921,21 @@ def select(req, *opts):
             return None
 
         log.debug("matching {} in {} entities".format(match, len(entities)))
+        candidates = req.md.store.match_candidates([match], prefix=True)
+        if candidates is not None:
+            entities = [e for e in entities if e.get('entityID') in candidates]
         entities = list(filter(lambda e: _match(match, e) is not None, entities))
         log.debug("returning {} entities after match".format(len(entities)))
 
-    ot = entitiesdescriptor(entities, name)
+    def _digest(e):
+        return req.store.entity_record(e).digest
+
+    if config.streaming and req.plumbing.id == name:
+        entities = list(entities)
+        req.set_origin(entities)
+        return EntityStream(entities, name, digest_fn=_digest)
+
+    ot = entitiesdescriptor(entities, name, digest_fn=_digest)
     if ot is None:
         raise PipeException("empty select - stop")
 
@@ -776,10 +943,11 @@ def select(req, *opts):
         log.debug("storing synthentic collection {}".format(name))
         req.store.update(ot, name)
 
+    req.set_origin(entities)
     return ot
 
 
-@pipe(name="filter")
+@pipe(name="filter", preserves_entities=True, streams=True)
 def _filter(req, *opts):
     """
 
@@ -816,7 +984,13 @@ def _filter(req, *opts):
     if args is None or not args:
         args = []
 
-    ot = entitiesdescriptor(args, name, lookup_fn=lambda member: find_in_document(req.t, member), copy=False)
+    if isinstance(req.t, EntityStream):
+        if not alias and all(is_text(member) and '!' not in member for member in args):
+            return req.t.lookup(args)
+        req.t = req.t.document()  # xpath expressions are evaluated in the aggregate
+
+    ot = entitiesdescriptor(args, name, lookup_fn=lambda member: find_in_document(req.t, member), copy=False,
+                            digest_fn=req.entity_digest)
     if alias:
         req.store.update(ot, name)
 
@@ -849,7 +1023,7 @@ def pick(req, *opts):
     return ot
 
 
-@pipe
+@pipe(read_only=True, streams=True)
 def first(req, *opts):
     """
 
@@ -867,6 +1041,15 @@ def first(req, *opts):
         raise PipeException("Your pipeline is missing a select statement.")
 
     gone = object()  # sentinel
+    if isinstance(req.t, EntityStream):
+        entities = iter(req.t)
+        one = next(entities, gone)
+        two = next(entities, gone)
+        if two is not gone:
+            return req.t
+        # assemble just the one entity (if any) and continue as if the stream had been assembled
+        req.t = req.t.document([one] if one is not gone else [])
+
     entities = iter_entities(req.t)
     one = next(entities, gone)
     if one is gone:
@@ -879,7 +1062,7 @@ def first(req, *opts):
     return req.t
 
 
-@pipe(name='discojson')
+@pipe(name='discojson', read_only=True)
 def _discojson(req, *opts):
     """
 
@@ -891,6 +1074,8 @@ def _discojson(req, *opts):
     If the config.load_icons directive is set the icons will be returned from a (possibly persistent) local
     cache & converted to data: URIs
 
+    Entities that are unmodified since they were selected are rendered from the precomputed records of the store.
+
     :param req: The request
     :param opts: Options (unusued)
     :return: returns a JSON array
@@ -900,10 +1085,14 @@ def _discojson(req, *opts):
     if req.t is None:
         raise PipeException("Your pipeline is missing a select statement.")
 
-    res = discojson_t(req.t, icon_store=req.md.icon_store)
-    res.sort(key=operator.itemgetter('title'))
+    origin = req.origin or dict()
+    res = []
+    for e in iter_entities(req.t):
+        rec = req.md.store.entity_record(origin.get(e.get('entityID'), e))
+        res.append((rec.title, rec.discojson_json(icon_store=req.md.icon_store)))
+    res.sort(key=operator.itemgetter(0))
 
-    return json.dumps(res)
+    return "[" + ", ".join(j for _, j in res) + "]"
 
 
 @pipe
@@ -913,7 +1102,7 @@ def sign(req, *opts):
     Sign the working document.
 
     :param req: The request
-    :param opts: Options (unused)
+    :param opts: Options: 'each' signs each entity separately
     :return: returns the signed working document
 
     Sign expects a single dict with at least a 'key' key and optionally a 'cert' key. The 'key' argument references
@@ -952,6 +1141,22 @@ def sign(req, *opts):
 
     This example signs the document using the plain key and cert found in the signer.key and signer.crt files.
 
+    Keys are loaded once and reused: PKCS#11 keys keep a pool of up to pkcs11_sessions logged-in sessions and key
+    files are only loaded again when they change (cf :py:mod:`pyff.signing`).
+
+    **Signing each entity**
+
+    .. code-block:: yaml
+
+        - sign each:
+            key: signer.key
+            cert: signer.crt
+
+    With the 'each' option every EntityDescriptor in the working document is signed separately, as for per-entity
+    MDQ responses. The entities are signed concurrently: in threads (one per PKCS#11 session) for a PKCS#11 key and
+    in worker processes (cf the map pipe) for a key file. The signature of an entity without an ID attribute
+    references the entity as a whole document so it only validates once the entity is published on its own.
+
     """
     if req.t is None:
         raise PipeException("Your pipeline is missing a select statement.")
@@ -968,17 +1173,19 @@ def sign(req, *opts):
     if cert_file is None:
         log.info("Attempting to extract certificate from token...")
 
-    opts = dict()
-    relt = root(req.t)
-    idattr = relt.get('ID')
-    if idattr:
-        opts['reference_uri'] = "#%s" % idattr
-    xmlsec.sign(req.t, key_file, cert_file, **opts)
+    s = signer(key_file, cert_file)
+    if 'each' in opts:
+        entities = list(iter_entities(req.t))
+        signed = s.sign_all(entities)
+        if len(entities) == 1 and entities[0] is root(req.t):
+            req.t = signed[0]
+        return req.t
 
+    s.sign(req.t)
     return req.t
 
 
-@pipe
+@pipe(read_only=True)
 def stats(req, *opts):
     """
 
@@ -1013,7 +1220,7 @@ def stats(req, *opts):
     return req.t
 
 
-@pipe
+@pipe(read_only=True)
 def summary(req, *opts):
     """
 
@@ -1029,7 +1236,7 @@ def summary(req, *opts):
     return dict(size=req.store.size())
 
 
-@pipe(name='store')
+@pipe(name='store', read_only=True)
 def _store(req, *opts):
     """
 
@@ -1041,7 +1248,17 @@ def _store(req, *opts):
 
     Split the working document into EntityDescriptor-parts and save in directory/sha1(@entityID).xml. Note that
     this does not erase files that may already be in the directory. If you want a "clean" directory, remove it
-    before you call store.
+    before you call store. Files that already have the content of the entity are left untouched.
+
+    **Examples**
+
+    .. code-block:: yaml
+
+        - store:
+            directory: /var/www/entities
+            compress: gz br
+
+    As for publish, 'compress' also writes precompressed copies of each file.
 
     """
     if req.t is None:
@@ -1051,8 +1268,12 @@ def _store(req, *opts):
         raise PipeException("store requires an argument")
 
     target_dir = None
+    compress = []
     if type(req.args) is dict:
         target_dir = req.args.get('directory', None)
+        compress = req.args.get('compress', [])
+        if is_text(compress):
+            compress = compress.split()
     else:
         target_dir = req.args[0]
 
@@ -1061,24 +1282,28 @@ def _store(req, *opts):
             os.makedirs(target_dir)
         for e in iter_entities(req.t):
             fn = hash_id(e, prefix=False)
-            safe_write("%s.xml" % os.path.join(target_dir, fn), dumptree(e, pretty_print=True))
+            safe_write("%s.xml" % os.path.join(target_dir, fn), dumptree(e, pretty_print=True), compress=compress)
     return req.t
 
 
-@pipe
+@pipe(per_entity='option')
 def xslt(req, *opts):
     """
 
     Transform the working document using an XSLT file.
 
     :param req: The request
-    :param opts: Options (unused)
+    :param opts: Options: 'per_entity' memoizes the transformation of each entity
     :return: the transformation result
 
     Apply an XSLT stylesheet to the working document. The xslt pipe takes a set of keyword arguments. The only required
     argument is 'stylesheet' which identifies the xslt resource. This is looked up either in the package or as a
     user-supplied file. The rest of the keyword arguments are made available as string parameters to the XSLT transform.
 
+    Use the 'per_entity' option if the stylesheet transforms each EntityDescriptor independently of the rest of the
+    document and copies elements it doesn't know (eg an identity transform with a few templates for specific
+    elements). Only the entities that changed since they were last transformed are then passed to the stylesheet.
+
     **Examples**
 
     .. code-block:: yaml
@@ -1088,6 +1313,9 @@ def xslt(req, *opts):
             x: foo
             y: bar
 
+        - xslt per_entity:
+            stylesheet: tidy.xsl
+
     """
     if req.t is None:
         raise PipeException("Your plumbing is missing a select statement.")
@@ -1105,7 +1333,7 @@ def xslt(req, *opts):
         raise ex
 
 
-@pipe
+@pipe(read_only=True)
 def validate(req, *opts):
     """
 
@@ -1168,7 +1396,7 @@ def prune(req, *opts):
     return req.t
 
 
-@pipe
+@pipe(read_only=True)
 def check_xml_namespaces(req, *opts):
     """
 
@@ -1193,7 +1421,7 @@ def check_xml_namespaces(req, *opts):
     return req.t
 
 
-@pipe
+@pipe(per_entity=True)
 def drop_xsi_type(req, *opts):
     """
 
@@ -1243,6 +1471,10 @@ def certreport(req, *opts):
     ships with a couple of xslt transforms that are useful for turning metadata with certreport annotation into
     HTML.
 
+    Certificates are looked up in the certificate inventory of the store (cf
+    :py:meth:`pyff.store.SAMLStoreBase.certificates`) so each certificate is only parsed once. Each certificate is
+    reported once - for the first entity in the selection that uses it.
+
     """
 
     if req.t is None:
@@ -1259,78 +1491,64 @@ def certreport(req, *opts):
     error_bits = int(req.args.get('error_bits', "1024"))
     warning_bits = int(req.args.get('warning_bits', "2048"))
 
-    seen = {}
-    for eid in req.t.xpath("//md:EntityDescriptor/@entityID",
-                           namespaces=NS,
-                           smart_strings=False):
-        for cd in req.t.xpath("md:EntityDescriptor[@entityID='%s']//ds:X509Certificate" % eid,
-                              namespaces=NS,
-                              smart_strings=False):
-            try:
-                cert_pem = cd.text
-                cert_der = base64.b64decode(cert_pem)
-                m = hashlib.sha1()
-                m.update(cert_der)
-                fp = m.hexdigest()
-                if not seen.get(fp, False):
-                    entity_elt = cd.getparent().getparent().getparent().getparent().getparent()
-                    seen[fp] = True
-                    cdict = xmlsec.utils.b642cert(cert_pem)
-                    keysize = cdict['modulus'].bit_length()
-                    cert = cdict['cert']
+    certs = req.store.certificates()
+    now = time.time()
+    seen = set()
+    with req.store.batch() as batch:
+        for entity_elt in iter_entities(req.t):
+            eid = entity_elt.get('entityID')
+            annotated = False
+            for fp, cd in entity_certificates(entity_elt):
+                if fp in seen:
+                    continue
+                seen.add(fp)
+                cert = certs.get(fp)
+                if cert is None:  # not in the store (eg added by the pipeline) or not parseable
+                    cert = certificate_info(cd.text)
+                if cert is None:
+                    log.error("%s has a certificate that can't be parsed" % eid)
+                    continue
+
+                if cert.key_type in ('RSA', 'DSA') and cert.key_size is not None:
+                    keysize = cert.key_size
                     if keysize < error_bits:
                         annotate_entity(entity_elt,
                                         "certificate-error",
                                         "keysize too small",
-                                        "%s has keysize of %s bits (less than %s)" % (cert.getSubject(),
-                                                                                      keysize,
-                                                                                      error_bits))
+                                        "%s has keysize of %s bits (less than %s)" % (cert.subject, keysize,
+                                                                                       error_bits))
                         log.error("%s has keysize of %s" % (eid, keysize))
+                        annotated = True
                     elif keysize < warning_bits:
                         annotate_entity(entity_elt,
                                         "certificate-warning",
                                         "keysize small",
-                                        "%s has keysize of %s bits (less than %s)" % (cert.getSubject(),
-                                                                                      keysize,
-                                                                                      warning_bits))
+                                        "%s has keysize of %s bits (less than %s)" % (cert.subject, keysize,
+                                                                                       warning_bits))
                         log.warn("%s has keysize of %s" % (eid, keysize))
-
-                    notafter = cert.getNotAfter()
-                    if notafter is None:
-                        annotate_entity(entity_elt,
-                                        "certificate-error",
-                                        "certificate has no expiration time",
-                                        "%s has no expiration time" % cert.getSubject())
-                    else:
-                        try:
-                            et = datetime.strptime("%s" % notafter, "%y%m%d%H%M%SZ")
-                            now = datetime.now()
-                            dt = et - now
-                            if total_seconds(dt) < error_seconds:
-                                annotate_entity(entity_elt,
-                                                "certificate-error",
-                                                "certificate has expired",
-                                                "%s expired %s ago" % (cert.getSubject(), -dt))
-                                log.error("%s expired %s ago" % (eid, -dt))
-                            elif total_seconds(dt) < warning_seconds:
-                                annotate_entity(entity_elt,
-                                                "certificate-warning",
-                                                "certificate about to expire",
-                                                "%s expires in %s" % (cert.getSubject(), dt))
-                                log.warn("%s expires in %s" % (eid, dt))
-                        except ValueError as ex:
-                            annotate_entity(entity_elt,
-                                            "certificate-error",
-                                            "certificate has unknown expiration time",
-                                            "%s unknown expiration time %s" % (cert.getSubject(), notafter))
-
-                    req.store.update(entity_elt)
-            except Exception as ex:
-                log.debug(traceback.format_exc())
-                log.error(ex)
-
-
-@pipe
+                        annotated = True
+
+                dt = timedelta(seconds=int(cert.not_after - now))
+                if total_seconds(dt) < error_seconds:
+                    annotate_entity(entity_elt,
+                                    "certificate-error",
+                                    "certificate has expired",
+                                    "%s expired %s ago" % (cert.subject, -dt))
+                    log.error("%s expired %s ago" % (eid, -dt))
+                    annotated = True
+                elif total_seconds(dt) < warning_seconds:
+                    annotate_entity(entity_elt,
+                                    "certificate-warning",
+                                    "certificate about to expire",
+                                    "%s expires in %s" % (cert.subject, dt))
+                    log.warn("%s expires in %s" % (eid, dt))
+                    annotated = True
+
+            if annotated:
+                batch.update(entity_elt)
+
+
+@pipe(read_only=True)
 def emit(req, ctype="application/xml", *opts):
     """
 
@@ -1338,7 +1556,7 @@ def emit(req, ctype="application/xml", *opts):
 
     :param req: The request
     :param ctype: The mimetype of the response.
-    :param opts: Options (not used)
+    :param opts: Options: 'stream' returns the working tree as a stream of chunks
     :return: unicode data
 
     Renders the working tree as text and sets the digest of the tree as the ETag. If the tree has already been rendered as
@@ -1352,10 +1570,32 @@ def emit(req, ctype="application/xml", *opts):
         - emit application/xml:
         - break
 
+    **Streaming**
+
+    .. code-block:: yaml
+
+        - emit application/xml stream:
+        - break
+
+    With the 'stream' option a tree is not rendered but returned as a :py:class:`pyff.store.XMLStream` which the
+    HTTP frontends send as a sequence of chunks, so memory use per request doesn't grow with the size of the
+    document. If the document is assembled from cached entity serializations (cf select) the ETag is still the
+    digest of the document. Otherwise it is a weak ETag derived from the store generation and the request. Only use
+    this option in pipelines that return their result to an HTTP client.
+
     """
     if req.t is None:
         raise PipeException("Your pipeline is missing a select statement.")
 
+    if 'stream' in opts and (hasattr(req.t, 'tag') or hasattr(req.t, 'getroot')):
+        stream = XMLStream(req.md.store, req.t, origin=req.origin)
+        etag = stream.etag()
+        if etag is None:
+            etag = 'W/"{}"'.format(hashlib.sha1(repr((req.plumbing.pid, request_key(req))).encode('utf-8')).hexdigest())
+        req.state['headers']['ETag'] = etag
+        req.state['headers']['Content-Type'] = ctype
+        return stream
+
     d = req.t
     if hasattr(d, 'getroot') and hasattr(d.getroot, '__call__'):
         nd = d.getroot()
@@ -1365,7 +1605,7 @@ def emit(req, ctype="application/xml", *opts):
             d = nd
 
     if hasattr(d, 'tag'):
-        d = dumptree(d)
+        d = req.md.store.serialize(d, origin=req.origin)
 
     if d is not None:
         m = hashlib.sha1()
@@ -1382,7 +1622,7 @@ def emit(req, ctype="application/xml", *opts):
     return d
 
 
-@pipe
+@pipe(read_only=True)
 def signcerts(req, *opts):
     """
 
@@ -1513,7 +1753,7 @@ def finalize(req, *opts):
     return req.t
 
 
-@pipe(name='reginfo')
+@pipe(name='reginfo', per_entity=True)
 def _reginfo(req, *opts):
     """
 
@@ -1574,7 +1814,7 @@ def _pubinfo(req, *opts):
     return req.t
 
 
-@pipe(name='setattr')
+@pipe(name='setattr', per_entity=True, updates_store=True)
 def _setattr(req, *opts):
     """
 
@@ -1603,15 +1843,16 @@ def _setattr(req, *opts):
     if req.t is None:
         raise PipeException("Your pipeline is missing a select statement.")
 
-    for e in iter_entities(req.t):
-        # log.debug("setting %s on %s" % (req.args,e.get('entityID')))
-        set_entity_attributes(e, req.args)
-        req.store.update(e)
+    with req.store.batch() as batch:
+        for e in iter_entities(req.t):
+            # log.debug("setting %s on %s" % (req.args,e.get('entityID')))
+            set_entity_attributes(e, req.args)
+            batch.update(e)
 
     return req.t
 
 
-@pipe(name='nodecountry')
+@pipe(name='nodecountry', per_entity=True, updates_store=True)
 def _nodecountry(req, *opts):
     """
 
@@ -1637,12 +1878,13 @@ def _nodecountry(req, *opts):
     if req.t is None:
         raise PipeException("Your pipeline is missing a select statement.")
 
-    for e in iter_entities(req.t):
-        if req.args is not None and 'country' in req.args:
-            set_nodecountry(e, country_code=req.args['country'])
-            req.store.update(e)
-        else:
-            log.error("No country found in arguments to nodecountry")
+    with req.store.batch() as batch:
+        for e in iter_entities(req.t):
+            if req.args is not None and 'country' in req.args:
+                set_nodecountry(e, country_code=req.args['country'])
+                batch.update(e)
+            else:
+                log.error("No country found in arguments to nodecountry")
 
     return req.t
 
@@ -136,17 +136,29 @@ class Config(object):
     cache_ttl = setting("cache_ttl", 300, as_int)
     randomize_cache_ttl = setting("randomize_cache_ttl", True, as_bool)
     cache_size = setting("cache.size", 3000, as_int)
+    response_cache_size = setting("response_cache.size", 1000, as_int)
+    entity_memo_size = setting("entity_memo.size", 10000, as_int)
+    validation_provenance_size = setting("validation_provenance.size", 100000, as_int)
+    streaming = setting("streaming", False, as_bool)
+    profile = setting("profile", False, as_bool)
     default_cache_duration = setting("default_cache_duration", "PT1H")
     respect_cache_duration = setting("respect_cache_duration", True, as_bool)
     info_buffer_size = setting("info_buffer_size", 10, as_int)
     worker_pool_size = setting("worker_pool_size", 10, as_int)
+    map_processes = setting("map_processes", 0, as_int)
+    pkcs11_sessions = setting("pkcs11_sessions", 4, as_int)
     store_class = setting("store.class", "pyff.store:MemoryStore")
     store_clear = setting("store.clear", False, as_bool)
     icon_store_clear = setting("icon_store.clear", False, as_bool)
     icon_maxsize = setting("icon_maxsize", 31*1024, as_int)  # 32k is the biggest data: uri size
     resource_store_class = setting('resource_store.class', "pyff.fetch:MemoryResourceStore")
     icon_store_class = setting("icon_store.class", "pyff.store:MemoryIconStore")
+    icon_store_dir = setting("icon_store.dir", None)
+    icon_store_maxbytes = setting("icon_store.maxbytes", 64*1024*1024, as_int)
+    icon_max_dimension = setting("icon_max_dimension", 128, as_int)
     store_name = setting("store.name", "pyff")
+    snapshot_dir = setting("snapshot.dir", None)
+    snapshot_check_interval = setting("snapshot.check_interval", 1, as_int)
     update_frequency = setting("update_frequency", 0, as_int)
     request_timeout = setting("request_timeout", 10, as_int)
     request_cache_time = setting("request_cache_time", 300, as_int)
@@ -159,7 +171,8 @@ class Config(object):
     redis_port = setting("redis_port", 6379, as_int)
     load_icons = setting("load_icons", False, as_bool)
     cache_ttl_icons = setting("cache_ttl_icons", 24*3600, as_int)
-    load_icons_async = setting("load_icons_async", False, as_bool)  # this is unstable - apscheduler is unpredictable
+    load_icons_async = setting("load_icons_async", False, as_bool)
+    icon_refresh_batch = setting("icon_refresh_batch", 50, as_int)
     pipeline = setting("pipeline", None)
     scheduler_job_store = setting("scheduler_job_store", "memory", as_string)
     langs = setting("langs", ['en'], as_list_of_string)
@@ -232,12 +245,16 @@ def parse_options(program, docs, short_args, long_args):
                     config.aliases[a] = uri
             elif o in ('--dir', ):
                 config.base_dir = a
+            elif o in ('--snapshot-dir', ):
+                config.snapshot_dir = a
             elif o in ('--proxy', ):
                 config.proxy = True
             elif o in ('--allow_shutdown', ):
                 config.allow_shutdown = True
             elif o in ('-m', '--module'):
                 config.modules.append(a)
+            elif o in ('--profile', ):
+                config.profile = True
             elif o in ('--version', ):
                 print("{} version {}".format(program, pyff_version))
                 sys.exit(0)
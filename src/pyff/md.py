@@ -6,21 +6,24 @@ Usage: [-h|--help]
        [--loglevel=<level>]
        [--logfile=<file>]
        [--version]
+       [--profile]
 """
 import importlib
 import logging
 import sys
 import traceback
+import tracemalloc
 from .repo import MDRepository
 from .pipes import plumbing
 from .constants import config, parse_options
+from .profiling import report
 
 
 def main():
     """
     The main entrypoint for the pyFF cmdline tool.
     """
-    args = parse_options("pyff", __doc__, 'hm:', ['help', 'loglevel=', 'logfile=', 'version', 'module='])
+    args = parse_options("pyff", __doc__, 'hm:', ['help', 'loglevel=', 'logfile=', 'version', 'module=', 'profile'])
 
     log_args = {'level': config.loglevel}
     if config.logfile is not None:
@@ -31,10 +34,17 @@ def main():
     for mn in config.modules:
         importlib.import_module(mn)
     config.update_frequency = 0
+    if config.profile:
+        tracemalloc.start()
     try:
         md = MDRepository()
         for p in args:
-            plumbing(p).process(md, state={'batch': True, 'stats': {}})
+            state = {'batch': True, 'stats': {}}
+            try:
+                plumbing(p).process(md, state=state)
+            finally:
+                if config.profile:
+                    sys.stderr.write("{}:\n{}\n".format(p, report(state['stats'].get('pipes', []))))
         sys.exit(0)
     except Exception as ex:
         logging.debug(traceback.format_exc())
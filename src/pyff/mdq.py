@@ -37,6 +37,12 @@ An implementation of draft-lajoie-md-query
             The service is running behind a proxy - respect the X-Forwarded-Host header.
     -m <module>|--modules=<module>
             Load a module
+    --snapshot-dir=<dir>
+            Run the update pipeline once in a separate loader process and
+            publish the result as snapshots in <dir>. Workers attach to the
+            snapshots read-only instead of loading metadata themselves. Each
+            worker still parses and indexes the whole snapshot, so this saves
+            fetching and validating metadata in every worker but not memory.
 
     {pipeline-files}+
             One or more pipeline files
@@ -48,9 +54,9 @@ from .constants import config, parse_options
 from .logs import get_log
 import importlib
 import os
+import time
 import gunicorn.app.base
 from gunicorn.six import iteritems
-from .wsgi import app
 import multiprocessing
 
 log = get_log(__name__)
@@ -80,6 +86,29 @@ def number_of_workers(cfg):
     return cfg.worker_pool_size or (multiprocessing.cpu_count() * 2) + 1
 
 
+def snapshot_loader(pipeline, dirname, frequency):
+    """
+    Run the update branch of the pipeline every frequency seconds using a private :py:class:`MemoryStore` and
+    publish a snapshot in dirname every time the store changes.
+    """
+    from .repo import MDRepository
+    from .pipes import plumbing
+    from .store import MemoryStore, write_snapshot
+
+    md = MDRepository(store=MemoryStore())
+    pl = plumbing(pipeline)
+    published = None
+    while True:
+        try:
+            pl.process(md, state={'update': True, 'stats': {}})
+            if md.store.generation != published:
+                if write_snapshot(md.store, dirname) is not None:
+                    published = md.store.generation
+        except Exception as ex:
+            log.error(ex)
+        time.sleep(frequency)
+
+
 def main():
     """
     The (new) main entrypoint for the pyffd command.
@@ -89,7 +118,7 @@ def main():
                          'hP:p:H:CfaA:l:Rm:',
                          ['help', 'loglevel=', 'log=', 'access-log=', 'error-log=',
                           'port=', 'host=', 'no-caching', 'autoreload', 'frequency=', 'module=',
-                          'alias=', 'dir=', 'version', 'proxy', 'allow_shutdown'])
+                          'alias=', 'dir=', 'version', 'proxy', 'allow_shutdown', 'snapshot-dir='])
 
     for p in ('allow_shutdown', 'alias', 'proxy'):
         if getattr(config,p):
@@ -137,6 +166,15 @@ def main():
     if args:
         config.pipeline = args[0]
 
+    if config.snapshot_dir:
+        config.store_class = "pyff.store:SnapshotStore"
+        loader = multiprocessing.Process(target=snapshot_loader,
+                                         name="pyff-snapshot-loader",
+                                         args=(config.pipeline, config.snapshot_dir, config.update_frequency or 600))
+        loader.daemon = True
+        loader.start()
+
+    from .wsgi import app
     MDQApplication(app, options).run()
 
 
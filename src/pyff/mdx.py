@@ -37,6 +37,8 @@ An implementation of draft-lajoie-md-query
             The service is running behind a proxy - respect the X-Forwarded-Host header.
     -m <module>|--modules=<module>
             Load a module
+    --profile
+            Record per-pipe execution statistics
 
     {pipeline-files}+
             One or more pipeline files
@@ -58,7 +60,6 @@ from cherrypy.process.plugins import Monitor, SimplePlugin
 from cherrypy.lib import caching
 from simplejson import dumps
 from .constants import config, parse_options
-from .locks import ReadWriteLock
 from .pipes import plumbing
 from .utils import resource_string, duration2timedelta, debug_observer, render_template, hash_id, safe_b64e, safe_b64d
 from .logs import get_log, SysLogLibHandler
@@ -400,7 +401,6 @@ class MDServer(object):
         if not pipes:
             pipes = []
         self._pipes = pipes
-        self.lock = ReadWriteLock()
         self.plumbings = [plumbing(v) for v in pipes]
         self.refresh = MDUpdate(cherrypy.engine, server=self, frequency=config.update_frequency)
         self.refresh.subscribe()
@@ -433,6 +433,9 @@ class MDServer(object):
             except HTTPError:
                 return False
 
+        def __str__(self):
+            return cherrypy.request.headers.get('Accept', '')
+
     def request(self, **kwargs):
         """The main request processor. This code implements all rendering of metadata.
         """
@@ -504,106 +507,105 @@ class MDServer(object):
         else:
             accept = {content_type: True}
 
-        with self.lock.readlock:
-            if ext == 'ds':
-                pdict = dict()
-                entity_id = kwargs.get('entityID', None)
-                if entity_id is None:
-                    raise HTTPError(400, _("400 Bad Request - missing entityID"))
+        if ext == 'ds':
+            pdict = dict()
+            entity_id = kwargs.get('entityID', None)
+            if entity_id is None:
+                raise HTTPError(400, _("400 Bad Request - missing entityID"))
 
-                e = self.md.store.lookup(entity_id)
-                if e is None or len(e) == 0:
-                    raise HTTPError(404)
+            e = self.md.store.lookup(entity_id)
+            if e is None or len(e) == 0:
+                raise HTTPError(404)
 
-                if len(e) > 1:
-                    raise HTTPError(400, _("Bad Request - multiple matches for") + " %s" % entity_id)
+            if len(e) > 1:
+                raise HTTPError(400, _("Bad Request - multiple matches for") + " %s" % entity_id)
 
-                pdict['entity'] = entity_simple_summary(e[0])
-                if not path:
-                    pdict['search'] = "/search/"
-                    pdict['list'] = "/role/idp.json"
+            pdict['entity'] = entity_simple_summary(e[0])
+            if not path:
+                pdict['search'] = "/search/"
+                pdict['list'] = "/role/idp.json"
+            else:
+                pdict['search'] = "{}.s".format(escape(path, quote=True))
+                pdict['list'] = "{}.json".format(escape(path, quote=True))
+
+            pdict['storage'] = "/storage/"
+            cherrypy.response.headers['Content-Type'] = 'text/html'
+            return render_template(config.ds_template, **pdict)
+        elif ext == 's':
+            query = kwargs.get('query', None)
+            entity_filter = kwargs.get('entity_filter', None)
+            related = kwargs.get('related', None)
+
+            cherrypy.response.headers['Content-Type'] = 'application/json'
+            cherrypy.response.headers['Access-Control-Allow-Origin'] = '*'
+
+            if query is None:
+                log.debug("empty query - creating one")
+                query = [cherrypy.request.remote.ip]
+                referrer = cherrypy.request.headers.get('referrer', None)
+                if referrer is not None:
+                    log.debug("including referrer: %s" % referrer)
+                    url = urlparse(referrer)
+                    host = url.netloc
+                    if ':' in url.netloc:
+                        (host, port) = url.netloc.split(':')
+                    for host_part in host.rstrip(get_public_suffix(host)).split('.'):
+                        if host_part is not None and len(host_part) > 0:
+                            query.append(host_part)
+                log.debug("created query: %s" % ",".join(query))
+
+            return dumps(self.md.store.search(query,
+                                              path=q,
+                                              entity_filter=entity_filter,
+                                              related=related))
+        elif accept.get('text/html'):
+            if not q:
+                if pfx:
+                    title = pfx
                 else:
-                    pdict['search'] = "{}.s".format(escape(path, quote=True))
-                    pdict['list'] = "{}.json".format(escape(path, quote=True))
-
-                pdict['storage'] = "/storage/"
-                cherrypy.response.headers['Content-Type'] = 'text/html'
-                return render_template(config.ds_template, **pdict)
-            elif ext == 's':
-                query = kwargs.get('query', None)
-                entity_filter = kwargs.get('entity_filter', None)
-                related = kwargs.get('related', None)
-
-                cherrypy.response.headers['Content-Type'] = 'application/json'
-                cherrypy.response.headers['Access-Control-Allow-Origin'] = '*'
-
-                if query is None:
-                    log.debug("empty query - creating one")
-                    query = [cherrypy.request.remote.ip]
-                    referrer = cherrypy.request.headers.get('referrer', None)
-                    if referrer is not None:
-                        log.debug("including referrer: %s" % referrer)
-                        url = urlparse(referrer)
-                        host = url.netloc
-                        if ':' in url.netloc:
-                            (host, port) = url.netloc.split(':')
-                        for host_part in host.rstrip(get_public_suffix(host)).split('.'):
-                            if host_part is not None and len(host_part) > 0:
-                                query.append(host_part)
-                    log.debug("created query: %s" % ",".join(query))
-
-                return dumps(self.md.store.search(query,
-                                                  path=q,
-                                                  entity_filter=entity_filter,
-                                                  related=related))
-            elif accept.get('text/html'):
-                if not q:
-                    if pfx:
-                        title = pfx
-                    else:
-                        title = _("Metadata By Attributes")
-                    return render_template("index.html",
+                    title = _("Metadata By Attributes")
+                return render_template("index.html",
+                                       md=self.md,
+                                       samlmd=samlmd,
+                                       alias=alias,
+                                       aliases=self.aliases,
+                                       title=title)
+            else:
+                entities = self.md.lookup(q)
+                if not entities:
+                    raise NotFound()
+                if len(entities) > 1:
+                    return render_template("metadata.html",
                                            md=self.md,
                                            samlmd=samlmd,
-                                           alias=alias,
-                                           aliases=self.aliases,
-                                           title=title)
+                                           subheading=q,
+                                           entities=entities)
                 else:
-                    entities = self.md.lookup(q)
-                    if not entities:
-                        raise NotFound()
-                    if len(entities) > 1:
-                        return render_template("metadata.html",
-                                               md=self.md,
-                                               samlmd=samlmd,
-                                               subheading=q,
-                                               entities=entities)
-                    else:
-                        entity = entities[0]
-                        return render_template("entity.html",
-                                               headline=entity_display_name(entity),
-                                               subheading=entity.get('entityID'),
-                                               entity_id=entity.get('entityID'),
-                                               samlmd=samlmd,
-                                               entity=entity_info(entity))
-            else:
-                for p in self.plumbings:
-                    state = {'request': request_type,
-                             'headers': {'Content-Type': 'text/xml'},
-                             'accept': accept,
-                             'url': cherrypy.url(relative=False),
-                             'select': q,
-                             'path': path,
-                             'stats': {}}
-                    r = p.process(self.md, state=state)
-                    if r is not None:
-                        cache_ttl = state.get('cache', 0)
-                        log.debug("caching for %d seconds" % cache_ttl)
-                        for k, v in list(state.get('headers', {}).items()):
-                            cherrypy.response.headers[k] = v
-                        cherrypy.response.headers['Access-Control-Allow-Origin'] = '*'
-                        caching.expires(secs=cache_ttl)
-                        return r
+                    entity = entities[0]
+                    return render_template("entity.html",
+                                           headline=entity_display_name(entity),
+                                           subheading=entity.get('entityID'),
+                                           entity_id=entity.get('entityID'),
+                                           samlmd=samlmd,
+                                           entity=entity_info(entity))
+        else:
+            for p in self.plumbings:
+                state = {'request': request_type,
+                         'headers': {'Content-Type': 'text/xml'},
+                         'accept': accept,
+                         'url': cherrypy.url(relative=False),
+                         'select': q,
+                         'path': path,
+                         'stats': {}}
+                r = p.process(self.md, state=state, cache=True)
+                if r is not None:
+                    cache_ttl = state.get('cache', 0)
+                    log.debug("caching for %d seconds" % cache_ttl)
+                    for k, v in list(state.get('headers', {}).items()):
+                        cherrypy.response.headers[k] = v
+                    cherrypy.response.headers['Access-Control-Allow-Origin'] = '*'
+                    caching.expires(secs=cache_ttl)
+                    return r
         raise NotFound()
 
 
@@ -616,7 +618,7 @@ def main():
                          'hP:p:H:CfaA:l:Rm:',
                          ['help', 'loglevel=', 'log=', 'access-log=', 'error-log=',
                           'port=', 'host=', 'no-caching', 'autoreload', 'frequency=', 'module=',
-                          'alias=', 'dir=', 'version', 'proxy', 'allow_shutdown'])
+                          'alias=', 'dir=', 'version', 'proxy', 'allow_shutdown', 'profile'])
 
     engine = cherrypy.engine
     plugins = cherrypy.process.plugins
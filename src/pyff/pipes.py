@@ -3,10 +3,23 @@ Pipes and plumbing. Plumbing instances are sequences of pipes. Each pipe is call
 transform, sign or output SAML metadata.
 """
 
+import hashlib
+import json
+import logging
 import traceback
 import os
+import time
 import yaml
-from .utils import resource_string, PyffException, is_text
+from io import BytesIO
+from copy import deepcopy
+from threading import Lock
+from multiprocessing.pool import ThreadPool
+from lxml import etree
+from .constants import config, NS
+from . import profiling
+from .samlmd import iter_entities, entity_digest, EntityStream
+from .store import XMLStream
+from .utils import resource_string, PyffException, is_text, root, parse_xml, CountingLRUCache
 from .logs import get_log
 
 log = get_log(__name__)
@@ -20,6 +33,22 @@ def pipe(*args, **kwargs):
     """
     Register the decorated function in the pyff pipe registry
     :param name: optional name - if None, use function name
+    :param preserves_entities: set to True if the pipe never modifies the EntityDescriptor elements of the working
+    document (it may drop or reorder them). Cf :py:attr:`Plumbing.Request.origin`
+    :param read_only: set to True if the pipe never modifies the working document in any way (it may replace it with
+    a new document). Implies preserves_entities. Cf :py:meth:`Plumbing.Request.own`. Pipes that run a nested
+    pipeline on the same request (pipe and when) are the exception: they are registered read_only because
+    :py:meth:`Plumbing.iprocess` checks the flags of each nested step - copying a shared working document before the
+    first step that isn't read_only and clearing the origin after the first step that doesn't preserve entities - so
+    the flags of such a pipe only describe what it does itself.
+    :param parallel: set to True if the pipe may run in the background when called with the 'parallel' option. Cf
+    :py:meth:`Plumbing.Request.submit`
+    :param per_entity: set to True if the pipe transforms each EntityDescriptor of the working document independently
+    of all other entities and of the rest of the document - or to 'option' if it only does so when called with the
+    'per_entity' option. The outputs of such pipes are memoized per entity. Cf :py:class:`EntityMemo`
+    :param updates_store: set to True if a per_entity pipe also writes each entity it transforms to the store
+    :param streams: set to True if the pipe accepts an unassembled working document (an
+    :py:class:`pyff.samlmd.EntityStream`). The stream is assembled before any other pipe. Cf the 'streaming' setting
     """
 
     def deco_none(f):
@@ -27,6 +56,12 @@ def pipe(*args, **kwargs):
 
     def deco_pipe(f):
         f_name = kwargs.get('name', f.__name__)
+        f.read_only = kwargs.get('read_only', False)
+        f.preserves_entities = kwargs.get('preserves_entities', f.read_only)
+        f.parallel = kwargs.get('parallel', False)
+        f.per_entity = kwargs.get('per_entity', False)
+        f.updates_store = kwargs.get('updates_store', False)
+        f.streams = kwargs.get('streams', False)
         registry[f_name] = f
         return f
 
@@ -42,6 +77,24 @@ class PipeException(PyffException):
     pass
 
 
+def _tree_root(t):
+    if hasattr(t, 'getroottree'):
+        return t.getroottree().getroot()
+    if hasattr(t, 'getroot'):
+        return t.getroot()
+    return None
+
+
+_copy_lock = Lock()
+_responses_lock = Lock()
+
+
+def _assemble(req):
+    """Replace an EntityStream working document (cf streams in :py:func:`pipe`) by the document it assembles."""
+    if isinstance(req.t, EntityStream):
+        req.t = req.t.document()
+
+
 class PluginsRegistry(dict):
     """
     The plugin registry uses pkg_resources.iter_entry_points to list all EntryPoints in the group 'pyff.pipe'. All pipe
@@ -107,6 +160,202 @@ def load_pipe(d):
     return func, opts, name, args
 
 
+class Step(object):
+    """
+    A compiled pipeline step: the pipe function with pre-parsed options and normalized arguments. Steps are created
+    once per plumbing and shared by all requests. Pipes that run their arguments as a nested pipeline (fork, pipe,
+    when, map) get a plumbing for it from :py:meth:`nested` which reuses the compiled steps of the nested pipeline.
+    """
+
+    __slots__ = ('fn', 'opts', 'name', 'args', 'preserves_entities', 'read_only', 'parallel', 'per_entity',
+                 'updates_store', 'streams', 'digest', '_nested')
+
+    def __init__(self, d):
+        fn, opts, name, args = load_pipe(d)
+        if is_text(args):
+            args = [args]
+        if args is not None and type(args) is not dict and type(args) is not list and type(args) is not tuple:
+            raise PipeException("Unknown argument type %s" % repr(args))
+        self.fn = fn
+        self.opts = tuple(opts)
+        self.name = name
+        self.args = args
+        self.preserves_entities = getattr(fn, 'preserves_entities', False)
+        self.read_only = getattr(fn, 'read_only', False)
+        self.parallel = getattr(fn, 'parallel', False) and 'parallel' in self.opts
+        per_entity = getattr(fn, 'per_entity', False)
+        self.per_entity = per_entity is True or (per_entity == 'option' and 'per_entity' in self.opts)
+        self.updates_store = getattr(fn, 'updates_store', False)
+        self.streams = getattr(fn, 'streams', False)
+        self.digest = None
+        if self.per_entity:
+            config_json = json.dumps([name, self.opts, args], sort_keys=True, default=str)
+            self.digest = hashlib.sha1(config_json.encode('utf-8')).hexdigest()
+        self._nested = None
+
+    def nested(self, pid):
+        """
+        Return a plumbing with the given id for the arguments of this step as a nested pipeline.
+
+        :param pid: the id of the nested plumbing
+        """
+        if self._nested is None:
+            self._nested = Plumbing.new_steps(self.args)
+        return Plumbing(self.args, pid, steps=self._nested)
+
+    def __repr__(self):
+        return "Step(name={!r}, opts={!r}, args={!r})".format(self.name, self.opts, self.args)
+
+
+def _accept_key(accept):
+    if accept is None:
+        return None
+    if isinstance(accept, dict):
+        return tuple(sorted(accept.items()))
+    return str(accept)
+
+
+_request_key_ignore = ('headers', 'stats', 'accept', 'cache')
+
+
+def request_key(req):
+    """
+    Return a tuple identifying the response to req: the store generation and the request state that determines
+    the result of a request pipeline (entry point, select, match, path, url and accept).
+
+    :param req: the request
+    """
+    state = tuple(sorted((k, v) for k, v in req.state.items() if k not in _request_key_ignore))
+    return req.md.store.generation, state, _accept_key(req.state.get('accept', None))
+
+
+def _freeze(r):
+    # cached results are kept serialized: every hit gets a document of its own that it may modify. Streams are
+    # shared - they can be iterated more than once and nothing modifies their tree. Other results aren't cached.
+    if isinstance(r, etree._ElementTree):
+        return 'tree', etree.tostring(r)
+    if etree.iselement(r):
+        return 'element', etree.tostring(r, with_tail=False)
+    if isinstance(r, XMLStream):
+        return 'stream', r
+    if r is None or is_text(r) or isinstance(r, bytes):
+        return 'value', r
+    return None, None
+
+
+def _thaw(kind, data):
+    if kind == 'tree':
+        return parse_xml(BytesIO(data))
+    if kind == 'element':
+        return root(parse_xml(BytesIO(data)))
+    return data
+
+
+class ResponseCache(CountingLRUCache):
+    """
+    A bounded (LRU) cache for the results of request pipelines. A result is cached if the pipeline sets a cache
+    time in the request state - as finalize does from cacheDuration or validUntil - and is returned for requests
+    with the same state (entry point, select, match, path, url and accept) until that time has passed or the store
+    changes: entries are keyed on the store generation. Documents are cached serialized and each hit parses a copy
+    of its own. Streams (cf emit) are shared by all hits and text as is. Other results aren't cached.
+    """
+
+    def __init__(self, maxsize=None):
+        if maxsize is None:
+            maxsize = config.response_cache_size
+        super(ResponseCache, self).__init__(maxsize)
+
+    def _expired(self, entry):
+        return entry[0] <= time.time()
+
+    def key(self, req):
+        key = (id(req.md.store),) + request_key(req)
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+    def process(self, pl, req):
+        """
+        Run req through pl unless a cached result for req exists. The cached result restores the working document,
+        origin and response headers of the request that produced it and sets the cache time in the request state to
+        the time left before the result expires.
+
+        :param pl: the plumbing to run
+        :param req: the request
+        :return: the result of the pipeline
+        """
+        if self.maxsize <= 0:
+            return pl.iprocess(req)
+        key = self.key(req)
+        if key is None:
+            return pl.iprocess(req)
+
+        now = time.time()
+        entry = self.get(key)
+        if entry is not None:
+            expires, kind, data, origin, headers = entry
+            req.t = _thaw(kind, data)
+            req.origin = dict(origin) if origin is not None else None
+            req.state['headers'] = dict(headers)
+            req.state['cache'] = int(expires - now)
+            return req.t
+
+        r = pl.iprocess(req)
+        ttl = int(req.state.get('cache', 0) or 0)
+        if req.exception is None and ttl > 0:
+            kind, data = _freeze(r)
+            if kind is not None:
+                origin = dict(req.origin) if req.origin is not None else None
+                self.put(key, (now + ttl, kind, data, origin, dict(req.state.get('headers', {}))))
+        return r
+
+
+_memo_placeholder = "{%s}memo" % NS['pyff']
+
+
+def _copy_into(e, ne):
+    # replace the content of e by that of ne in place - whoever holds on to e (eg map) sees the memoized output
+    e.attrib.clear()
+    e.attrib.update(ne.attrib)
+    e.text = ne.text
+    e[:] = list(ne)
+
+
+class EntityMemo(CountingLRUCache):
+    """
+    A bounded (LRU) cache of the outputs of per_entity pipes (cf :py:func:`pipe`) keyed on the digest of the step
+    (pipe name, options and arguments) and the digest of the input entity (cf :py:func:`pyff.samlmd.entity_digest`).
+    A per_entity step is run on the working document with each entity that has a memoized output replaced by a
+    placeholder; the placeholders are then replaced by the memoized outputs, so the pipe only transforms the
+    entities that changed since they were last seen. Outputs are kept serialized along with their digest which is
+    the input digest of the next per_entity step: entries are (data, digest) tuples. Note that the memo can't tell
+    if a file used by a pipe (eg an XSLT stylesheet) changes - use :py:meth:`clear` if one does.
+    """
+
+    def __init__(self, maxsize=None):
+        if maxsize is None:
+            maxsize = config.entity_memo_size
+        super(EntityMemo, self).__init__(maxsize)
+
+
+_entity_memo = None
+_entity_memo_lock = Lock()
+
+
+def entity_memo():
+    """
+    Return the :py:class:`EntityMemo` shared by all plumbings.
+    """
+    global _entity_memo
+    if _entity_memo is None:
+        with _entity_memo_lock:
+            if _entity_memo is None:
+                _entity_memo = EntityMemo()
+    return _entity_memo
+
+
 class PipelineCallback(object):
     """
 A delayed pipeline callback used as a post for parse_saml_metadata
@@ -114,7 +363,7 @@ A delayed pipeline callback used as a post for parse_saml_metadata
 
     def __init__(self, entry_point, req, store=None):
         self.entry_point = entry_point
-        self.plumbing = Plumbing(req.scope_of(entry_point).plumbing.pipeline, "%s-via-%s" % (req.plumbing.id, entry_point))
+        self.plumbing = req.scope_of(entry_point).plumbing.alias("%s-via-%s" % (req.plumbing.id, entry_point))
         self.req = req
         self.store = store
 
@@ -169,9 +418,62 @@ EntitiesDescriptor element with @Name http://example.com/metadata.xml, @cacheDur
 would then be signed (using signer.key) and finally published in /var/metadata/public/metadata.xml
     """
 
-    def __init__(self, pipeline, pid):
+    def __init__(self, pipeline, pid, steps=None):
         self._id = pid
         self.pipeline = pipeline
+        if steps is None:
+            steps = Plumbing.new_steps(pipeline)
+        self._steps = steps
+        self._responses = None
+
+    @property
+    def responses(self):
+        """
+        The :py:class:`ResponseCache` of this plumbing.
+        """
+        if self._responses is None:
+            with _responses_lock:
+                if self._responses is None:
+                    self._responses = ResponseCache()
+        return self._responses
+
+    @staticmethod
+    def new_steps(pipeline):
+        return [None] * len(pipeline or [])
+
+    def alias(self, pid):
+        """
+        Return a plumbing for the same pipeline with a different id sharing the compiled steps of this one.
+
+        :param pid: the id of the new plumbing
+        """
+        return Plumbing(self.pipeline, pid, steps=self._steps)
+
+    def step(self, i):
+        """
+        Return the compiled step i of the pipeline, compiling it on first use.
+
+        :param i: the index of the step in the pipeline
+        """
+        step = self._steps[i]
+        if step is None:
+            step = Step(self.pipeline[i])
+            self._steps[i] = step
+        return step
+
+    def compile(self):
+        """
+        Compile all steps of the pipeline. Steps that fail to compile (eg because the pipe isn't registered yet) are
+        left to be compiled - and fail - when the pipeline is run.
+
+        :return: the plumbing
+        """
+        for i in range(len(self._steps)):
+            try:
+                self.step(i)
+            except PipeException as ex:
+                log.debug(ex)
+        return self
 
     def to_json(self):
         return self.pipeline
@@ -214,6 +516,15 @@ may modify any of the fields.
             self.raise_exceptions = raise_exceptions
             self.exception = None
             self.parent = None
+            self.origin = None
+            self.entity_digests = None
+            self.step = None
+            self.shared = None
+            self.pending = []
+            self._pool = None
+            self.profile = None
+            if config.profile:
+                self.profile = self.state.setdefault('stats', {}).setdefault('pipes', [])
 
         def scope_of(self, entry_point):
             if 'with {}'.format(entry_point) in self.plumbing.pipeline:
@@ -238,6 +549,120 @@ may modify any of the fields.
 
         def set_parent(self, _parent):
             self.parent = _parent
+            self.profile = _parent.profile
+
+        def nested(self, pid):
+            """
+            Return a plumbing for the arguments of the current step as a nested pipeline (cf :py:meth:`Step.nested`).
+
+            :param pid: the id of the nested plumbing
+            """
+            if self.step is None:
+                return Plumbing(pipeline=self.args, pid=pid)
+            return self.step.nested(pid)
+
+        def share(self, t):
+            """
+            Use t - the working document of another request - as the working document without copying it. The first
+            pipe that isn't registered with read_only=True causes a copy to be made (cf :py:meth:`own`).
+
+            :param t: the working document of the other request
+            """
+            self.t = t
+            self.shared = _tree_root(t)
+
+        def own(self):
+            """
+            Make sure the working document isn't shared with another request by copying it if it (or the tree it
+            belongs to) is shared. Called before each pipe that isn't read_only and by read_only pipes that hand the
+            working document to something that keeps it.
+
+            :return: the working document
+            """
+            if self.shared is not None:
+                if self.t is not None and _tree_root(self.t) is self.shared:
+                    log.debug("copying shared working document")
+                    # parallel fork branches may copy the same tree at the same time
+                    with _copy_lock:
+                        self.t = deepcopy(self.t)
+                self.shared = None
+            return self.t
+
+        def set_origin(self, entities):
+            """
+            Record that the EntityDescriptor elements of the working document are unmodified copies of entities (as
+            returned from the store). The origin is a dict mapping entityID to the store element and is cleared by
+            the first pipe that isn't registered with preserves_entities=True.
+
+            :param entities: an iterable of EntityDescriptor elements from the store
+            """
+            self.origin = dict((e.get('entityID'), e) for e in entities)
+
+        def entity_digest(self, e):
+            """
+            Return the digest of an EntityDescriptor element of the working document (cf
+            :py:func:`pyff.samlmd.entity_digest`) without serializing it if the digest is known: the entity is an
+            unmodified copy of an entity in the store (cf :py:attr:`origin`) or the output of a per_entity step.
+
+            :param e: an EntityDescriptor element
+            """
+            entity_id = e.get('entityID')
+            known = (self.entity_digests or {}).get(entity_id, None)
+            if known is not None and known[0] is e:
+                return known[1]
+            if self.origin:
+                o = self.origin.get(entity_id, None)
+                if o is not None:
+                    digest = self.store.entity_record(o).digest
+                    if digest is not None:
+                        return digest
+            return entity_digest(e)
+
+        def submit(self, fn, done=None):
+            """
+            Run fn in a thread pool. The pipeline continues with the next step while fn runs, but the next step
+            that isn't called with the 'parallel' option (or the end of the pipeline) waits for all submitted
+            functions to return (cf :py:meth:`join`).
+
+            :param fn: a callable without arguments
+            :param done: an optional callable without arguments called by :py:meth:`join` - in the thread running
+            the pipeline and in the order fn was submitted - if fn returns without raising an exception
+            """
+            if self._pool is None:
+                self._pool = ThreadPool(processes=config.worker_pool_size)
+            self.pending.append((self._pool.apply_async(fn), done))
+
+        def join(self, discard=False):
+            """
+            Wait for all functions passed to :py:meth:`submit` and call their done callbacks. If any of them raised
+            an exception that exception - or a PipeException listing all of them if there is more than one - is
+            raised once all of them have returned.
+
+            :param discard: if True don't call the done callbacks and log exceptions instead of raising them
+            """
+            pending, self.pending = self.pending, []
+            errors = []
+            try:
+                for result, done in pending:
+                    try:
+                        result.get()
+                    except Exception as ex:
+                        errors.append(ex)
+                        continue
+                    if done is not None and not discard:
+                        done()
+            finally:
+                if self._pool is not None:
+                    self._pool.close()
+                    self._pool = None
+            if discard:
+                for ex in errors:
+                    log.error(ex)
+            elif len(errors) == 1:
+                raise errors[0]
+            elif errors:
+                raise PipeException("{:d} of {:d} parallel steps failed: {}".format(
+                    len(errors), len(pending), "; ".join(str(ex) for ex in errors)))
 
         @property
         def store(self):
@@ -245,11 +670,14 @@ may modify any of the fields.
                 return self._store
             return self.md.store
 
-        def process(self, pl):
+        def process(self, pl, cache=False):
             """The inner request pipeline processor.
 
             :param pl: The plumbing to run this request through
+            :param cache: if True use the response cache of pl (cf :py:class:`ResponseCache`)
             """
+            if cache:
+                return pl.responses.process(pl, self)
             return pl.iprocess(self)
 
     def iprocess(self, req):
@@ -258,35 +686,142 @@ may modify any of the fields.
         :param req: The request to run through the pipeline
         """
         #log.debug("Processing {}".format(self.pipeline))
-        for p in self.pipeline:
+        debug = log.isEnabledFor(logging.DEBUG)
+        for i in range(len(self._steps)):
             try:
-                pipefn, opts, name, args = load_pipe(p)
-                log.debug("{!s}: calling '{}' using args: {} and opts: {}".format(self.pipeline, name, repr(args), repr(opts)))
-                if is_text(args):
-                    args = [args]
-                if args is not None and type(args) is not dict and type(args) is not list and type(args) is not tuple:
-                    raise PipeException("Unknown argument type %s" % repr(args))
-                req.args = args
-                req.name = name
-                ot = pipefn(req, *opts)
+                step = self.step(i)
+                if req.pending and not step.parallel:
+                    req.join()
+                if debug:
+                    log.debug("{!s}: calling '{}' using args: {} and opts: {}".format(self.pipeline, step.name,
+                                                                                     repr(step.args), repr(step.opts)))
+                req.args = step.args
+                req.name = step.name
+                req.step = step
+                if not step.streams:
+                    _assemble(req)
+                if req.shared is not None and not step.read_only:
+                    req.own()
+                origin = req.origin
+                profile = req.profile
+                if profile is not None:
+                    m = profiling.Measurement(self, step, req.t)
+                    profile.append(m.node)
+                    req.profile = m.steps
+                ot = None
+                try:
+                    if step.per_entity:
+                        ot = self._per_entity(req, step)
+                    else:
+                        ot = step.fn(req, *step.opts)
+                finally:
+                    if profile is not None:
+                        req.profile = profile
+                        m.done(ot if ot is not None else req.t)
                 if ot is not None:
                     req.t = ot
+                if req.origin is origin and not step.preserves_entities:
+                    req.origin = None
+                if not step.per_entity and not step.preserves_entities:
+                    req.entity_digests = None
                 if req.done:
                     break
             except BaseException as ex:
-                log.debug(traceback.format_exc())
-                log.error(ex)
-                req.exception = ex
-                if req.raise_exceptions:
+                if req.pending:
+                    req.join(discard=True)
+                if self._failed(req, ex):
                     raise ex
                 break
+        if req.pending:
+            try:
+                req.join()
+            except BaseException as ex:
+                if self._failed(req, ex):
+                    raise ex
+        _assemble(req)
         return req.t
 
-    def process(self, md, args=None, state=None, t=None, store=None, raise_exceptions=True, scheduler=None):
+    def _per_entity(self, req, step):
+        """
+        Run a per_entity step using the outputs memoized for unchanged entities (cf :py:class:`EntityMemo`). The
+        number of memo hits and misses is added to the 'memo' dict of the 'stats' dict of the request state.
+        """
+        memo = entity_memo()
+        entities = list(iter_entities(req.t)) if memo.maxsize > 0 else []
+        entity_ids = [e.get('entityID') for e in entities]
+        if not entities or len(set(entity_ids)) != len(entity_ids):
+            return step.fn(req, *step.opts)
+
+        hits = []
+        misses = []
+        for e in entities:
+            key = (step.digest, req.entity_digest(e))
+            entry = memo.get(key)
+            if entry is None:
+                misses.append((e.get('entityID'), key))
+            else:
+                hits.append((e, entry))
+        stats = req.state.setdefault('stats', {}).setdefault('memo', {}).setdefault(step.name, dict(hits=0, misses=0))
+        stats['hits'] += len(hits)
+        stats['misses'] += len(misses)
+
+        digests = dict()
+        top = root(req.t)
+        for i, (e, (data, digest)) in enumerate(hits):
+            if e is top:  # the working document is a single entity
+                _copy_into(e, etree.fromstring(data))
+                if step.updates_store:
+                    req.store.update(e)
+                req.entity_digests = {e.get('entityID'): (e, digest)}
+                return req.t
+            p = etree.Element(_memo_placeholder, ref=str(i))
+            p.tail = e.tail
+            e.getparent().replace(e, p)
+
+        # the store updates of the pipe and those of the memoized entities are applied together
+        with req.store.batch() as batch:
+            ot = step.fn(req, *step.opts)
+            t = ot if ot is not None else req.t
+
+            n = 0
+            for p in list(t.iter(_memo_placeholder)):
+                data, digest = hits[int(p.get('ref'))][1]
+                ne = etree.fromstring(data)
+                ne.tail = p.tail
+                p.getparent().replace(p, ne)
+                if step.updates_store:
+                    batch.update(ne)
+                digests[ne.get('entityID')] = (ne, digest)
+                n += 1
+            if n != len(hits):
+                raise PipeException("{}: the pipe didn't preserve the entities of the working document".format(
+                    step.name))
+
+        if misses:
+            outputs = dict((e.get('entityID'), e) for e in iter_entities(t))
+            for entity_id, key in misses:
+                e = outputs.get(entity_id, None)
+                if e is None or entity_id in digests:
+                    continue
+                digest = entity_digest(e)
+                memo.put(key, (etree.tostring(e, with_tail=False), digest))
+                digests[entity_id] = (e, digest)
+        req.entity_digests = digests
+        return ot
+
+    def _failed(self, req, ex):
+        log.debug(traceback.format_exc())
+        log.error(ex)
+        req.exception = ex
+        return req.raise_exceptions
+
+    def process(self, md, args=None, state=None, t=None, store=None, raise_exceptions=True, scheduler=None,
+                cache=False):
         """
         The main entrypoint for processing a request pipeline. Calls the inner processor.
 
 
+        :param cache: if True return a cached result for an identical earlier request (cf :py:class:`ResponseCache`)
         :param scheduler: a scheduler for use in pipes
         :param raise_exceptions: weather to raise or just log exceptions in the process
         :param md: The current metadata repository
@@ -305,7 +840,7 @@ may modify any of the fields.
                                 state=state,
                                 store=store,
                                 raise_exceptions=raise_exceptions,
-                                scheduler=scheduler).process(self)
+                                scheduler=scheduler).process(self, cache=cache)
 
 
 def plumbing(fn):
@@ -323,4 +858,4 @@ This uses the resource framework to locate the yaml file which means that pipeli
         raise PipeException("Plumbing not found: %s" % fn)
     pipeline = yaml.safe_load(ystr)
 
-    return Plumbing(pipeline=pipeline, pid=pid)
+    return Plumbing(pipeline=pipeline, pid=pid).compile()
@@ -0,0 +1,167 @@
+"""
+Execution statistics for pipelines. When profiling is enabled (the profile setting or pyff --profile) each step run
+by :py:meth:`pyff.pipes.Plumbing.iprocess` is measured and recorded in the 'pipes' list of the 'stats' dict of the
+request state. Steps run by nested pipelines (fork, pipe, when, map ...) are recorded in the 'steps' list of the
+step that ran them. Every measurement is also added to a per-pipe :py:class:`Histogram` which the API exposes at
+/api/profile.
+
+Memory deltas are only recorded if tracemalloc is tracing, eg when running pyff --profile or with
+PYTHONTRACEMALLOC=1 in the environment.
+"""
+
+import time
+import tracemalloc
+from threading import Lock
+from .constants import NS
+from .samlmd import EntityStream
+from .utils import root
+
+_cpu_time = getattr(time, 'thread_time', time.process_time)
+
+_entity_tag = "{%s}EntityDescriptor" % NS['md']
+_entities_tag = "{%s}EntitiesDescriptor" % NS['md']
+
+
+def _memory():
+    if tracemalloc.is_tracing():
+        return tracemalloc.get_traced_memory()[0]
+    return None
+
+
+def entity_count(t):
+    """
+    Count the EntityDescriptor elements in t (an EntityDescriptor or a possibly nested EntitiesDescriptor) without
+    searching the entities themselves.
+
+    :param t: an element, a tree or an EntityStream
+    :return: the number of entities
+    """
+    if isinstance(t, EntityStream):
+        return len(t)
+    if t is None or not hasattr(t, 'tag') and not hasattr(t, 'getroot'):
+        return 0
+    r = root(t)
+    if r.tag == _entity_tag:
+        return 1
+    if r.tag != _entities_tag:
+        return 0
+    n = 0
+    for c in r.iterchildren(_entity_tag, _entities_tag):
+        n += 1 if c.tag == _entity_tag else entity_count(c)
+    return n
+
+
+class Histogram(object):
+    """
+    Aggregated per-pipe execution times. Each pipe has a count, total wall and cpu time, the maximum wall time and
+    the number of calls with a wall time of at most each of the :py:attr:`buckets` (in seconds) - cumulative, like
+    a prometheus histogram.
+    """
+
+    buckets = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 60.0)
+
+    def __init__(self):
+        self._lock = Lock()
+        self._pipes = dict()
+
+    def add(self, pipe, wall, cpu):
+        with self._lock:
+            h = self._pipes.get(pipe, None)
+            if h is None:
+                h = dict(count=0, wall=0.0, cpu=0.0, max=0.0, buckets=[0] * (len(Histogram.buckets) + 1))
+                self._pipes[pipe] = h
+            h['count'] += 1
+            h['wall'] += wall
+            h['cpu'] += cpu
+            h['max'] = max(h['max'], wall)
+            for i, le in enumerate(Histogram.buckets):
+                if wall <= le:
+                    h['buckets'][i] += 1
+            h['buckets'][-1] += 1
+
+    def info(self):
+        with self._lock:
+            res = dict()
+            for pipe, h in self._pipes.items():
+                le = ["{:g}".format(b) for b in Histogram.buckets] + ['+Inf']
+                res[pipe] = dict(count=h['count'],
+                                 wall=h['wall'],
+                                 cpu=h['cpu'],
+                                 max=h['max'],
+                                 mean=h['wall'] / h['count'],
+                                 buckets=dict(zip(le, h['buckets'])))
+            return res
+
+    def reset(self):
+        with self._lock:
+            self._pipes.clear()
+
+
+histogram = Histogram()
+
+
+class Measurement(object):
+    """
+    The measurement of a single step. The result is the dict :py:attr:`node` which has the pipe name, the id of the
+    plumbing, the options, wall and cpu time (in seconds), the number of entities in the working document before
+    and after the step, the change in traced memory (in bytes, or None) and the list of nested steps.
+    """
+
+    __slots__ = ('node', '_wall', '_cpu', '_mem')
+
+    def __init__(self, pl, step, t):
+        self.node = dict(pipe=step.name,
+                         plumbing=pl.pid,
+                         opts=list(step.opts),
+                         entities_in=entity_count(t),
+                         steps=[])
+        self._mem = _memory()
+        self._cpu = _cpu_time()
+        self._wall = time.perf_counter()
+
+    @property
+    def steps(self):
+        return self.node['steps']
+
+    def done(self, t):
+        wall = time.perf_counter() - self._wall
+        cpu = _cpu_time() - self._cpu
+        mem = _memory()
+        self.node['wall'] = wall
+        self.node['cpu'] = cpu
+        self.node['memory'] = mem - self._mem if mem is not None and self._mem is not None else None
+        self.node['entities_out'] = entity_count(t)
+        histogram.add(self.node['pipe'], wall, cpu)
+
+
+def _fmt_bytes(n):
+    if n is None:
+        return ""
+    for unit in ('B', 'kB', 'MB'):
+        if abs(n) < 1024:
+            return "{:+.0f}{}".format(n, unit)
+        n /= 1024.0
+    return "{:+.1f}GB".format(n)
+
+
+def report(pipes, indent=0):
+    """
+    Format a list of step measurements (eg state['stats']['pipes']) as an indented tree.
+
+    :param pipes: a list of :py:attr:`Measurement.node` dicts
+    :param indent: the indentation of the top level
+    :return: the report as a string
+    """
+    lines = []
+    for node in pipes:
+        name = " ".join([node['pipe']] + node['opts'])
+        lines.append("{:<40} {:>10.1f}ms wall {:>10.1f}ms cpu {:>6d} -> {:<6d} entities {:>8}".format(
+            "  " * indent + name,
+            node.get('wall', 0.0) * 1000,
+            node.get('cpu', 0.0) * 1000,
+            node['entities_in'],
+            node.get('entities_out', 0),
+            _fmt_bytes(node.get('memory', None))))
+        if node['steps']:
+            lines.append(report(node['steps'], indent + 1))
+    return "\n".join(lines)
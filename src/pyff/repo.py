@@ -4,7 +4,6 @@ from .store import make_store_instance, make_icon_store_instance
 from .utils import is_text, make_default_scheduler
 from .resource import Resource, IconHandler
 from .logs import get_log
-from .samlmd import entitiesdescriptor, root
 from .constants import config
 
 log = get_log(__name__)
@@ -14,14 +13,16 @@ class MDRepository():
     """A class representing a set of SAML metadata and the resources from where this metadata was loaded.
     """
 
-    def __init__(self, scheduler=None):
+    def __init__(self, scheduler=None, store=None):
         random.seed(self)
         self.rm = Resource()  # root
         if scheduler is None:
             scheduler = make_default_scheduler()
             scheduler.start()
         self.scheduler = scheduler
-        self.store = make_store_instance()
+        if store is None:
+            store = make_store_instance()
+        self.store = store
         self.icon_store = make_icon_store_instance()
         self.rm.add_watcher(self.store, scheduler=self.scheduler)
         if config.load_icons:
@@ -68,10 +69,11 @@ Lookup elements in the working metadata repository
 The first form results in the intersection of the results of doing a lookup on the selectors. The second form
 results in the EntityDescriptor elements from the source (defaults to all EntityDescriptors) that match the
 xpath expression. The attribute-value forms resuls in the EntityDescriptors that contain the specified entity
-attribute pair. If non of these forms apply, the lookup is done using either source ID (normally @Name from
-the EntitiesDescriptor) or the entityID of single EntityDescriptors. If member is a URI but isn't part of
-the metadata repository then it is fetched an treated as a list of (one per line) of selectors. If all else
-fails an empty list is returned.
+attribute pair. A domain value that starts with a '.' (eg {http://pyff.io/domain}.example.org) matches the entities
+with a domain (the host part of the entityID or an mdui:DomainHint) equal to or below that domain. If non of these
+forms apply, the lookup is done using either source ID (normally @Name from the EntitiesDescriptor) or the entityID
+of single EntityDescriptors. If member is a URI but isn't part of the metadata repository then it is fetched an
+treated as a list of (one per line) of selectors. If all else fails an empty list is returned.
 
         """
         if store is None:
@@ -86,10 +88,4 @@ fails an empty list is returned.
         if xp is None:
             return l
         else:
-            log.debug("filtering %d entities using xpath %s" % (len(l), xp))
-            t = entitiesdescriptor(l, 'dummy', lookup_fn=self.lookup)
-            if t is None:
-                return []
-            l = root(t).xpath(xp, namespaces=NS, smart_strings=False)
-            log.debug("got %d entities after filtering" % len(l))
-            return l
+            return store.xpath_filter(l, xp)
@@ -12,7 +12,7 @@ from datetime import datetime
 from collections import deque
 from .parse import parse_resource
 from .exceptions import ResourceException
-from .utils import url_get, non_blocking_lock, hex_digest, img_to_data, Watchable
+from .utils import url_get, non_blocking_lock, hex_digest, Watchable
 from copy import deepcopy
 from threading import Lock, Condition
 from .fetch import make_fetcher
@@ -86,14 +86,10 @@ class URLHandler(object):
 
 class IconHandler(URLHandler):
     def __init__(self, *args, **kwargs):
-        kwargs['content_handler'] = IconHandler._convert_image_response
+        kwargs['content_handler'] = kwargs['icon_store'].convert
         super().__init__(self, *args, **kwargs)
         self.icon_store = kwargs.pop('icon_store')
 
-    @staticmethod
-    def _convert_image_response(response):
-        return img_to_data(response.content, response.headers.get('Content-Type'))
-
     def i_handle(self, t, url=None, response=None, exception=None, last_fetched=None):
         try:
             if exception is None:
@@ -2,7 +2,7 @@ from datetime import datetime
 from .utils import parse_xml, check_signature, root, validate_document, xml_error, \
     schema, iso2datetime, duration2timedelta, filter_lang, url2host, trunc_str, subdomains, \
     has_tag, hash_id, load_callable, rreplace, dumptree, first_text, is_text, unicode_stream, \
-    Lambda, b2u
+    Lambda, b2u, compiled_xpath, hex_digest, PersistentDict, CountingLRUCache
 from .logs import get_log
 from .constants import config, NS, ATTRS, NF_URI
 from lxml import etree
@@ -15,14 +15,25 @@ import traceback
 from distutils.util import strtobool
 from .parse import add_parser, PyffParser
 from xmlsec.crypto import CertDict
+from collections import namedtuple
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives.asymmetric import rsa, dsa, ec
+from cryptography.x509 import load_der_x509_certificate
+import base64
+import binascii
+import calendar
+import hashlib
+from threading import Lock
 
 log = get_log(__name__)
 
 
 class EntitySet(object):
     def __init__(self, initial=None):
-        self._e = dict()
-        if initial is not None:
+        self._e = PersistentDict()
+        if isinstance(initial, EntitySet):
+            self._e = initial._e.copy()
+        elif initial is not None:
             for e in initial:
                 self.add(e)
 
@@ -35,14 +46,14 @@ class EntitySet(object):
             del self._e[entity_id]
 
     def __iter__(self):
-        for e in list(self._e.values()):
+        for e in self._e.values():
             yield e
 
     def __len__(self):
-        return len(list(self._e.keys()))
+        return len(self._e)
 
     def __contains__(self, item):
-        return item.get('entityID') in list(self._e.keys())
+        return item.get('entityID') in self._e
 
 
 def find_merge_strategy(strategy_name):
@@ -110,7 +121,7 @@ def parse_saml_metadata(source,
                 t = entitiesdescriptor([t],
                                        base_url,
                                        copy=False,
-                                       validate=True,
+                                       validate=not validate,  # the entity was validated above if validate is set
                                        filter_invalid=filter_invalid,
                                        nsmap=t.nsmap)
 
@@ -267,10 +278,101 @@ def metadata_expiration(t):
     return None
 
 
-def filter_invalids_from_document(t, base_url, validation_errors):
+class ValidationProvenance(CountingLRUCache):
+    """
+    A bounded (LRU) set of the digests (cf :py:func:`entity_digest`) of entities that passed schema validation. The
+    digest only changes if the content of the entity changes, so an entity with a digest in the set is known to be
+    valid wherever it is copied to and doesn't have to be validated again: entities are validated when they are
+    loaded and again only after a pipe modifies them. Cf :py:func:`validate_entities`
+    """
+
+    def __init__(self, maxsize=None):
+        if maxsize is None:
+            maxsize = config.validation_provenance_size
+        super(ValidationProvenance, self).__init__(maxsize)
+
+    def __contains__(self, digest):
+        if digest is None or self.maxsize <= 0:
+            return False
+        return self.get(digest, False)
+
+    def add(self, digest):
+        self.put(digest, True)
+
+
+_validation_provenance = None
+_validation_provenance_lock = Lock()
+
+
+def validation_provenance():
+    """
+    Return the :py:class:`ValidationProvenance` shared by all documents.
+    """
+    global _validation_provenance
+    if _validation_provenance is None:
+        with _validation_provenance_lock:
+            if _validation_provenance is None:
+                _validation_provenance = ValidationProvenance()
+    return _validation_provenance
+
+
+def _validated(e, digests):
+    digest = digests.get(e, None) if digests is not None else None
+    if digest is None and validation_provenance().maxsize > 0:
+        digest = entity_digest(e)
+    if digest is not None:
+        validation_provenance().add(digest)
+
+
+def validate_entities(t, digests=None):
+    """
+    Validate t like :py:func:`pyff.utils.validate_document` without validating the EntityDescriptor children of t that
+    are known to be valid (cf :py:class:`ValidationProvenance`) and record the entities that were validated as valid.
+
+    The known entities are left out of a copy of the document that is validated in place of t - all other children
+    are copied. The entities are validated with t if any two children of t have the same @ID.
+
+    :param t: an EntitiesDescriptor or EntityDescriptor element
+    :param digests: a dict mapping children of t to their digest - entities without a known digest are validated
+    :raise: DocumentInvalid
+    """
+    relt = root(t)
+    provenance = validation_provenance()
+    known = []
+    if digests and relt.tag == "{%s}EntitiesDescriptor" % NS['md']:
+        known = [c for c in relt.iterchildren("{%s}EntityDescriptor" % NS['md']) if digests.get(c, None) in provenance]
+        ids = [c.get('ID') for c in relt.iterchildren() if c.get('ID') is not None]
+        if len(ids) != len(set(ids)):
+            known = []
+
+    if not known:
+        validate_document(t)
+        for e in iter_entities(t):
+            _validated(e, digests)
+        return
+
+    skip = set(known)
+    validated = [c for c in relt.iterchildren("{%s}EntityDescriptor" % NS['md']) if c not in skip]
+    shell = etree.Element(relt.tag, attrib=relt.attrib, nsmap=relt.nsmap)
+    for c in relt.iterchildren():
+        if c not in skip:
+            shell.append(deepcopy(c))
+    if not validated and relt.find("{%s}EntitiesDescriptor" % NS['md']) is None:
+        shell.append(deepcopy(known[0]))  # an EntitiesDescriptor can't be empty
+    validate_document(shell)
+    for e in validated:
+        _validated(e, digests)
+
+
+def filter_invalids_from_document(t, base_url, validation_errors, digests=None):
+    provenance = validation_provenance()
     xsd = schema()
     for e in iter_entities(t):
-        if not xsd.validate(e):
+        if digests and digests.get(e, None) in provenance:
+            continue
+        if xsd.validate(e):
+            _validated(e, digests)
+        else:
             error = xml_error(xsd.error_log, m=base_url)
             entity_id = e.get("entityID", "(Missing entityID)")
             log.warn('removing \'%s\': schema validation failed: %s' % (entity_id, xsd.error_log))
@@ -281,10 +383,10 @@ def filter_invalids_from_document(t, base_url, validation_errors):
     return t
 
 
-def filter_or_validate(t, filter_invalid=False, base_url="", source=None, validation_errors=dict()):
+def filter_or_validate(t, filter_invalid=False, base_url="", source=None, validation_errors=dict(), digests=None):
     log.debug("Filtering invalids from {}".format(base_url))
     if filter_invalid:
-        t = filter_invalids_from_document(t, base_url=base_url, validation_errors=validation_errors)
+        t = filter_invalids_from_document(t, base_url=base_url, validation_errors=validation_errors, digests=digests)
         for entity_id, err in validation_errors.items():
             log.error("Validation error while parsing {} (from {}). Removed @entityID='{}': {}".format(base_url,
                                                                                                        source,
@@ -293,7 +395,7 @@ def filter_or_validate(t, filter_invalid=False, base_url="", source=None, valida
     else:  # all or nothing
         log.debug("Validating (one-shot) {}".format(base_url))
         try:
-            validate_document(t)
+            validate_entities(t, digests=digests)
         except DocumentInvalid as ex:
             err = xml_error(ex.error_log, m=base_url)
             validation_errors[base_url] = err
@@ -335,7 +437,8 @@ def entitiesdescriptor(entities,
                        validate=True,
                        filter_invalid=True,
                        copy=True,
-                       nsmap=None):
+                       nsmap=None,
+                       digest_fn=None):
     """
 :param lookup_fn: a function used to lookup entities by name - set to None to skip resolving
 :param entities: a set of entities specifiers (lookup is used to find entities from this set)
@@ -346,6 +449,8 @@ def entitiesdescriptor(entities,
 :param validate: set to False to skip schema validation of the resulting EntitiesDesciptor element. This is dangerous!
 :param filter_invalid: remove invalid entitiesdescriptor elements from aggregate
 :param nsmap: additional namespace definitions to include in top level entitiesdescriptor element
+:param digest_fn: a function returning the digest of an entity (or None if it isn't known) - entities with a digest
+    recorded as valid are not validated again (cf :py:class:`ValidationProvenance`)
 
 Produce an EntityDescriptors set from a list of entities. Optional Name, cacheDuration and validUntil are affixed.
     """
@@ -369,11 +474,14 @@ Produce an EntityDescriptors set from a list of entities. Optional Name, cacheDu
     if valid_until is not None:
         attrs['validUntil'] = valid_until
     t = etree.Element("{%s}EntitiesDescriptor" % NS['md'], **attrs)
+    digests = dict() if validate and digest_fn is not None else None
     for entity in entities:
         ent_insert = entity
         if copy:
             ent_insert = deepcopy(ent_insert)
         t.append(ent_insert)
+        if digests is not None:
+            digests[ent_insert] = digest_fn(entity)
 
     if config.devel_write_xml_to_file:
         import os
@@ -386,7 +494,8 @@ Produce an EntityDescriptors set from a list of entities. Optional Name, cacheDu
                                filter_invalid=filter_invalid,
                                base_url=name,
                                source="request",
-                               validation_errors=validation_errors)
+                               validation_errors=validation_errors,
+                               digests=digests)
 
         for base_url, err in validation_errors.items():
             log.error("Validation error: @ {}: {}".format(base_url, err))
@@ -394,6 +503,79 @@ Produce an EntityDescriptors set from a list of entities. Optional Name, cacheDu
     return t
 
 
+class _Reiterable(object):
+    def __init__(self, fn):
+        self._fn = fn
+
+    def __iter__(self):
+        return iter(self._fn())
+
+
+class EntityStream(object):
+    """
+    A working document that hasn't been assembled yet: the EntityDescriptor elements it would contain - as returned
+    from the store and never modified in place - and the @Name of the EntitiesDescriptor that would contain them.
+
+    Pipes registered with streams=True (cf :py:func:`pyff.pipes.pipe`) pick, drop or reorder the entities of a stream
+    by returning a new stream that wraps a generator over the old one. Nothing is copied until the aggregate is
+    assembled by :py:meth:`document`, which the pipeline does before the first pipe that needs a document. A stream may
+    be iterated more than once and each iteration runs the generators again.
+    """
+
+    def __init__(self, entities, name, digest_fn=None):
+        self._entities = entities
+        self.name = name
+        self.digest_fn = digest_fn
+
+    def __iter__(self):
+        return iter(self._entities)
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def filter(self, predicate):
+        """
+        :param predicate: a callable taking an EntityDescriptor element
+        :return: a stream of the entities for which predicate returns True
+        """
+        return EntityStream(_Reiterable(lambda: (e for e in self if predicate(e))), self.name, self.digest_fn)
+
+    def lookup(self, entity_ids):
+        """
+        :param entity_ids: a list of entityIDs
+        :return: a stream of the entities with the given entityIDs in the order of the list (cf :py:func:`find_in_document`)
+        """
+
+        def _lookup():
+            by_id = dict((e.get('entityID'), e) for e in self)
+            seen = set()
+            for entity_id in entity_ids:
+                e = by_id.get(entity_id, None)
+                if e is not None and entity_id not in seen:
+                    seen.add(entity_id)
+                    yield e
+
+        return EntityStream(_Reiterable(_lookup), self.name, self.digest_fn)
+
+    def sorted(self, sxp=None):
+        """
+        :param sxp: xpath expression selecting the value used for sorting the entities
+        :return: a stream of the entities sorted as by :py:func:`sort_entities`
+        """
+        return EntityStream(sorted(self, key=sort_key(sxp)), self.name, self.digest_fn)
+
+    def document(self, entities=None):
+        """
+        Assemble (copy and validate) the aggregate exactly like select does without streaming.
+
+        :param entities: an optional list of entities from the stream to assemble instead of all of them
+        :return: an EntitiesDescriptor element
+        """
+        if entities is None:
+            entities = list(self)
+        return entitiesdescriptor(entities, self.name, digest_fn=self.digest_fn)
+
+
 def entities_list(t=None):
     """
         :param t: An EntitiesDescriptor or EntityDescriptor element
@@ -540,7 +722,7 @@ def find_in_document(t, member):
     if is_text(member):
         if '!' in member:
             (src, xp) = member.split("!")
-            return relt.xpath(xp, namespaces=NS, smart_strings=False)
+            return compiled_xpath(xp)(relt)
         else:
             lst = []
             for e in iter_entities(relt):
@@ -609,6 +791,23 @@ def entity_domains(entity):
     return domains
 
 
+def entity_match_strings(entity):
+    """
+    Returns the strings that search and select match queries are matched against: the display, service and
+    organization names, keywords, scopes and the entityID.
+    """
+    lst = []
+    for attr in ['{%s}DisplayName' % NS['mdui'],
+                 '{%s}ServiceName' % NS['md'],
+                 '{%s}OrganizationDisplayName' % NS['md'],
+                 '{%s}OrganizationName' % NS['md'],
+                 '{%s}Keywords' % NS['mdui'],
+                 '{%s}Scope' % NS['shibmd']]:
+        lst.extend([s.text for s in entity.iter(attr)])
+    lst.append(entity.get('entityID'))
+    return [item for item in lst if item is not None]
+
+
 def entity_extended_display(entity, langs=None):
     """Utility-method for computing a displayable string for a given entity.
 
@@ -740,6 +939,19 @@ def discojson_t(t, icon_store=None):
     return [discojson(en, icon_store=icon_store) for en in iter_entities(t)]
 
 
+def entity_digest(e, hn='sha1'):
+    """
+    Returns a digest of the exclusive c14n serialization of the entity which only changes if the content of the
+    entity changes - not when it is moved between documents. Falls back to the plain serialization for entities that
+    can't be canonicalized (eg because they use relative namespace URIs).
+    """
+    try:
+        data = etree.tostring(e, method='c14n', exclusive=True)
+    except etree.C14NError:
+        data = etree.tostring(e)
+    return hex_digest(data, hn)
+
+
 def sha1_id(e):
     return hash_id(e, 'sha1')
 
@@ -837,6 +1049,48 @@ def entity_nameid_formats(entity):
     return [nif.text for nif in entity.iter("{%s}NameIDFormat" % NS['md'])]
 
 
+_KEY_TYPES = (('RSA', rsa.RSAPublicKey), ('DSA', dsa.DSAPublicKey), ('EC', ec.EllipticCurvePublicKey))
+
+Certificate = namedtuple('Certificate', ['fingerprint', 'subject', 'not_after', 'key_type', 'key_size'])
+
+
+def entity_certificates(entity):
+    """
+    Return a list of (fingerprint, element) for each ds:X509Certificate element of entity. The fingerprint is the
+    sha1 hex digest of the DER encoded certificate.
+    """
+    res = []
+    for cd in entity.iter("{%s}X509Certificate" % NS['ds']):
+        try:
+            res.append((hashlib.sha1(base64.b64decode(cd.text or "")).hexdigest(), cd))
+        except (binascii.Error, ValueError):
+            log.debug("{}: unable to decode certificate".format(entity.get('entityID')))
+    return res
+
+
+def certificate_info(data):
+    """
+    Parse a base64 encoded (ie the content of a ds:X509Certificate element) certificate.
+
+    :param data: the base64 encoded DER certificate
+    :return: a :py:class:`Certificate` with not_after as a POSIX timestamp or None if data can't be parsed
+    """
+    try:
+        der = base64.b64decode(data)
+        cert = load_der_x509_certificate(der, backend=default_backend())
+        key = cert.public_key()
+        not_after = getattr(cert, 'not_valid_after_utc', None) or cert.not_valid_after
+        key_type = next((name for name, kt in _KEY_TYPES if isinstance(key, kt)), type(key).__name__)
+        return Certificate(fingerprint=hashlib.sha1(der).hexdigest(),
+                           subject=str(cert.subject),
+                           not_after=calendar.timegm(not_after.utctimetuple()),
+                           key_type=key_type,
+                           key_size=getattr(key, 'key_size', None))
+    except Exception as ex:
+        log.debug("unable to parse certificate: {}".format(ex))
+        return None
+
+
 def object_id(e):
     return e.get('entityID')
 
@@ -1023,14 +1277,10 @@ def expiration(t):
     return None
 
 
-def sort_entities(t, sxp=None):
+def sort_key(sxp=None):
     """
-Sorts the working entities 't' by the value returned by the xpath 'sxp'
-By default, entities are sorted by 'entityID' when this method is called without 'sxp', and otherwise as
-second criteria.
-Entities where no value exists for the given 'sxp' are sorted last.
+Returns the key function used to sort entities by the value returned by the xpath 'sxp' (cf :py:func:`sort_entities`)
 
-:param t: An element tree containing the entities to sort
 :param sxp: xpath expression selecting the value used for sorting the entities
 """
 
@@ -1038,7 +1288,7 @@ Entities where no value exists for the given 'sxp' are sorted last.
         eid = e.attrib.get('entityID')
         sv = None
         try:
-            sxp_values = e.xpath(sxp, namespaces=NS, smart_strings=False)
+            sxp_values = compiled_xpath(sxp)(e)
             try:
                 sv = sxp_values[0]
                 try:
@@ -1054,8 +1304,21 @@ Entities where no value exists for the given 'sxp' are sorted last.
         log.debug("Generated sort key for entityID='%s' and %s='%s'" % (eid, sxp, sv))
         return sv is None, sv, eid
 
+    return get_key
+
+
+def sort_entities(t, sxp=None):
+    """
+Sorts the working entities 't' by the value returned by the xpath 'sxp'
+By default, entities are sorted by 'entityID' when this method is called without 'sxp', and otherwise as
+second criteria.
+Entities where no value exists for the given 'sxp' are sorted last.
+
+:param t: An element tree containing the entities to sort
+:param sxp: xpath expression selecting the value used for sorting the entities
+"""
     container = root(t)
-    container[:] = sorted(container, key=lambda e: get_key(e))
+    container[:] = sorted(container, key=sort_key(sxp))
 
 
 def set_nodecountry(e, country_code):
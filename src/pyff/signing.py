@@ -0,0 +1,332 @@
+"""
+Signing keys that are loaded once and reused. xmlsec loads the key for every signature - for a PKCS#11 key that
+means opening a session and logging in to the token - which dominates the cost of signing many small documents
+(eg per-entity MDQ responses). A :py:class:`Signer` keeps the loaded key: software keys are parsed once and PKCS#11
+keys use a pool of logged-in sessions (cf :py:class:`PKCS11Key`). :py:meth:`Signer.sign_all` signs a batch of
+elements concurrently - in threads for PKCS#11 keys and in the worker process pool for software keys.
+"""
+
+import os
+import time
+from contextlib import contextmanager
+from threading import Lock, local
+from multiprocessing.pool import ThreadPool
+from six.moves import queue
+import xmlsec
+from xmlsec import crypto as xmlsec_crypto
+from lxml import etree
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import serialization
+from cryptography.x509 import load_pem_x509_certificate
+from .constants import config
+from .logs import get_log
+from .utils import root, process_pool, process_pool_size, PyffException
+
+log = get_log(__name__)
+
+_from_keyspec = xmlsec_crypto.from_keyspec
+_signers = dict()
+_lock = Lock()
+_scope = local()
+
+
+def _scoped_from_keyspec(keyspec, private=False, signature_element=None):
+    # xmlsec.sign only takes keyspecs and resolves them through xmlsec.crypto.from_keyspec on every call. This
+    # replaces it for good: inside _loaded_keys the keys of the Signer are returned, everywhere else - other threads,
+    # other xmlsec users - keys are loaded as before
+    keys = getattr(_scope, 'keys', None)
+    if keys is not None and signature_element is None:
+        key = keys.get((keyspec, private), None)
+        if key is not None:
+            return key
+    return _from_keyspec(keyspec, private=private, signature_element=signature_element)
+
+
+xmlsec_crypto.from_keyspec = _scoped_from_keyspec
+
+
+@contextmanager
+def _loaded_keys(keys):
+    """
+    Make xmlsec use the loaded keys - a dict mapping (keyspec, private) to a key - in this thread for the duration
+    of the with statement (cf :py:func:`_scoped_from_keyspec`).
+    """
+    outer = getattr(_scope, 'keys', None)
+    _scope.keys = keys
+    try:
+        yield
+    finally:
+        _scope.keys = outer
+
+
+class PKCS11Key(xmlsec_crypto.XMlSecCrypto):
+    """
+    A PKCS#11 private key with a pool of up to size sessions. Each signature borrows a session from the pool, so up
+    to size signatures can be made concurrently. A session that fails is closed and replaced by a new one on demand.
+
+    The login state of a token is shared by all sessions of the application: the first session logs in, the others
+    are only opened. Closing the last session logs out - so the next session opened logs in again - and
+    :py:meth:`close` logs out explicitly before it closes the last session.
+    """
+
+    def __init__(self, keyspec, size=None):
+        super(PKCS11Key, self).__init__(source='pkcs11', do_padding=False, private=True)
+        if size is None:
+            size = config.pkcs11_sessions
+        self.keyspec = keyspec
+        self.size = max(1, size)
+        self._idle = queue.LifoQueue()
+        self._sessions = 0
+        self._opened = 0
+        self._lock = Lock()
+        self._lib, self._slot, self._keyname, self._pin, self._mech = self._library()
+
+        session, key, cert = self._open()
+        self._sessions = 1
+        self._idle.put((session, key))
+        if cert is not None:
+            self.key = load_pem_x509_certificate(cert, backend=default_backend())
+            self.cert_pem = self.key.public_bytes(encoding=serialization.Encoding.PEM)
+            self.keysize = self.key.public_key().key_size
+
+    def _library(self):
+        # the library is loaded once per process and shared with xmlsec (cf xmlsec.pk11._session)
+        from xmlsec import pk11
+
+        library, slot, keyname, query = pk11.parse_uri(self.keyspec)
+        library = str(library)
+        pin_spec = query.get('pin', "env:PYKCS11PIN")
+        if pin_spec.startswith("env:"):
+            pin = os.environ.get(pin_spec[4:], None)
+        else:
+            pin = pin_spec
+        with pk11._session_lock:
+            lib = pk11._modules.get(library, None)
+            if lib is None:
+                lib = pk11.PyKCS11.PyKCS11Lib()
+                lib.load(library)
+                lib.lib.C_Initialize()
+                pk11._modules[library] = lib
+        if slot is None:
+            slot = lib.getSlotList(tokenPresent=True)[0]
+        return lib, slot, keyname, pin, pk11.PyKCS11.MechanismRSAPKCS1
+
+    def _find_key(self, session):
+        from xmlsec import pk11
+
+        return pk11._find_key(session, self._keyname)
+
+    def _open(self):
+        with self._lock:
+            session = self._lib.openSession(self._slot)
+            try:
+                if self._opened == 0 and self._pin is not None:
+                    session.login(str(self._pin))
+                key, cert = self._find_key(session)
+            except Exception:
+                session.closeSession()
+                raise
+            self._opened += 1
+        if key is None:
+            self._close(session)
+            raise PyffException("No such key: {}".format(self.keyspec))
+        return session, key, cert
+
+    def _close(self, session, logout=False):
+        with self._lock:
+            self._opened -= 1
+            try:
+                if logout and self._opened == 0 and self._pin is not None:
+                    session.logout()
+                session.closeSession()
+            except Exception as ex:
+                log.debug("error closing pkcs11 session: {}".format(ex))
+
+    def _acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            grow = self._sessions < self.size
+            if grow:
+                self._sessions += 1
+        if not grow:
+            return self._idle.get()
+        try:
+            session, key, cert = self._open()
+        except Exception:
+            with self._lock:
+                self._sessions -= 1
+            raise
+        return session, key
+
+    def sign(self, data, sig_uri=None, parameters=None):
+        session, key = self._acquire()
+        try:
+            sig = session.sign(key, data, self._mech)
+        except Exception:
+            self._close(session)
+            with self._lock:
+                self._sessions -= 1
+            raise
+        self._idle.put((session, key))
+        return bytearray(sig)
+
+    def close(self):
+        while True:
+            try:
+                session, key = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self._close(session, logout=True)
+            with self._lock:
+                self._sessions -= 1
+
+
+def _mtime(spec):
+    if spec is not None and os.path.isfile(spec):
+        return os.path.getmtime(spec)
+    return None
+
+
+class Signer(object):
+    """
+    A private key (and optionally a certificate) used to sign documents. Use :py:func:`signer` to get the shared
+    Signer for a key and certificate.
+
+    :param key_spec: a PKCS#11 URI or the name of a file containing a PEM-encoded private key
+    :param cert_spec: the name of a file containing a PEM-encoded certificate or None
+    """
+
+    def __init__(self, key_spec, cert_spec=None):
+        self.key_spec = key_spec
+        self.cert_spec = cert_spec
+        self.pkcs11 = key_spec.startswith("pkcs11://")
+        self.mtimes = (_mtime(key_spec), _mtime(cert_spec))
+        if self.pkcs11:
+            private = PKCS11Key(key_spec)
+        else:
+            private = _from_keyspec(key_spec, private=True)
+        self._keys = {(key_spec, True): private}
+        if cert_spec is not None:
+            self._keys[(cert_spec, False)] = _from_keyspec(cert_spec)
+        self._private = private
+        self._lock = Lock()
+        self.count = 0
+        self.seconds = 0.0
+
+    def _record(self, n, seconds):
+        with self._lock:
+            self.count += n
+            self.seconds += seconds
+
+    def _sign(self, t):
+        opts = dict()
+        idattr = root(t).get('ID')
+        if idattr:
+            opts['reference_uri'] = "#%s" % idattr
+        with _loaded_keys(self._keys):
+            xmlsec.sign(t, self.key_spec, self.cert_spec, **opts)
+        return t
+
+    def sign(self, t):
+        """
+        Sign t. The signature references the ID attribute of the root element of t if there is one and the whole
+        document otherwise.
+
+        :param t: an element or tree
+        :return: t
+        """
+        start = time.time()
+        self._sign(t)
+        self._record(1, time.time() - start)
+        return t
+
+    def sign_all(self, elements):
+        """
+        Sign each of the elements separately (cf :py:meth:`sign`). The elements are signed concurrently: in a pool
+        of pkcs11_sessions threads for a PKCS#11 key and in the worker process pool for a software key. Each signed
+        element replaces the original in its parent.
+
+        :param elements: a list of elements
+        :return: the list of signed elements
+        """
+        if not elements:
+            return []
+        start = time.time()
+        if self.pkcs11:
+            # each thread signs a copy in a document of its own - lxml documents can't be modified concurrently
+            pool = ThreadPool(processes=self._private.size)
+            try:
+                signed = pool.map(self._sign, [_standalone(e) for e in elements])
+            finally:
+                pool.close()
+        elif len(elements) < 2 * process_pool_size():
+            signed = [self._sign(_standalone(e)) for e in elements]
+        else:
+            nproc = process_pool_size()
+            chunksize = max(1, min(100, len(elements) // (nproc * 4)))
+            tasks = [(self.key_spec, self.cert_spec, [etree.tostring(e, with_tail=False)
+                                                      for e in elements[i:i + chunksize]])
+                     for i in range(0, len(elements), chunksize)]
+            signed = []
+            for result in process_pool().imap(_sign_worker, tasks):
+                signed.extend(etree.fromstring(data) for data in result)
+
+        for e, se in zip(elements, signed):
+            parent = e.getparent()
+            if parent is not None:
+                se.tail = e.tail
+                parent.replace(e, se)
+        seconds = time.time() - start
+        self._record(len(elements), seconds)
+        log.info("signed {:d} elements in {:.2f}s ({:.1f} signatures/s)".format(
+            len(elements), seconds, len(elements) / seconds if seconds > 0 else 0.0))
+        return signed
+
+    def info(self):
+        with self._lock:
+            return dict(key=self.key_spec,
+                        pkcs11=self.pkcs11,
+                        count=self.count,
+                        seconds=self.seconds,
+                        rate=self.count / self.seconds if self.seconds > 0 else 0.0)
+
+
+def _standalone(e):
+    return etree.fromstring(etree.tostring(e, with_tail=False))
+
+
+def _sign_worker(task):
+    key_spec, cert_spec, elements = task
+    s = signer(key_spec, cert_spec)
+    return [etree.tostring(s.sign(etree.fromstring(data)), with_tail=False) for data in elements]
+
+
+def signer(key_spec, cert_spec=None):
+    """
+    Return the shared :py:class:`Signer` for key_spec and cert_spec. Key and certificate files are loaded again if
+    they have changed since they were last loaded.
+
+    :param key_spec: a PKCS#11 URI or the name of a file containing a PEM-encoded private key
+    :param cert_spec: the name of a file containing a PEM-encoded certificate or None
+    """
+    s = _signers.get((key_spec, cert_spec), None)
+    if s is None or s.mtimes != (_mtime(key_spec), _mtime(cert_spec)):
+        s = Signer(key_spec, cert_spec)
+        with _lock:
+            old = _signers.get((key_spec, cert_spec), None)
+            _signers[(key_spec, cert_spec)] = s
+        if old is not None and old.pkcs11:
+            old._private.close()
+    return s
+
+
+def info():
+    """
+    Return the signature counts and rates (in signatures per second) of all signers.
+    """
+    with _lock:
+        signers = list(_signers.values())
+    return [s.info() for s in signers]
@@ -1,5 +1,9 @@
+import bisect
+import hashlib
+import heapq
 import operator
 import re
+import traceback
 
 import ipaddr
 import six
@@ -9,10 +13,15 @@ from whoosh.fields import Schema, ID, KEYWORD, NGRAMWORDS
 from whoosh.qparser import MultifieldParser, QueryParser
 from whoosh.filedb.filestore import FileStorage
 import json
+from copy import deepcopy
+from lxml import etree
 from io import BytesIO
-from cachetools.func import ttl_cache
-from threading import ThreadError
-from datetime import datetime, timedelta
+from cachetools.keys import hashkey
+from functools import wraps
+from threading import ThreadError, Lock, RLock, Condition, Thread, local
+from collections import OrderedDict
+from array import array
+from datetime import datetime
 import time
 from pyff.resource import IconHandler
 from . import merge_strategies
@@ -20,15 +29,20 @@ from .constants import NS, ATTRS, ATTRS_INV
 from .constants import config
 from .logs import get_log
 from .samlmd import EntitySet, iter_entities, entity_attribute_dict, is_sp, is_idp, entity_simple_info, \
-    object_id, find_merge_strategy, find_entity, entity_simple_summary, entitiesdescriptor, discojson, entity_icon_url
-from .utils import root, hash_id, avg_domain_distance, load_callable, is_text, b2u, parse_xml, dumptree, \
-    LRUProxyDict, hex_digest, redis, is_past_ttl
+    object_id, find_merge_strategy, find_entity, entity_simple_summary, entitiesdescriptor, discojson, entity_icon_url, \
+    entity_match_strings, sub_domains, _domains, resolve_entities, entity_digest, entity_display_name, \
+    entity_certificates, certificate_info
+from .utils import root, hash_id, avg_domain_vector_distance, domain_vector, load_callable, is_text, b2u, parse_xml, dumptree, \
+    LRUProxyDict, hex_digest, redis, is_past_ttl, sentinel, safe_write, is_ip_address, compiled_xpath, \
+    img_to_data, convert_image, iter_dumptree, PersistentDict, CountingLRUCache
 import os
 import shutil
+import tempfile
 
 log = get_log(__name__)
 
 DINDEX = ('sha1', 'sha256', 'null')
+DOMAIN_SUFFIX_RE = re.compile(r'^\.[\w-]+(\.[\w-]+)*$')
 
 
 def make_store_instance(*args, **kwargs):
@@ -105,9 +119,25 @@ class XMLDict(Dict):
 
 
 class IconStore(object):
+    """
+    Base class for icon stores. The icon store is a watcher of the resource tree and keeps track of the icon URLs
+    of the entities in each resource. Only resources with a new etag are walked on notify and each icon URL is
+    scheduled for (re)fetching in an expiry-ordered queue: new URLs are checked with is_valid once and fetched
+    if needed, known URLs are fetched again when config.cache_ttl_icons has passed. If config.load_icons_async is
+    set the fetching is done by a dedicated worker thread in batches of at most config.icon_refresh_batch URLs,
+    otherwise on notify.
+    """
 
     def __init__(self):
-        pass
+        self._init_refresh()
+
+    def _init_refresh(self):
+        self._refresh_lock = Condition()
+        self._resources = dict()
+        self._refs = dict()
+        self._due = dict()
+        self._expiry = []
+        self._refresher = None
 
     def size(self):
         raise NotImplementedError()
@@ -124,43 +154,147 @@ class IconStore(object):
     def is_valid(self, url):
         return True
 
+    def convert(self, response):
+        """
+        Convert a fetched icon into the form expected by update. Called from the fetcher worker threads.
+
+        :param response: the response from fetching the icon
+        """
+        return img_to_data(response.content, response.headers.get('Content-Type'))
+
+    @staticmethod
+    def _icon_urls(t):
+        urls = set()
+        for e in iter_entities(t):
+            ico = entity_icon_url(e)
+            if ico is not None and 'url' in ico and not ico['url'].startswith('data:'):
+                urls.add(ico['url'])
+        return urls
+
+    def _schedule(self, url, when):
+        self._due[url] = when
+        heapq.heappush(self._expiry, (when, url))
+
+    def _release(self, url):
+        n = self._refs.get(url, 0) - 1
+        if n > 0:
+            self._refs[url] = n
+        else:
+            self._refs.pop(url, None)
+            self._due.pop(url, None)
+
+    def track(self, watched):
+        """
+        Update the tracked icon URLs from the resources in the tree below watched. Resources with the same etag
+        as on the previous call are skipped. New URLs are scheduled for fetching unless is_valid says the store
+        already has a fresh copy.
+
+        :param watched: the root of a resource tree
+        :return: the list of newly tracked icon URLs
+        """
+        new = []
+        seen = set()
+        with self._refresh_lock:
+            for r in watched.walk():
+                if r.t is None:
+                    continue
+                seen.add(r.url)
+                prev = self._resources.get(r.url, None)
+                if prev is not None and r.etag is not None and prev[0] == r.etag:
+                    continue
+                urls = self._icon_urls(r.t)
+                old = prev[1] if prev is not None else set()
+                for u in urls - old:
+                    self._refs[u] = self._refs.get(u, 0) + 1
+                    if self._refs[u] == 1:
+                        new.append(u)
+                for u in old - urls:
+                    self._release(u)
+                self._resources[r.url] = (r.etag, urls)
+            for url in [u for u in self._resources if u not in seen]:
+                for u in self._resources.pop(url)[1]:
+                    self._release(u)
+
+        now = time.time()
+        for u in new:
+            when = now + config.cache_ttl_icons if self.is_valid(u) else now
+            with self._refresh_lock:
+                if u in self._refs and u not in self._due:
+                    self._schedule(u, when)
+
+        log.debug("tracking {} icons ({} new)".format(len(self._refs), len(new)))
+        return new
+
+    def due(self, now=None, limit=None):
+        """
+        Remove and return the tracked icon URLs that are due for fetching.
+
+        :param now: the current time (defaults to time.time())
+        :param limit: the maximum number of URLs to return
+        """
+        if now is None:
+            now = time.time()
+        res = []
+        with self._refresh_lock:
+            while self._expiry and self._expiry[0][0] <= now and (limit is None or len(res) < limit):
+                when, url = heapq.heappop(self._expiry)
+                if self._due.get(url, None) == when:
+                    del self._due[url]
+                    res.append(url)
+        return res
+
+    def refresh(self, urls):
+        """
+        Fetch urls and schedule the next refresh of each after config.cache_ttl_icons.
+        """
+        if not urls:
+            return
+        try:
+            self._load_icons(urls)
+        finally:
+            when = time.time() + config.cache_ttl_icons
+            with self._refresh_lock:
+                for u in urls:
+                    if u in self._refs and u not in self._due:
+                        self._schedule(u, when)
+
+    def _refresh_loop(self):
+        while True:
+            urls = self.due(limit=config.icon_refresh_batch)
+            if urls:
+                try:
+                    self.refresh(urls)
+                except BaseException as ex:
+                    log.debug(traceback.format_exc())
+                    log.warn(ex)
+                continue
+            with self._refresh_lock:
+                timeout = 60
+                if self._expiry:
+                    timeout = min(timeout, max(0, self._expiry[0][0] - time.time()))
+                self._refresh_lock.wait(timeout)
+
     def __call__(self, *args, **kwargs):
         watched = kwargs.pop('watched', None)
-        scheduler = kwargs.pop('scheduler', None)
-        log.debug("about to schedule icon refresh on {} using {}".format(self, scheduler.state))
-        if watched is not None and scheduler is not None:
-            urls = []
-            for r in watched.walk():
-                log.debug("looking at {}".format(r.url))
-                if r.t is not None:
-                    for e in iter_entities(r.t):
-                        ico = entity_icon_url(e)
-                        if ico is not None and 'url' in ico and not ico['url'].startswith('data:'):
-                            urls.append(ico)
-            if config.load_icons_async:
-                now = datetime.now()
-                start = now + timedelta(seconds=20)
-                job = scheduler.add_job(IconStore._load_icons,
-                                        args=[self, urls],
-                                        id="load_icons",
-                                        next_run_time=start,
-                                        name="load_icons",
-                                        max_instances=1,
-                                        coalesce=False)
-                log.debug(job)
-            else:
-                self._load_icons(urls)
+        if watched is None:
+            return
+
+        self.track(watched)
+        if config.load_icons_async:
+            with self._refresh_lock:
+                if self._refresher is None:
+                    self._refresher = Thread(target=self._refresh_loop, name="IconRefresher")
+                    self._refresher.daemon = True
+                    self._refresher.start()
+                self._refresh_lock.notify()
+        else:
+            self.refresh(self.due())
 
     def _load_icons(self, urls):
-        tbs = []
-        for u in [ico['url'] for ico in urls]:
-            if not self.is_valid(u):
-                tbs.append(u)
-
-        log.debug("fetching {} icons".format(len(tbs)))
-        if len(tbs) > 0:
+        log.debug("fetching {} icons".format(len(urls)))
+        if len(urls) > 0:
             icon_handler = IconHandler(icon_store=self, name="Icons")
-            icon_handler.schedule(tbs)
+            icon_handler.schedule(urls)
             try:
                 icon_handler.done.acquire()
                 icon_handler.done.wait()
@@ -179,6 +313,9 @@ class MemoryIconStore(IconStore):
     def lookup(self, uri):
         return self.icons.get(uri, None)
 
+    def is_valid(self, url):
+        return url in self.icons
+
     def update(self, uri, img, info=None):
         self.icons[uri] = img
 
@@ -229,6 +366,7 @@ class RedisIconStore(IconStore):
     def __setstate__(self, state):
         state.setdefault('_redis', None)
         self.__dict__.update(state)
+        self._init_refresh()
         self._setup()
 
     def reset(self):
@@ -238,7 +376,759 @@ class RedisIconStore(IconStore):
         return len(self.icons)
 
 
+class DiskIconStore(IconStore):
+    """
+    An icon store that keeps each icon as a file in a directory so icons survive restarts. The total size of all
+    icons is kept below a byte budget (config.icon_store_maxbytes) by evicting the least recently used icons.
+
+    Icons are converted to PNG and scaled to fit config.icon_max_dimension in the fetcher worker threads. Instead
+    of inlining icons as data: URIs, lookup returns the URL of the icon on the /api/icons/<hash> endpoint so
+    discovery JSON stays small and clients can cache icons. The ETag of an icon is the digest of its content.
+    """
+
+    def __init__(self, directory=None, maxbytes=None):
+        super().__init__()
+        if directory is None:
+            directory = config.icon_store_dir
+        if directory is None:
+            directory = os.path.join(tempfile.gettempdir(), 'pyff-icons')
+        if maxbytes is None:
+            maxbytes = config.icon_store_maxbytes
+        self._dir = directory
+        self._maxbytes = maxbytes
+        self._lock = RLock()
+        self._icons = OrderedDict()
+        self._bytes = 0
+        if not os.path.isdir(self._dir):
+            os.makedirs(self._dir)
+        self._load()
+        if config.icon_store_clear:
+            self.reset()
+
+    @staticmethod
+    def key(uri):
+        return hash_id(uri, prefix=False)
+
+    def _path(self, h, ext=''):
+        return os.path.join(self._dir, "{}{}".format(h, ext))
+
+    def _load(self):
+        icons = []
+        for fn in os.listdir(self._dir):
+            if not fn.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(self._dir, fn)) as fd:
+                    icons.append(json.load(fd))
+            except (IOError, ValueError) as ex:
+                log.warn(ex)
+        for nfo in sorted(icons, key=lambda x: x.get('last_seen', 0)):
+            self._icons[nfo['hash']] = nfo
+            self._bytes += nfo.get('size', 0)
+        self._evict()
+
+    def _evict(self):
+        while self._bytes > self._maxbytes and self._icons:
+            h, nfo = self._icons.popitem(last=False)
+            self._bytes -= nfo.get('size', 0)
+            self._remove(h)
+
+    def _remove(self, h):
+        for ext in ('', '.json'):
+            try:
+                os.unlink(self._path(h, ext))
+            except OSError:
+                pass
+
+    def convert(self, response):
+        return convert_image(response.content, response.headers.get('Content-Type'),
+                             max_dimension=config.icon_max_dimension)
+
+    def lookup(self, uri):
+        h = self.key(uri)
+        with self._lock:
+            nfo = self._icons.get(h, None)
+            if nfo is None or 'etag' not in nfo:
+                return None
+            self._icons.move_to_end(h)
+        return "{}/api/icons/{}".format(config.base_url.rstrip('/'), h)
+
+    def get(self, h):
+        """
+        Return the icon with hash h as a tuple (data, content_type, etag) or None if there is no such icon.
+        """
+        with self._lock:
+            nfo = self._icons.get(h, None)
+            if nfo is None or 'etag' not in nfo:
+                return None
+            self._icons.move_to_end(h)
+        try:
+            with open(self._path(h), 'rb') as fd:
+                return fd.read(), nfo['content_type'], nfo['etag']
+        except IOError as ex:
+            log.warn(ex)
+            return None
+
+    def is_valid(self, url):
+        nfo = self._icons.get(self.key(url), None)
+        if nfo is None or is_past_ttl(int(nfo['last_seen']), ttl=config.cache_ttl_icons):
+            return False
+        return True
+
+    def update(self, uri, img, info=None):
+        h = self.key(uri)
+        nfo = dict(hash=h, url=uri, size=0, last_seen=int(time.time()))
+        if img is not None:
+            data, content_type = img
+            if not safe_write(self._path(h), data):
+                return
+            nfo.update(size=len(data), content_type=content_type, etag=hex_digest(data))
+        elif info is not None and 'exception' in info:
+            nfo['exception'] = "{}".format(info['exception'])
+        safe_write(self._path(h, '.json'), json.dumps(nfo))
+        with self._lock:
+            old = self._icons.pop(h, None)
+            if old is not None:
+                self._bytes -= old.get('size', 0)
+            self._icons[h] = nfo
+            self._bytes += nfo['size']
+            self._evict()
+
+    def reset(self):
+        with self._lock:
+            for h in list(self._icons.keys()):
+                self._remove(h)
+            self._icons = OrderedDict()
+            self._bytes = 0
+
+    def size(self):
+        return len(self._icons)
+
+    def bytes(self):
+        return self._bytes
+
+
+class StoreCache(CountingLRUCache):
+    """
+    A bounded (LRU) cache for the results of store queries. Entries are keyed on the store generation so a
+    result computed before an update can never be returned after it.
+    """
+
+    def __init__(self, maxsize=None):
+        if maxsize is None:
+            maxsize = config.cache_size
+        super(StoreCache, self).__init__(maxsize)
+
+
+def cached(fn):
+    """
+    Cache the result of a store method in the per-store :py:class:`StoreCache` using (generation, method, args)
+    as the key. Calls with unhashable arguments (eg a list of queries) bypass the cache. Each call returns a copy
+    of the cached result (cf :py:func:`_result_copy`).
+    """
+
+    @wraps(fn)
+    def _cached(self, *args, **kwargs):
+        try:
+            key = hashkey(self.generation, fn.__name__, *args, **kwargs)
+            hash(key)
+        except TypeError:
+            return fn(self, *args, **kwargs)
+
+        res = self._result_cache.get(key, sentinel)
+        if res is sentinel:
+            res = fn(self, *args, **kwargs)
+            self._result_cache.put(key, res)
+        return _result_copy(res)
+
+    return _cached
+
+
+def _result_copy(res):
+    """
+    Return a copy of a cached result that the caller can modify without changing the cached one: lists and dicts
+    are copied, as are dicts in a list (eg search results). Elements are shared - as they are with the store.
+    """
+    if isinstance(res, list):
+        return [deepcopy(v) if isinstance(v, dict) else v for v in res]
+    if isinstance(res, dict):
+        return deepcopy(res)
+    return res
+
+
+ROLE_PREDICATES = {'[md:IDPSSODescriptor]': 'idp', '[md:SPSSODescriptor]': 'sp'}
+NONLOCAL_PREDICATE_RE = re.compile(r"(^|[\[(,|=<>!\s])/|\.\.|::|position\(|last\(|\bid\(|\[\s*[\d$]")
+
+
+def _entity_predicates(xp):
+    """
+    Return the predicates of an XPath expression of the form //md:EntityDescriptor[...][...] (possibly an empty
+    string) or None if xp does not have that form.
+    """
+    pfx = '//md:EntityDescriptor'
+    if not xp.startswith(pfx):
+        return None
+    rest = xp[len(pfx):].strip()
+    depth = 0
+    quote = None
+    for c in rest:
+        if quote is not None:
+            if c == quote:
+                quote = None
+        elif depth == 0 and c != '[':
+            return None
+        elif c in '"\'':
+            quote = c
+        elif c == '[':
+            depth += 1
+        elif c == ']':
+            depth -= 1
+    if depth != 0 or quote is not None:
+        return None
+    return rest
+
+
+class TextIndex(object):
+    """
+    An inverted index from the trigrams of the match strings of each entity (cf :py:func:`entity_match_strings`)
+    and from the (up to three character) prefixes of their tokens to entityIDs. This allows substring (search) and
+    token prefix (select match) queries to only look at the entities that can match. Like the rest of the
+    :py:class:`MemoryStore` state the index is copy-on-write: the posting tables are :py:class:`PersistentDict`
+    instances and postings are copied the first time they are modified after a :py:meth:`copy`. Postings are sets
+    while small; larger ones (eg the trigrams of 'https://' which most entityIDs share) are kept in a
+    :py:class:`PersistentDict` (entityID -> None) so they too are cheap to copy.
+    """
+    N = 3
+    LARGE = 4096
+
+    def __init__(self):
+        self._grams = PersistentDict()
+        self._prefixes = PersistentDict()
+        self._owned = (dict(), dict())  # the postings of _grams and _prefixes copied since the last publish
+
+    def copy(self):
+        c = TextIndex()
+        c._grams = self._grams.copy()
+        c._prefixes = self._prefixes.copy()
+        return c
+
+    def publish(self):
+        self._owned = (dict(), dict())
+
+    def _postings(self, idx, owned, k):
+        p = owned.get(k, None)
+        if p is not None:
+            return p
+        p = idx.get(k, None)
+        if p is None:
+            p = set()
+        elif type(p) is PersistentDict:
+            p = p.copy()
+        else:
+            p = set(p)
+        idx[k] = owned[k] = p
+        return p
+
+    def _add(self, idx, owned, k, entity_id):
+        p = self._postings(idx, owned, k)
+        if type(p) is PersistentDict:
+            p[entity_id] = None
+            return
+        p.add(entity_id)
+        if len(p) > self.LARGE:
+            idx[k] = owned[k] = PersistentDict((x, None) for x in p)
+
+    def _discard(self, idx, owned, k, entity_id):
+        p = self._postings(idx, owned, k)
+        if type(p) is PersistentDict:
+            p.pop(entity_id, None)
+        else:
+            p.discard(entity_id)
+
+    def _keys(self, entity):
+        grams = set()
+        prefixes = set()
+        for tstr in entity_match_strings(entity):
+            lstr = tstr.lower()
+            for i in range(len(lstr) - self.N + 1):
+                grams.add(lstr[i:i + self.N])
+            for tpart in tstr.split():
+                tpart = tpart.lower()
+                for i in range(1, min(len(tpart), self.N) + 1):
+                    prefixes.add(tpart[:i])
+        return grams, prefixes
+
+    def replace(self, old, new):
+        """
+        Replace the postings of old (an entity or None) with those of new (an entity with the same entityID or
+        None). Postings of keys both have are left alone so updating an entity without changing its match strings
+        doesn't modify the index.
+        """
+        empty = (set(), set())
+        old_keys = self._keys(old) if old is not None else empty
+        new_keys = self._keys(new) if new is not None else empty
+        for idx, owned, ok, nk in zip((self._grams, self._prefixes), self._owned, old_keys, new_keys):
+            if old is not None:
+                entity_id = old.get('entityID')
+                for k in ok - nk:
+                    if k in idx:
+                        self._discard(idx, owned, k, entity_id)
+            if new is not None:
+                entity_id = new.get('entityID')
+                for k in nk - ok:
+                    self._add(idx, owned, k, entity_id)
+
+    def add(self, entity):
+        self.replace(None, entity)
+
+    def discard(self, entity):
+        self.replace(entity, None)
+
+    def candidates(self, q):
+        if len(q) < self.N:
+            return None
+        postings = [self._grams.get(q[i:i + self.N], ()) for i in range(len(q) - self.N + 1)]
+        postings.sort(key=len)
+        res = set(postings[0])
+        for p in postings[1:]:
+            if not res:
+                break
+            if type(p) is PersistentDict:
+                res = set(x for x in res if x in p)
+            else:
+                res.intersection_update(p)
+        return res
+
+    def prefix_candidates(self, q):
+        return set(self._prefixes.get(q[:self.N], ()))
+
+
+class IPIndex(object):
+    """
+    An index of the mdui:IPHint networks of all entities. Networks are kept in one hash table per (version, prefix
+    length) so finding all networks containing an address takes one probe per prefix length in use - at most 33 for
+    IPv4 and 129 for IPv6 - independent of the number of entities and networks. Postings are tuples and the tables
+    are :py:class:`PersistentDict` instances copied by :py:meth:`copy` so a published index is never modified.
+    """
+
+    def __init__(self):
+        self._nets = dict()
+
+    def copy(self):
+        c = IPIndex()
+        c._nets = dict((k, v.copy()) for k, v in self._nets.items())
+        return c
+
+    def _networks(self, entity):
+        try:
+            return [ipaddr.IPNetwork(x.text) for x in entity.iter('{%s}IPHint' % NS['mdui'])]
+        except (ValueError, TypeError):  # search ignores the IPHints of entities with invalid ones
+            return []
+
+    def add(self, entity):
+        entity_id = entity.get('entityID')
+        for pos, net in enumerate(self._networks(entity)):
+            idx = self._nets.setdefault((net.version, net.prefixlen), PersistentDict())
+            k = int(net.network)
+            idx[k] = idx.get(k, ()) + ((entity_id, pos, net),)
+
+    def discard(self, entity):
+        entity_id = entity.get('entityID')
+        for net in self._networks(entity):
+            idx = self._nets.get((net.version, net.prefixlen), None)
+            if idx is None:
+                continue
+            k = int(net.network)
+            postings = tuple(p for p in idx.get(k, ()) if p[0] != entity_id)
+            if postings:
+                idx[k] = postings
+            else:
+                idx.pop(k, None)
+
+    def lookup(self, q):
+        try:
+            addr = ipaddr.IPv6Address(q) if ':' in q else ipaddr.IPv4Address(q)
+        except ValueError:
+            return dict()
+        bits = addr.max_prefixlen
+        res = dict()
+        for (version, prefixlen), idx in self._nets.items():
+            if version != addr.version:
+                continue
+            k = int(addr) >> (bits - prefixlen) << (bits - prefixlen)
+            for entity_id, pos, net in idx.get(k, ()):
+                if entity_id not in res or pos < res[entity_id][0]:
+                    res[entity_id] = (pos, net)
+        return dict((entity_id, net) for entity_id, (pos, net) in res.items())
+
+
+class DomainIndex(object):
+    """
+    A suffix trie over the domains of all entities (the host part of the entityID and any mdui:DomainHint) keyed on
+    the reversed domain labels so that all entities in or below a domain are found by walking a single path. The
+    index also keeps the domain label vectors (cf :py:func:`domain_vector`) used for related-domain ranking. Trie
+    nodes are copied on write after a :py:meth:`copy` so a published index is never modified.
+    """
+
+    def __init__(self):
+        self._root = (dict(), set())
+        self._vectors = PersistentDict()
+        self._owned = set()
+
+    def copy(self):
+        c = DomainIndex()
+        c._root = self._root
+        c._vectors = self._vectors.copy()
+        return c
+
+    def publish(self):
+        self._owned = set()
+
+    def _own(self, node):
+        if id(node) not in self._owned:
+            node = (dict(node[0]), set(node[1]))
+            self._owned.add(id(node))
+        return node
+
+    def _labels(self, domain):
+        return [label for label in reversed(domain.lower().split('.')) if label]
+
+    def _domains(self, entity):
+        try:
+            return _domains(entity)
+        except ValueError:
+            return []
+
+    def _modify(self, entity, add):
+        entity_id = entity.get('entityID')
+        for domain in self._domains(entity):
+            labels = self._labels(domain or '')
+            if not labels:
+                continue
+            node = self._root = self._own(self._root)
+            for label in labels:
+                child = node[0].get(label, None)
+                if child is None and not add:
+                    break
+                elif child is None:
+                    child = (dict(), set())
+                    self._owned.add(id(child))
+                else:
+                    child = self._own(child)
+                node[0][label] = child
+                node = child
+            else:
+                if add:
+                    node[1].add(entity_id)
+                else:
+                    node[1].discard(entity_id)
+
+    def add(self, entity):
+        self._modify(entity, True)
+        self._vectors[entity.get('entityID')] = domain_vector(";".join(sub_domains(entity)))
+
+    def discard(self, entity):
+        self._modify(entity, False)
+        self._vectors.pop(entity.get('entityID'), None)
+
+    def vector(self, entity_id):
+        return self._vectors.get(entity_id, None)
+
+    def lookup(self, domain):
+        """
+        Return the entityIDs of all entities with a domain equal to or below domain
+        """
+        node = self._root
+        for label in self._labels(domain):
+            node = node[0].get(label, None)
+            if node is None:
+                return set()
+        res = set()
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            res.update(node[1])
+            stack.extend(node[0].values())
+        return res
+
+
+class CertificateIndex(object):
+    """
+    An inventory of the certificates of all entities keyed on their sha1 fingerprint. Each certificate is parsed
+    once when the first entity using it is added (cf :py:func:`certificate_info`) and is kept along with the
+    entityIDs of the entities that use it. Expiry queries use arrays of the notAfter times (sorted) and fingerprints
+    of all certificates which are built by the first query after a modification, so finding the certificates that
+    expire before some time is a binary search. Postings are tuples and the dicts are :py:class:`PersistentDict`
+    instances copied by :py:meth:`copy` so a published index is never modified.
+    """
+
+    def __init__(self):
+        self._certs = PersistentDict()
+        self._entities = PersistentDict()
+        self._expiry = None
+
+    def copy(self):
+        c = CertificateIndex()
+        c._certs = self._certs.copy()
+        c._entities = self._entities.copy()
+        return c
+
+    def _fingerprints(self, entity):
+        if entity is None:
+            return dict()
+        return dict(entity_certificates(entity))
+
+    def replace(self, old, new):
+        """
+        Replace the certificates of old (an entity or None) with those of new (an entity or None). Certificates
+        used by both are left alone.
+        """
+        old_fps = self._fingerprints(old)
+        new_fps = self._fingerprints(new)
+        if old is not None:
+            entity_id = old.get('entityID')
+            for fp in set(old_fps) - set(new_fps):
+                postings = tuple(x for x in self._entities.get(fp, ()) if x != entity_id)
+                if postings:
+                    self._entities[fp] = postings
+                else:
+                    self._entities.pop(fp, None)
+                    self._certs.pop(fp, None)
+                self._expiry = None
+        if new is not None:
+            entity_id = new.get('entityID')
+            for fp, cd in new_fps.items():
+                postings = self._entities.get(fp, ())
+                if entity_id in postings:
+                    continue
+                if fp not in self._certs:
+                    self._certs[fp] = certificate_info(cd.text)
+                self._entities[fp] = postings + (entity_id,)
+                self._expiry = None
+
+    def add(self, entity):
+        self.replace(None, entity)
+
+    def discard(self, entity):
+        self.replace(entity, None)
+
+    def __len__(self):
+        return len(self._entities)
+
+    def __iter__(self):
+        return (c for c in self._certs.values() if c is not None)
+
+    def get(self, fingerprint):
+        """
+        Return the :py:class:`Certificate` with fingerprint or None if there is no such (parseable) certificate
+        """
+        return self._certs.get(fingerprint, None)
+
+    def entities(self, fingerprint):
+        """
+        Return the entityIDs of the entities using the certificate with fingerprint
+        """
+        return self._entities.get(fingerprint, ())
+
+    def _columns(self):
+        expiry = self._expiry
+        if expiry is None:
+            certs = sorted((c for c in self if c.not_after is not None), key=operator.attrgetter('not_after'))
+            expiry = (array('d', [c.not_after for c in certs]), [c.fingerprint for c in certs])
+            self._expiry = expiry
+        return expiry
+
+    def expiring(self, seconds, now=None):
+        """
+        Return the certificates that have expired or expire within seconds from now, ordered by expiry time.
+
+        :param seconds: the number of seconds
+        :param now: the current time as a POSIX timestamp (default: time.time())
+        :return: a list of :py:class:`Certificate`
+        """
+        if now is None:
+            now = time.time()
+        not_after, fingerprints = self._columns()
+        return [self._certs[fp] for fp in fingerprints[:bisect.bisect_right(not_after, now + seconds)]]
+
+
+class EntityRecord(object):
+    """
+    Summary information about an entity used for discovery, search and webfinger: the simple summary, the display
+    name, the discojson dict and its JSON encoding for the default and each configured language and the serialized
+    XML of the entity used to assemble aggregates (cf :py:meth:`SAMLStoreBase.serialize`). Values are
+    computed on first use and kept for the lifetime of the record. A :py:class:`MemoryStore` keeps one record per
+    entity keyed on the digest of the entity (cf :py:func:`entity_digest`) and warms it at update time, so the
+    record is reused for as long as the entity doesn't change.
+    """
+
+    def __init__(self, e, digest=None):
+        self._e = e
+        self.digest = digest
+        self._summary = None
+        self._display_name = None
+        self._discojson = dict()
+        self._json = dict()
+        self._xml = None
+
+    def warm(self, langs=None):
+        if langs is None:
+            langs = config.langs
+        self.summary()
+        self.display_name()
+        self.xml()
+        for lang in [None] + [[lang] for lang in langs]:
+            self.discojson_json(langs=lang)
+        return self
+
+    @property
+    def title(self):
+        return self._get_discojson(None)['title']
+
+    def summary(self):
+        if self._summary is None:
+            self._summary = entity_simple_summary(self._e)
+        return dict(self._summary)
+
+    def display_name(self):
+        if self._display_name is None:
+            self._display_name = entity_display_name(self._e)
+        return self._display_name
+
+    def xml(self):
+        """
+        The UTF-8 serialization of the entity without XML declaration. The entity carries all namespace declarations
+        in scope in the source document so the bytes can be embedded in any aggregate - prefixes used in attribute
+        values and text (eg xsi:type) remain bound.
+        """
+        if self._xml is None:
+            self._xml = etree.tostring(self._e, encoding='UTF-8', xml_declaration=False, with_tail=False)
+        return self._xml
+
+    def _get_discojson(self, langs):
+        k = tuple(langs) if langs is not None else None
+        d = self._discojson.get(k, None)
+        if d is None:
+            d = discojson(self._e, langs=langs)
+            self._discojson[k] = d
+        return d
+
+    def _icon(self, d, icon_store):
+        icon_info = d.get('entity_icon_url', None)
+        if icon_store is not None and icon_info is not None and 'url' in icon_info:
+            return icon_store.lookup(icon_info['url'])
+        return None
+
+    def discojson(self, langs=None, icon_store=None):
+        d = deepcopy(self._get_discojson(langs))
+        ico = self._icon(d, icon_store)
+        if ico is not None:
+            d['entity_icon_url']['url'] = ico
+        return d
+
+    def discojson_json(self, langs=None, icon_store=None):
+        if self._icon(self._get_discojson(langs), icon_store) is not None:
+            return json.dumps(self.discojson(langs=langs, icon_store=icon_store))
+        k = tuple(langs) if langs is not None else None
+        j = self._json.get(k, None)
+        if j is None:
+            j = json.dumps(self._get_discojson(langs))
+            self._json[k] = j
+        return j
+
+
+class XMLStream(object):
+    """
+    A document serialized on demand: iterating over an XMLStream yields UTF-8 encoded chunks of the document from
+    :py:meth:`SAMLStoreBase.serialize_chunks`. An XMLStream can be iterated over more than once (eg when it is
+    returned from the response cache) as long as the tree isn't modified.
+    """
+
+    def __init__(self, store, t, origin=None):
+        self.store = store
+        self.t = t
+        self.origin = origin
+
+    def __iter__(self):
+        return self.store.serialize_chunks(self.t, origin=self.origin)
+
+    def etag(self):
+        """
+        Return the sha1 digest of the document if it can be computed without serializing the whole document at
+        once (ie if it is assembled from cached entity serializations) and None otherwise.
+        """
+        if not self.origin:
+            return None
+        parts = self.store._parts(self.t, self.origin)
+        if parts is None:
+            return None
+        m = hashlib.sha1()
+        for p in parts:
+            m.update(p)
+        return m.hexdigest()
+
+
+class StoreBatch(object):
+    """
+    Buffers updates of a store (cf :py:meth:`SAMLStoreBase.batch`) and applies them with
+    :py:meth:`SAMLStoreBase.update_batch` when the outermost `with` block using the batch exits without an exception.
+    The buffered updates are discarded if an exception is raised.
+    """
+
+    def __init__(self, store):
+        self._store = store
+        self._items = []
+        self._depth = 0
+
+    def update(self, t, tid=None, etag=None, lazy=True):
+        """
+        Buffer an update - same arguments as :py:meth:`SAMLStoreBase.update`
+        """
+        self._items.append((t, tid, etag, lazy))
+
+    def __len__(self):
+        return len(self._items)
+
+    def __enter__(self):
+        if self._depth == 0:
+            self._store._batches.current = self
+        self._depth += 1
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._depth -= 1
+        if self._depth > 0:
+            return
+        self._store._batches.current = None
+        items, self._items = self._items, []
+        if exc_type is None and items:
+            self._store.update_batch(items)
+
+
 class SAMLStoreBase(object):
+    def __init__(self, *args, **kwargs):
+        self._generation = 0
+        self._generation_lock = Lock()
+        self._result_cache = StoreCache()
+        self._certificates = None
+        self._batches = local()
+
+    @property
+    def generation(self):
+        """
+        A monotonically increasing number identifying the current contents of the store. The generation is bumped
+        every time the store is mutated.
+        """
+        return self._generation
+
+    def _touch(self):
+        with self._generation_lock:
+            self._generation += 1
+        self._result_cache.clear()
+
+    def cache_info(self):
+        return self._result_cache.info()
+
     def lookup(self, key):
         raise NotImplementedError()
 
@@ -256,12 +1146,103 @@ class SAMLStoreBase(object):
     def update(self, t, tid=None, etag=None, lazy=True):
         raise NotImplementedError()
 
+    def batch(self):
+        """
+        Return a :py:class:`StoreBatch` to use as a context manager by code that updates many entities, eg:
+
+        .. code-block:: python
+
+            with store.batch() as batch:
+                for e in entities:
+                    batch.update(e)
+
+        The updates are applied together (cf :py:meth:`update_batch`) when the block exits. Opening a batch in a
+        block that already uses a batch of the same store in the same thread returns the open batch, so nested
+        blocks are applied together with the outermost one.
+        """
+        current = getattr(self._batches, 'current', None)
+        if current is not None:
+            return current
+        return StoreBatch(self)
+
+    def update_batch(self, items):
+        """
+        Apply a list of updates - (t, tid, etag, lazy) tuples with the arguments of :py:meth:`update` - in order. Stores
+        that can apply many updates at once do so bumping the generation once.
+
+        :param items: a list of updates
+        """
+        for t, tid, etag, lazy in items:
+            self.update(t, tid=tid, etag=etag, lazy=lazy)
+
     def reset(self):
         raise NotImplementedError()
 
     def entity_ids(self):
         return set(e.get('entityID') for e in self.lookup('entities'))
 
+    def text_candidates(self, q, prefix=False):
+        """
+        Return the set of entityIDs that could have a match string (cf :py:func:`entity_match_strings`) containing q
+        - or a token starting with q if prefix is True. Returns None if the store can't narrow down the candidates
+        in which case every entity has to be considered.
+        """
+        return None
+
+    def entity_record(self, e):
+        """
+        Return an :py:class:`EntityRecord` for e. Stores that precompute records return the precomputed one if e
+        is the current version of the entity in the store.
+        """
+        return EntityRecord(e)
+
+    def domain_vector(self, e):
+        """
+        Return the domain label vector (cf :py:func:`domain_vector`) used to rank e by related domains
+        """
+        return domain_vector(";".join(sub_domains(e)))
+
+    def certificates(self):
+        """
+        Return the :py:class:`CertificateIndex` of the certificates of all entities in the store. Stores that don't
+        maintain an index build one from all entities the first time it is needed in each generation.
+        """
+        certs = self._certificates
+        if certs is None or certs[0] != self.generation:
+            idx = CertificateIndex()
+            for e in self.lookup('entities'):
+                idx.add(e)
+            certs = self._certificates = (self.generation, idx)
+        return certs[1]
+
+    def ip_lookup(self, q):
+        """
+        Return a dict mapping the entityIDs of all entities with an mdui:IPHint network containing the IP address q
+        to the first such network or None if the store does not index IPHints.
+        """
+        return None
+
+    def match_candidates(self, query, prefix=False):
+        """
+        Return the union of :py:meth:`text_candidates` (and of :py:meth:`ip_lookup` for IP addresses) for each of
+        the strings in query or None if any of them can't be narrowed down.
+        """
+        res = set()
+        for q in query:
+            q = q.strip()
+            if len(q) == 0:
+                continue
+            if is_ip_address(q):
+                hits = self.ip_lookup(q)
+                if hits is None:
+                    return None
+                res.update(hits.keys())
+            c = self.text_candidates(q, prefix=prefix)
+            if c is None:
+                return None
+            res.update(c)
+        return res
+
     def _select(self, member=None):
         if member is None:
             member = "entities"
@@ -284,6 +1265,80 @@ class SAMLStoreBase(object):
                 if r.t is not None:
                     self.update(r.t, tid=r.name, etag=r.etag)
 
+    def serialize(self, t, origin=None):
+        """
+        Serialize t like :py:func:`pyff.utils.dumptree`. If origin (cf :py:attr:`pyff.pipes.Plumbing.Request.origin`)
+        shows that the entities of t are unmodified copies of entities in the store the result is assembled from the
+        cached serialization of each entity between a header and a footer generated from the root element. Any tree
+        that doesn't consist only of such entities is serialized in full.
+
+        :param t: an EntitiesDescriptor or EntityDescriptor element or tree
+        :param origin: a dict mapping entityID to the store element the entity in t is a copy of
+        :return: the UTF-8 encoded XML document
+        """
+        if origin:
+            data = self._assemble(t, origin)
+            if data is not None:
+                return data
+        return dumptree(t)
+
+    def serialize_chunks(self, t, origin=None):
+        """
+        Serialize t like :py:meth:`serialize` but return an iterator over chunks of the document so the whole
+        document never has to be held in memory. If t can't be assembled from cached entity serializations the
+        children of the root element are serialized one at a time (cf :py:func:`pyff.utils.iter_dumptree`) which
+        repeats the namespace declarations of the root element on each child.
+
+        :param t: an EntitiesDescriptor or EntityDescriptor element or tree
+        :param origin: a dict mapping entityID to the store element the entity in t is a copy of
+        :return: an iterator over UTF-8 encoded chunks of the XML document
+        """
+        if origin:
+            parts = self._parts(t, origin)
+            if parts is not None:
+                return iter(parts)
+        return iter_dumptree(t)
+
+    def _assemble(self, t, origin):
+        parts = self._parts(t, origin)
+        if parts is None:
+            return None
+        return b''.join(parts)
+
+    def _parts(self, t, origin):
+        r = root(t)
+        if r is None or r.getprevious() is not None or r.getnext() is not None:
+            return None
+
+        if r.tag == "{%s}EntityDescriptor" % NS['md']:
+            entities = [r]
+            shell = None
+        elif r.tag == "{%s}EntitiesDescriptor" % NS['md']:
+            if r.text is not None and r.text.strip():
+                return None
+            entities = list(r)
+            shell = etree.Element(r.tag, attrib=dict(r.attrib), nsmap=r.nsmap)
+        else:
+            return None
+
+        parts = []
+        for e in entities:
+            if e.tag != "{%s}EntityDescriptor" % NS['md'] or (e.tail is not None and e.tail.strip()):
+                return None
+            o = origin.get(e.get('entityID'), None)
+            if o is None:
+                return None
+            parts.append(self.entity_record(o).xml())
+
+        if shell is None:
+            header, footer = b"<?xml version='1.0' encoding='UTF-8'?>\n", b''
+        else:
+            marker = "@@{}@@".format(id(shell))
+            shell.text = marker
+            header, footer = dumptree(shell).split(marker.encode('utf-8'))
+
+        return [header] + parts + [footer]
+
     def select(self, member, xp=None):
         """
         Select a set of metadata elements and return an EntityDescriptor with the result of the select.
@@ -321,13 +1376,37 @@ class SAMLStoreBase(object):
         if xp is None:
             return l
         else:
-            log.debug("filtering %d entities using xpath %s" % (len(l), xp))
-            t = entitiesdescriptor(l, 'dummy', lookup_fn=self.lookup)
+            return self.xpath_filter(l, xp)
+
+    def xpath_filter(self, entities, xp):
+        """
+        Filter a list of entities using the XPath expression xp as if it was evaluated on an EntitiesDescriptor
+        containing the entities. Expressions of the form //md:EntityDescriptor[md:IDPSSODescriptor] (or
+        md:SPSSODescriptor) are answered using the role index. Other //md:EntityDescriptor[...] expressions with
+        predicates that only look at the entity itself are evaluated per entity. Anything else is evaluated on an
+        (unvalidated) aggregate of the entities.
+
+        :param entities: a list of EntityDescriptor elements
+        :param xp: an XPath expression
+        :return: a list of the elements matching xp
+        """
+        entities = list(resolve_entities(entities))
+        log.debug("filtering %d entities using xpath %s" % (len(entities), xp))
+        predicates = _entity_predicates(xp)
+        if predicates is not None and re.sub(r'\s', '', predicates) in ROLE_PREDICATES:
+            role = ROLE_PREDICATES[re.sub(r'\s', '', predicates)]
+            ids = set(e.get('entityID') for e in self.lookup("{%s}%s" % (ATTRS['role'], role)))
+            l = [e for e in entities if e.get('entityID') in ids]
+        elif predicates is not None and not NONLOCAL_PREDICATE_RE.search(predicates):
+            xpe = compiled_xpath("self::md:EntityDescriptor{}".format(predicates))
+            l = [e for e in entities if xpe(e)]
+        else:
+            t = entitiesdescriptor(entities, 'dummy', validate=False)
             if t is None:
                 return []
-            l = root(t).xpath(xp, namespaces=NS, smart_strings=False)
-            log.debug("got %d entities after filtering" % len(l))
-            return l
+            l = compiled_xpath(xp)(root(t))
+        log.debug("got %d entities after filtering" % len(l))
+        return l
 
     def merge(self, t, nt, strategy=merge_strategies.replace_existing, strategy_name=None):
         """
@@ -361,6 +1440,7 @@ replace old_e in t.
             if new is not None:
                 self.update(new)
 
+    @cached
     def search(self, query=None, path=None, entity_filter=None, related=None):
         """
 :param query: A string to search for.
@@ -384,25 +1464,17 @@ The dict in the list contains three items:
         if isinstance(query, six.string_types):
             query = [query.lower()]
 
-        def _strings(elt):
-            lst = []
-            for attr in ['{%s}DisplayName' % NS['mdui'],
-                         '{%s}ServiceName' % NS['md'],
-                         '{%s}OrganizationDisplayName' % NS['md'],
-                         '{%s}OrganizationName' % NS['md'],
-                         '{%s}Keywords' % NS['mdui'],
-                         '{%s}Scope' % NS['shibmd']]:
-                lst.extend([s.text for s in elt.iter(attr)])
-            lst.append(elt.get('entityID'))
-            return [item for item in lst if item is not None]
-
         def _ip_networks(elt):
             return [ipaddr.IPNetwork(x.text) for x in elt.iter('{%s}IPHint' % NS['mdui'])]
 
         def _match(qq, elt):
             for q in qq:
                 q = q.strip()
-                if ':' in q or '.' in q:
+                if q in ip_hits and ip_hits[q] is not None:
+                    net = ip_hits[q].get(elt.get('entityID'), None)
+                    if net is not None:
+                        return net
+                elif q in ip_hits:
                     try:
                         nets = _ip_networks(elt)
                         for net in nets:
@@ -414,7 +1486,7 @@ The dict in the list contains three items:
                         pass
 
                 if q is not None and len(q) > 0:
-                    tokens = _strings(elt)
+                    tokens = entity_match_strings(elt)
                     for tstr in tokens:
                         if q in tstr.lower():
                             return tstr
@@ -430,22 +1502,36 @@ The dict in the list contains three items:
         if f:
             mexpr = "+".join(f)
 
+        related_vector = None
+        if related is not None:
+            related_vector = domain_vector(related)
+
+        candidates = None
+        ip_hits = dict()
+        if match_query:
+            candidates = self.match_candidates(query)
+            for q in query:
+                q = q.strip()
+                if is_ip_address(q):
+                    ip_hits[q] = self.ip_lookup(q)
+
         log.debug("match using '%s'" % mexpr)
         res = []
         for e in self.lookup(mexpr):
+            if candidates is not None and e.get('entityID') not in candidates:
+                continue
             d = None
             if match_query:
                 m = _match(query, e)
                 if m is not None:
-                    d = entity_simple_summary(e)
-                    ll = d['title'].lower()
+                    d = self.entity_record(e).summary()
                     d['matched'] = m
             else:
-                d = entity_simple_summary(e)
+                d = self.entity_record(e).summary()
 
             if d is not None:
                 if related is not None:
-                    d['ddist'] = avg_domain_distance(related, d['domains'])
+                    d['ddist'] = avg_domain_vector_distance(related_vector, self.domain_vector(e))
                 else:
                     d['ddist'] = 0
 
@@ -463,7 +1549,7 @@ class EmptyStore(SAMLStoreBase):
         return list()
 
     def __init__(self, *args, **kwargs):
-        pass
+        super().__init__()
 
     def update(self, *args, **kwargs):
         return 0
@@ -505,6 +1591,7 @@ class RedisWhooshStore(SAMLStoreBase):  # TODO: This needs a gc mechanism for ke
                             maxsize=config.cache_size)
 
     def __init__(self, *args, **kwargs):
+        super().__init__()
         self._dir = kwargs.pop('directory', '.whoosh')
         clear = bool(kwargs.pop('clear', config.store_clear))
         self._name = kwargs.pop('name', config.store_name)
@@ -539,6 +1626,22 @@ class RedisWhooshStore(SAMLStoreBase):  # TODO: This needs a gc mechanism for ke
             self.index = self.storage.create_index(self.schema)
             self._reindex()
 
+    @property
+    def generation(self):
+        """
+        The generation of a RedisWhooshStore is kept in redis: the contents of the store are shared by all processes
+        using the same redis so an update made by any of them must invalidate the results cached by all of them.
+        """
+        return int(self._redis.get(self._generation_key) or 0)
+
+    @property
+    def _generation_key(self):
+        return '{}_generation'.format(self._name)
+
+    def _touch(self):
+        self._redis.incr(self._generation_key)
+        self._result_cache.clear()
+
     def __getstate__(self):
         state = dict()
         for p in ('_dir', '_name', '_last_index_time', '_last_modified'):
@@ -546,6 +1649,7 @@ class RedisWhooshStore(SAMLStoreBase):  # TODO: This needs a gc mechanism for ke
         return state
 
     def __setstate__(self, state):
+        SAMLStoreBase.__init__(self)
         self.__dict__.update(state)
         self._setup()
 
@@ -593,6 +1697,7 @@ class RedisWhooshStore(SAMLStoreBase):  # TODO: This needs a gc mechanism for ke
                     writer.add_document(object_id=ref, **info)
 
                 writer.mergetype = CLEAR
+            self._touch()
         finally:
             try:
                 log.debug("releasing index lock")
@@ -630,6 +1735,23 @@ class RedisWhooshStore(SAMLStoreBase):  # TODO: This needs a gc mechanism for ke
         return res
 
     def update(self, t, tid=None, etag=None, lazy=True):
+        if self._update(t, tid, etag):
+            self._touch()
+
+        if not lazy:
+            self._reindex()
+
+    def update_batch(self, items):
+        modified = False
+        for t, tid, etag, lazy in items:
+            modified = self._update(t, tid, etag) or modified
+        if modified:
+            self._touch()
+
+        if not all(lazy for t, tid, etag, lazy in items):
+            self._reindex()
+
+    def _update(self, t, tid, etag):
         relt = root(t)
         assert (relt is not None)
 
@@ -642,6 +1764,7 @@ class RedisWhooshStore(SAMLStoreBase):  # TODO: This needs a gc mechanism for ke
                 self.parts[ref] = {'id': relt.get('entityID'), 'etag': etag, 'count': 1, 'items': [ref]}
                 self.objects[ref] = relt
                 self._last_modified = datetime.now()
+                return True
         elif relt.tag == "{%s}EntitiesDescriptor" % NS['md']:
             if tid is None:
                 tid = relt.get('Name')
@@ -658,11 +1781,10 @@ class RedisWhooshStore(SAMLStoreBase):  # TODO: This needs a gc mechanism for ke
                     self.objects[ref] = e
                 self.parts[tid] = {'id': tid, 'count': len(items), 'etag': etag, 'items': list(items)}
                 self._last_modified = datetime.now()
+                return True
+        return False
 
-        if not lazy:
-            self._reindex()
-
-    @ttl_cache(ttl=config.cache_ttl, maxsize=config.cache_size)
+    @cached
     def collections(self):
         return [b2u(ref) for ref in self.parts.keys()]
 
@@ -670,6 +1792,7 @@ class RedisWhooshStore(SAMLStoreBase):  # TODO: This needs a gc mechanism for ke
         for k in ('{}_{}'.format(self._name, 'parts'), '{}_{}'.format(self._name, 'objects')):
             self._redis.delete('{}_{}'.format(self._name, 'parts'))
             self._redis.delete('{}_{}'.format(self._name, 'objects'))
+        self._touch()
 
     def size(self, a=None, v=None):
         if a is None:
@@ -722,8 +1845,11 @@ class RedisWhooshStore(SAMLStoreBase):  # TODO: This needs a gc mechanism for ke
 
         return b2u(list(lst))
 
-    @ttl_cache(ttl=config.cache_ttl, maxsize=config.cache_size)
+    @cached
     def lookup(self, key):
+        return self._lookup(key)
+
+    def _lookup(self, key):
         if key == 'entities' or key is None:
             return self._entities()
 
@@ -735,7 +1861,7 @@ class RedisWhooshStore(SAMLStoreBase):  # TODO: This needs a gc mechanism for ke
             res = []
             part = self.parts.get(bkey)
             for item in part['items']:
-                res.extend(self.lookup(item))
+                res.extend(self._lookup(item))
             return res
 
         key = self._prep_key(key)
@@ -751,7 +1877,7 @@ class RedisWhooshStore(SAMLStoreBase):  # TODO: This needs a gc mechanism for ke
 
         return b2u(list(lst))
 
-    @ttl_cache(ttl=config.cache_ttl, maxsize=config.cache_size)
+    @cached
     def search(self, query=None, path=None, entity_filter=None, related=None):
         if entity_filter:
             query = "{!s} AND {!s}".format(query, entity_filter)
@@ -769,68 +1895,153 @@ class RedisWhooshStore(SAMLStoreBase):  # TODO: This needs a gc mechanism for ke
         for ref in lst:
             e = self.objects.get(ref, None)
             if e is not None:
-                res.append(discojson(e))
+                res.append(self.entity_record(e).discojson())
         return res
 
 
+class _MemoryState(object):
+    """
+    A single generation of the contents of a :py:class:`MemoryStore`. Once published a state is never modified:
+    writers work on a :py:meth:`copy` and publish it by replacing the reference held by the store. The tables are
+    :py:class:`PersistentDict` instances so a copy shares everything with the original and an update only copies
+    what it touches - the trie nodes on the path to each modified key and the modified entity sets.
+    """
+
+    def __init__(self):
+        self.md = PersistentDict()
+        self.entities = PersistentDict()
+        self.index = dict((hn, PersistentDict()) for hn in DINDEX)
+        self.index['attr'] = PersistentDict()
+        self.text = TextIndex()
+        self.ips = IPIndex()
+        self.domains = DomainIndex()
+        self.certs = CertificateIndex()
+        self.digests = PersistentDict()
+        self.records = PersistentDict()
+        self._owned = dict()  # the attribute indexes and entity sets copied since the state was published
+
+    def copy(self):
+        c = _MemoryState()
+        c.md = self.md.copy()
+        c.entities = self.entities.copy()
+        c.text = self.text.copy()
+        c.ips = self.ips.copy()
+        c.domains = self.domains.copy()
+        c.certs = self.certs.copy()
+        c.digests = self.digests.copy()
+        c.records = self.records.copy()
+        for hn in DINDEX:
+            c.index[hn] = self.index[hn].copy()
+        c.index['attr'] = self.index['attr'].copy()
+        return c
+
+    def attribute_index(self, a):
+        """
+        Return the value index of attribute a making sure it is private to this state (cf :py:meth:`entity_set`).
+        """
+        key = ('attr', a)
+        vidx = self._owned.get(key, None)
+        if vidx is None:
+            vidx = self.index['attr'].get(a, None)
+            vidx = vidx.copy() if vidx is not None else PersistentDict()
+            self.index['attr'][a] = self._owned[key] = vidx
+        return vidx
+
+    def entity_set(self, idx, v):
+        """
+        Return the EntitySet for v in idx making sure it is private to this state so it can be modified
+        without affecting readers of earlier generations.
+        """
+        key = (id(idx), v)
+        s = self._owned.get(key, None)
+        if s is None:
+            s = idx[v] = self._owned[key] = EntitySet(idx.get(v, None))
+        return s
+
+
 class MemoryStore(SAMLStoreBase):
+    """
+    An in-memory store. Updates build the next generation off to the side and publish it with a single reference
+    swap (RCU style) so readers never lock: a reader keeps working on the generation it started with while new
+    readers see the new one.
+    """
+
     def __init__(self, *args, **kwargs):
-        self.md = dict()
-        self.index = dict()
-        self.entities = dict()
+        super().__init__(*args, **kwargs)
+        self._update_lock = Lock()  # serializes writers - readers never take it
+        self._state = _MemoryState()
 
-        for hn in DINDEX:
-            self.index.setdefault(hn, {})
-        self.index.setdefault('attr', {})
+    @property
+    def md(self):
+        return self._state.md
+
+    @property
+    def index(self):
+        return self._state.index
+
+    @property
+    def entities(self):
+        return self._state.entities
+
+    def _publish(self, state):
+        state._owned = dict()
+        state.text.publish()
+        state.domains.publish()
+        self._state = state
+        self._touch()
 
     def __str__(self):
         return repr(self.index)
 
     def size(self, a=None, v=None):
+        s = self._state
         if a is None:
-            return len(self.entities)
+            return len(s.entities)
         elif a is not None and v is None:
-            return len(list(self.index.setdefault('attr', {}).setdefault(a, {}).keys()))
+            return len(list(s.index['attr'].get(a, {}).keys()))
         else:
-            return len(self.index.setdefault('attr', {}).setdefault(a, {}).get(v, []))
+            return len(s.index['attr'].get(a, {}).get(v, []))
 
     def attributes(self):
-        return list(self.index.setdefault('attr', {}).keys())
+        return list(self._state.index['attr'].keys())
 
     def attribute(self, a):
-        return list(self.index.setdefault('attr', {}).setdefault(a, {}).keys())
+        return list(self._state.index['attr'].get(a, {}).keys())
 
-    def _modify(self, entity, modifier):
+    def _modify(self, state, entity, modifier):
 
         def _m(idx, vv):
-            getattr(idx.setdefault(vv, EntitySet()), modifier)(entity)
+            if modifier == "discard" and vv not in idx:
+                return
+            getattr(state.entity_set(idx, vv), modifier)(entity)
 
         for hn in DINDEX:
-            _m(self.index[hn], hash_id(entity, hn, False))
+            _m(state.index[hn], hash_id(entity, hn, False))
 
-        attr_idx = self.index.setdefault('attr', {})
         for attr, values in list(entity_attribute_dict(entity).items()):
-            vidx = attr_idx.setdefault(attr, {})
+            vidx = state.attribute_index(attr)
             for v in values:
                 _m(vidx, v)
 
-        vidx = attr_idx.setdefault(ATTRS['role'], {})
+        vidx = state.attribute_index(ATTRS['role'])
         if is_idp(entity):
             _m(vidx, "idp")
         if is_sp(entity):
             _m(vidx, "sp")
 
-    def _index(self, entity):
-        return self._modify(entity, "add")
+    def _index(self, state, entity):
+        return self._modify(state, entity, "add")
 
-    def _unindex(self, entity):
-        return self._modify(entity, "discard")
+    def _unindex(self, state, entity):
+        return self._modify(state, entity, "discard")
 
-    def _get_index(self, a, v):
+    def _get_index(self, state, a, v):
         if a in DINDEX:
-            return self.index[a].get(v, [])
+            return state.index[a].get(v, [])
+        elif a == ATTRS['domain'] and DOMAIN_SUFFIX_RE.match(v):  # .example.org: example.org and everything below
+            return [state.entities[entity_id] for entity_id in state.domains.lookup(v) if entity_id in state.entities]
         else:
-            idx = self.index['attr'].setdefault(a, {})
+            idx = state.index['attr'].get(a, {})
             entities = idx.get(v, None)
             if entities is not None:
                 return entities
@@ -843,38 +2054,102 @@ class MemoryStore(SAMLStoreBase):
                 return entities
 
     def reset(self):
-        self.__init__()
+        with self._update_lock:
+            self._publish(_MemoryState())
 
     def collections(self):
-        return list(self.md.keys())
+        return list(self._state.md.keys())
+
+    def _update_entity(self, state, e):
+        self._unindex(state, e)
+        self._index(state, e)
+        old_e = state.entities.get(e.get('entityID'), None)
+        if old_e is not None:
+            state.ips.discard(old_e)
+            state.domains.discard(old_e)
+        state.text.replace(old_e, e)
+        state.ips.add(e)
+        state.domains.add(e)
+        state.certs.replace(old_e, e)
+        self._update_record(state, e)
+        state.entities[e.get('entityID')] = e  # TODO: merge?
+
+    def _update_record(self, state, e):
+        entity_id = e.get('entityID')
+        digest = entity_digest(e)
+        old_digest = state.digests.get(entity_id, None)
+        if old_digest is not None and old_digest != digest:
+            state.records.pop(old_digest, None)
+        if digest not in state.records:
+            state.records[digest] = EntityRecord(e, digest).warm()
+        state.digests[entity_id] = digest
 
     def update(self, t, tid=None, etag=None, lazy=True):
+        self.update_batch([(t, tid, etag, lazy)])
+
+    def update_batch(self, items):
+        with self._update_lock:
+            state = self._state.copy()
+            for t, tid, etag, lazy in items:
+                self._apply(state, t, tid)
+            self._publish(state)
+
+    def _apply(self, state, t, tid):
         relt = root(t)
         assert (relt is not None)
         if relt.tag == "{%s}EntityDescriptor" % NS['md']:
-            self._unindex(relt)
-            self._index(relt)
-            self.entities[relt.get('entityID')] = relt  # TODO: merge?
+            self._update_entity(state, relt)
             if tid is not None:
-                self.md[tid] = [relt.get('entityID')]
+                state.md[tid] = [relt.get('entityID')]
         elif relt.tag == "{%s}EntitiesDescriptor" % NS['md']:
             if tid is None:
                 tid = relt.get('Name')
             lst = []
             for e in iter_entities(t):
-                self.update(e)
+                self._update_entity(state, e)
                 lst.append(e.get('entityID'))
-            self.md[tid] = lst
-
+            state.md[tid] = lst
+
+    def text_candidates(self, q, prefix=False):
+        text = self._state.text
+        if prefix:
+            return text.prefix_candidates(q)
+        return text.candidates(q)
+
+    def ip_lookup(self, q):
+        return self._state.ips.lookup(q)
+
+    def certificates(self):
+        return self._state.certs
+
+    def entity_record(self, e):
+        state = self._state
+        entity_id = e.get('entityID')
+        if state.entities.get(entity_id, None) is e:
+            rec = state.records.get(state.digests.get(entity_id, None), None)
+            if rec is not None:
+                return rec
+        return super().entity_record(e)
+
+    def domain_vector(self, e):
+        v = self._state.domains.vector(e.get('entityID'))
+        if v is None:
+            v = super().domain_vector(e)
+        return v
+
+    @cached
     def lookup(self, key):
         return self._lookup(key)
 
-    def _lookup(self, key):
+    def _lookup(self, key, state=None):
+        if state is None:
+            state = self._state
+
         if key == 'entities' or key is None:
-            return list(self.entities.values())
+            return list(state.entities.values())
 
-        if key in self.entities:
-            return [self.entities[key]]
+        if key in state.entities:
+            return [state.entities[key]]
 
         if '+' in key:
             key = key.strip('+')
@@ -883,9 +2158,9 @@ class MemoryStore(SAMLStoreBase):
             for f in key.split("+"):
                 f = f.strip()
                 if hits is None:
-                    hits = set(self._lookup(f))
+                    hits = set(self._lookup(f, state))
                 else:
-                    other = self._lookup(f)
+                    other = self._lookup(f, state)
                     hits.intersection_update(other)
 
                 if not hits:
@@ -899,22 +2174,185 @@ class MemoryStore(SAMLStoreBase):
 
         m = re.match("^(.+)=(.+)$", key)
         if m:
-            return self._lookup("{%s}%s" % (m.group(1), str(m.group(2)).rstrip("/")))
+            return self._lookup("{%s}%s" % (m.group(1), str(m.group(2)).rstrip("/")), state)
 
         m = re.match("^{(.+)}(.+)$", key)
         if m:
             res = set()
             for v in str(m.group(2)).rstrip("/").split(';'):
                 # log.debug("... adding %s=%s" % (m.group(1),v))
-                res.update(self._get_index(m.group(1), v))
+                res.update(self._get_index(state, m.group(1), v))
             return list(res)
 
-        if key in self.md:
-            log.debug("entities list %s: %d" % (key, len(self.md[key])))
+        if key in state.md:
+            log.debug("entities list %s: %d" % (key, len(state.md[key])))
             lst = []
-            for entityID in self.md[key]:
-                lst.extend(self.lookup(entityID))
+            for entityID in state.md[key]:
+                lst.extend(self._lookup(entityID, state))
             log.debug("returning {} entities".format(len(lst)))
             return lst
 
         return []
+
+
+SNAPSHOT_POINTER = "current"
+
+
+def write_snapshot(store, dirname, keep=2):
+    """
+    Publish the contents of a store as an immutable snapshot in dirname. A snapshot consists of an XML file with
+    all entities and a JSON sidecar with the collections. Once both are written the pointer file is atomically
+    replaced so that attached :py:class:`SnapshotStore` instances switch to the new generation.
+
+    :param store: The store to snapshot
+    :param dirname: The snapshot directory
+    :param keep: The number of snapshots to retain - older snapshots are removed
+    :return: The name of the new snapshot or None if the snapshot could not be written
+    """
+    name = "{:d}-{:d}".format(int(time.time() * 1000), store.generation)
+    log.debug("writing snapshot {} into {}".format(name, dirname))
+    entities = [etree.tostring(e, encoding='utf-8') for e in store.lookup('entities')]
+    xml = b''.join([b'<md:EntitiesDescriptor xmlns:md="', NS['md'].encode('utf-8'), b'">'] +
+                   entities +
+                   [b'</md:EntitiesDescriptor>'])
+    info = dict(generation=store.generation,
+                collections=dict((c, [e.get('entityID') for e in store.lookup(c)]) for c in store.collections()))
+    if not safe_write(os.path.join(dirname, "{}.xml".format(name)), xml, mkdirs=True):
+        return None
+    if not safe_write(os.path.join(dirname, "{}.json".format(name)), json.dumps(info)):
+        return None
+    if not safe_write(os.path.join(dirname, SNAPSHOT_POINTER), name):
+        return None
+
+    snapshots = sorted(set(os.path.splitext(fn)[0] for fn in os.listdir(dirname) if fn.endswith(('.xml', '.json'))))
+    for old in snapshots[:-keep]:
+        for ext in ('.xml', '.json'):
+            try:
+                os.unlink(os.path.join(dirname, old + ext))
+            except OSError as ex:
+                log.warn(ex)
+    return name
+
+
+class SnapshotStore(SAMLStoreBase):
+    """
+    A read-only store attached to a snapshot directory written by :py:func:`write_snapshot`. The pointer file is
+    checked at most every config.snapshot_check_interval seconds and when it changes the new snapshot is loaded into
+    a fresh :py:class:`MemoryStore` which is then swapped in. Readers keep using the previous generation until the
+    swap is complete.
+    """
+
+    def __init__(self, dirname=None, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        if dirname is None:
+            dirname = config.snapshot_dir
+        self._dirname = dirname
+        self._snapshot = None
+        self._store = MemoryStore()
+        self._checked = 0
+        self._attach_lock = Lock()
+
+    @property
+    def snapshot(self):
+        return self._snapshot
+
+    @property
+    def generation(self):
+        self._attach()
+        return self._generation
+
+    def _attach(self):
+        now = time.time()
+        if now - self._checked < config.snapshot_check_interval:
+            return
+        if not self._attach_lock.acquire(False):  # someone else is already loading - keep using what we have
+            return
+        try:
+            self._checked = now
+            try:
+                with open(os.path.join(self._dirname, SNAPSHOT_POINTER)) as fd:
+                    name = fd.read().strip()
+            except IOError:
+                return
+            if not name or name == self._snapshot:
+                return
+            self._load(name)
+        finally:
+            self._attach_lock.release()
+
+    def _load(self, name):
+        log.debug("attaching to snapshot {} in {}".format(name, self._dirname))
+        try:
+            t = parse_xml(os.path.join(self._dirname, "{}.xml".format(name)))
+            with open(os.path.join(self._dirname, "{}.json".format(name))) as fd:
+                info = json.load(fd)
+        except (IOError, ValueError, etree.XMLSyntaxError) as ex:
+            log.warn("unable to attach to snapshot {}: {}".format(name, ex))
+            return
+        # the entities and the collections of the snapshot are published together, as one generation
+        new_store = MemoryStore()
+        with new_store._update_lock:
+            state = new_store._state.copy()
+            new_store._apply(state, t, None)
+            state.md = PersistentDict(info.get('collections', {}))
+            new_store._publish(state)
+        self._store = new_store
+        self._snapshot = name
+        self._touch()
+
+    def update(self, t, tid=None, etag=None, lazy=True):
+        log.warn("ignoring update of read-only snapshot store (tid={})".format(tid))
+
+    def update_batch(self, items):
+        log.warn("ignoring {:d} updates of read-only snapshot store".format(len(items)))
+
+    def reset(self):
+        log.warn("ignoring reset of read-only snapshot store")
+
+    def size(self, a=None, v=None):
+        self._attach()
+        return self._store.size(a, v)
+
+    def attributes(self):
+        self._attach()
+        return self._store.attributes()
+
+    def attribute(self, a):
+        self._attach()
+        return self._store.attribute(a)
+
+    def collections(self):
+        self._attach()
+        return self._store.collections()
+
+    def text_candidates(self, q, prefix=False):
+        self._attach()
+        return self._store.text_candidates(q, prefix=prefix)
+
+    def ip_lookup(self, q):
+        self._attach()
+        return self._store.ip_lookup(q)
+
+    def certificates(self):
+        self._attach()
+        return self._store.certificates()
+
+    def domain_vector(self, e):
+        self._attach()
+        return self._store.domain_vector(e)
+
+    def entity_record(self, e):
+        self._attach()
+        return self._store.entity_record(e)
+
+    def serialize(self, t, origin=None):
+        self._attach()
+        return self._store.serialize(t, origin=origin)
+
+    def serialize_chunks(self, t, origin=None):
+        self._attach()
+        return self._store.serialize_chunks(t, origin=origin)
+
+    @cached
+    def lookup(self, key):
+        return self._store._lookup(key)
@@ -91,6 +91,21 @@ if __name__ == '__main__':
     return out, err, rv
 
 
+def reset_caches():
+    """
+    Drop the process-wide caches - the entity memo, validation provenance, signers and the record of written
+    files - so that a test doesn't see what an earlier test left behind.
+    """
+    from pyff import pipes, samlmd, signing, utils
+
+    pipes._entity_memo = None
+    samlmd._validation_provenance = None
+    with signing._lock:
+        signing._signers.clear()
+    with utils._written_lock:
+        utils._written.clear()
+
+
 def _pstart(args, outf=None, ignore_exit=False):
     env = {}
     logging.debug(" ".join(args))
@@ -139,6 +154,25 @@ class SignerTestCase(TestCase):
             '-key', cls.private_keyspec,
             '-out', cls.public_keyspec])
 
+    def tearDown(self):
+        reset_caches()
+
+    def load_md(self, name=None, tid=None):
+        """
+        Return a repository with a store of its own containing the metadata file name in datadir/metadata
+
+        :param name: the name of the metadata file or None for an empty store
+        :param tid: the tid of the metadata in the store
+        """
+        from pyff.repo import MDRepository
+        from pyff.store import make_store_instance
+        from pyff.utils import parse_xml
+
+        md = MDRepository(store=make_store_instance())
+        if name is not None:
+            md.store.update(parse_xml(os.path.join(self.datadir, 'metadata', name)), tid=tid)
+        return md
+
     @classmethod
     def tearDownClass(cls):
         if os.path.exists(cls.private_keyspec):
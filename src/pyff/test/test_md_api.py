@@ -4,6 +4,7 @@ from pyff.test.test_pipeline import PipeLineTest
 from wsgi_intercept.interceptor import RequestsInterceptor, UrllibInterceptor
 from pyff.api import mkapp
 from pyff.test import SignerTestCase
+from pyff.utils import parse_xml
 from mako.lookup import TemplateLookup
 import tempfile
 import os
@@ -50,6 +51,31 @@ class PyFFAPITest(PipeLineTest):
             assert('size' in data['store'])
             assert(int(data['store']['size']) >= 0)
 
+    def test_certs(self):
+        store = self._app.registry.md.store
+        store.update(parse_xml(os.path.join(self.datadir, 'metadata', 'wayf-edugain-metadata.xml')))
+        with RequestsInterceptor(self.app, host='127.0.0.1', port=80) as url:
+            r = requests.get("{}/api/certs".format(url))
+            assert (r.status_code == 200)
+            assert ("application/json" in r.headers['content-type'])
+            data = r.json()
+            assert (len(data) == len(store.certificates()))
+            for c in data:
+                assert ('fingerprint' in c)
+                assert ('not_after' in c)
+                assert (len(c['entities']) > 0)
+
+            r = requests.get("{}/api/certs?expiring_within=P36500D".format(url))
+            assert (r.status_code == 200)
+            assert (len(r.json()) == len(data))
+
+            r = requests.get("{}/api/certs?expiring_within=-3153600000".format(url))
+            assert (r.status_code == 200)
+            assert (len(r.json()) == 0)
+
+            r = requests.get("{}/api/certs?expiring_within=soon".format(url))
+            assert (r.status_code == 400)
+
     def test_parse_robots(self):
         try:
             import six.moves.urllib_robotparser as robotparser
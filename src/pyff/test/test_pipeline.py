@@ -1,13 +1,21 @@
 import shutil
 import sys
 import tempfile
+import threading
+import time
 import os
 import yaml
+from copy import deepcopy
+from lxml import etree
 from mako.lookup import TemplateLookup
-from mock import patch
+from mock import patch, Mock
 from pyff.repo import MDRepository
 from pyff.exceptions import MetadataException
 from pyff.pipes import plumbing, Plumbing, PipeException
+from pyff import pipes
+from pyff.constants import NS, config
+from pyff import profiling
+from pyff import samlmd
 from pyff.test import ExitException
 from pyff.test import SignerTestCase
 from pyff.utils import hash_id, parse_xml, resource_filename, root
@@ -15,6 +23,8 @@ from pyff.parse import ParserException
 from pyff.resource import ResourceException
 import six
 from pyff.store import make_store_instance
+from pyff.samlmd import entity_attribute_dict, iter_entities, EntityStream, filter_or_validate, validate_entities, \
+    entity_digest
 
 # don't remove this - it only appears unused to static analysis
 from pyff import builtins
@@ -702,3 +712,651 @@ class SigningTest(PipeLineTest):
             except ValueError:
                 pass
             assert("Expected exception from bad namespace in")
+
+
+class CompiledPlumbingTest(PipeLineTest):
+
+    def _md(self):
+        return self.load_md('test01.xml', tid='test01')
+
+    def test_steps_shared(self):
+        p = yaml.safe_load(six.StringIO("""
+- when request:
+  - select
+  - pipe:
+    - when accept application/json:
+      - discojson
+      - break
+    - when accept application/xml:
+      - first
+      - emit application/xml
+      - break
+"""))
+        pl = Plumbing(p, pid="test").compile()
+        md = self._md()
+        res = [pl.process(md, state={'request': True, 'accept': {'application/json': True}, 'headers': {}})
+               for _ in range(2)]
+        assert (res[0] == res[1])
+        assert ('https://idp.example.com/saml2/idp/metadata.php' in res[0])
+        step = pl.step(0)
+        assert (step is pl.step(0))
+        nested = step.nested("test.when")
+        assert (nested.step(1) is step.nested("other").step(1))
+        assert (nested.step(1).name == 'pipe')
+        assert (pl.alias("other").step(0) is step)
+
+    def test_compile_unknown_pipe(self):
+        pl = Plumbing(["select", "no-such-pipe"], pid="test").compile()
+        assert (pl.step(0).name == 'select')
+        try:
+            pl.process(self._md(), state={'batch': True, 'stats': {}})
+            assert False
+        except PipeException as ex:
+            assert ('no-such-pipe' in "{}".format(ex))
+
+    def test_opts_and_args(self):
+        pl = Plumbing([{"select as /foo": "https://idp.example.com/saml2/idp/metadata.php"}], pid="test")
+        step = pl.step(0)
+        assert (step.opts == ('as', '/foo'))
+        assert (step.args == ['https://idp.example.com/saml2/idp/metadata.php'])
+        md = self._md()
+        pl.process(md, state={'batch': True, 'stats': {}})
+        assert (len(md.store.lookup('/foo')) == 1)
+
+
+class CopyOnWriteForkTest(PipeLineTest):
+
+    def setUp(self):
+        super().setUp()
+        self.md = self.load_md('test01.xml', tid='test01')
+        self.copies = []
+        real_deepcopy = pipes.deepcopy
+
+        def _deepcopy(x, *args):
+            self.copies.append(x)
+            return real_deepcopy(x, *args)
+
+        self._patch = patch('pyff.pipes.deepcopy', _deepcopy)
+        self._patch.start()
+
+    def tearDown(self):
+        self._patch.stop()
+        super().tearDown()
+
+    def _run(self, p):
+        req = Plumbing.Request(Plumbing(p, pid="test"), self.md, state={'batch': True, 'stats': {}, 'headers': {}})
+        req.process(req.plumbing)
+        return req
+
+    def test_read_only_branch(self):
+        self._run(["select", {"fork": ["stats", "discojson"]}, "discojson"])
+        assert (self.copies == [])
+
+    def test_select_branch(self):
+        self._run(["select", {"fork": ["select", {"setattr": {"foo": "bar"}}]}])
+        assert (self.copies == [])
+
+    def test_modifying_branch(self):
+        req = self._run(["select", {"fork": [{"setattr": {"foo": "bar"}}]}, "emit application/xml"])
+        assert (len(self.copies) == 1)
+        assert (b'foo' not in req.t)
+
+    def test_first_copies_entity_only(self):
+        self._run(["select", {"fork": ["first", {"setattr": {"foo": "bar"}}]}])
+        assert (len(self.copies) == 1)
+        assert (self.copies[0].tag == "{%s}EntityDescriptor" % NS['md'])
+
+    def test_fork_merge(self):
+        req = self._run(["select", {"fork merge": [{"setattr": {"foo": "bar"}}]}, "emit application/xml"])
+        assert (b'foo' in req.t)
+
+    def test_nested_pipeline_branch(self):
+        self._run(["select", {"fork": [{"pipe": ["stats", {"pipe": ["discojson"]}]}]}])
+        assert (self.copies == [])
+        req = self._run(["select", {"fork": [{"pipe": [{"pipe": [{"setattr": {"foo": "bar"}}]}]}]},
+                         "emit application/xml"])
+        assert (len(self.copies) == 1)
+        assert (b'foo' not in req.t)
+
+    def test_nested_pipeline_origin(self):
+        req = self._run(["select", {"when batch": ["discojson"]}])
+        assert (req.origin is not None)
+        req = self._run(["select", {"when batch": [{"setattr": {"foo": "bar"}}]}])
+        assert (req.origin is None)
+
+
+class ParallelForkTest(PipeLineTest):
+
+    def setUp(self):
+        super().setUp()
+        self.md = self.load_md('test01.xml', tid='test01')
+        self.output = tempfile.mkdtemp()
+        self.barrier = threading.Barrier(2, timeout=10)
+
+        def _barrier(req, *opts):
+            self.barrier.wait()
+            return req.t
+
+        def _fail(req, *opts):
+            raise ValueError("branch {} failed".format(opts[0]))
+
+        pipes.pipe(name='test_barrier', read_only=True)(_barrier)
+        pipes.pipe(name='test_fail', read_only=True)(_fail)
+
+    def tearDown(self):
+        del pipes.registry['test_barrier']
+        del pipes.registry['test_fail']
+        shutil.rmtree(self.output)
+        super().tearDown()
+
+    def _run(self, p):
+        req = Plumbing.Request(Plumbing(p, pid="test"), self.md, state={'batch': True, 'stats': {}, 'headers': {}})
+        req.process(req.plumbing)
+        return req
+
+    def test_branches_run_concurrently(self):
+        out1 = os.path.join(self.output, "one.xml")
+        out2 = os.path.join(self.output, "two.xml")
+        req = self._run(["select",
+                         {"fork parallel": ["test_barrier", {"publish": out1}]},
+                         {"fork parallel": ["test_barrier", {"publish": out2}]},
+                         "stats"])
+        assert (os.path.exists(out1))
+        assert (os.path.exists(out2))
+        assert (req.pending == [])
+
+    def test_join_at_end_of_pipeline(self):
+        out = os.path.join(self.output, "last.xml")
+        self._run(["select", {"fork parallel": [{"publish": out}]}])
+        assert (os.path.exists(out))
+
+    def test_merge_in_order(self):
+        req = self._run(["select",
+                         {"fork parallel merge": ["test_barrier", {"setattr": {"foo": "first"}}]},
+                         {"fork parallel merge": ["test_barrier", {"setattr": {"foo": "second"}}]},
+                         "emit application/xml"])
+        assert (b'second' in req.t)
+        assert (b'first' not in req.t)
+
+    def test_exceptions_aggregated(self):
+        out = os.path.join(self.output, "ok.xml")
+        with self.assertRaises(PipeException) as ctx:
+            self._run(["select",
+                       {"fork parallel": ["test_fail 1"]},
+                       {"fork parallel": [{"publish": out}]},
+                       {"fork parallel": ["test_fail 2"]},
+                       "stats"])
+        assert ("2 of 3" in str(ctx.exception))
+        assert ("branch 1 failed" in str(ctx.exception))
+        assert ("branch 2 failed" in str(ctx.exception))
+        assert (os.path.exists(out))
+
+    def test_single_exception_raised(self):
+        with self.assertRaises(ValueError):
+            self._run(["select", {"fork parallel": ["test_fail 1"]}, "stats"])
+
+
+class ResponseCacheTest(PipeLineTest):
+
+    def setUp(self):
+        super().setUp()
+        self.md = self.load_md('test01.xml', tid='test01')
+        self.pl = Plumbing(yaml.safe_load("""
+- when request:
+  - select
+  - pipe:
+    - when accept application/xml:
+      - finalize:
+          cacheDuration: PT1H
+          validUntil: P10D
+      - emit application/xml
+      - break
+    - when accept application/json:
+      - discojson
+      - emit application/json
+      - break
+"""), pid="test")
+
+    def _state(self, accept, select=None):
+        return {'request': True, 'headers': {}, 'accept': {accept: True}, 'select': select, 'stats': {}}
+
+    def test_cached(self):
+        state = self._state('application/xml')
+        r1 = self.pl.process(self.md, state=state, cache=True)
+        state = self._state('application/xml')
+        r2 = self.pl.process(self.md, state=state, cache=True)
+        assert (r1 is r2)
+        assert (state['headers']['Content-Type'] == 'application/xml')
+        assert (0 < state['cache'] <= 3600)
+        info = self.pl.responses.info()
+        assert (info['hits'] == 1)
+        assert (info['misses'] == 1)
+
+    def test_key_includes_state(self):
+        r1 = self.pl.process(self.md, state=self._state('application/xml'), cache=True)
+        r2 = self.pl.process(self.md, state=self._state('application/xml', select='https://idp.example.com/saml2/idp/metadata.php'),
+                             cache=True)
+        assert (r1 is not r2)
+        assert (self.pl.responses.info()['hits'] == 0)
+
+    def test_store_update_invalidates(self):
+        r1 = self.pl.process(self.md, state=self._state('application/xml'), cache=True)
+        self.md.store.update(parse_xml(os.path.join(self.datadir, 'metadata', 'test01.xml')), tid='test01-again')
+        r2 = self.pl.process(self.md, state=self._state('application/xml'), cache=True)
+        assert (r1 is not r2)
+        assert (self.pl.responses.info()['hits'] == 0)
+
+    def test_not_cached_without_cache_time(self):
+        self.pl.process(self.md, state=self._state('application/json'), cache=True)
+        self.pl.process(self.md, state=self._state('application/json'), cache=True)
+        info = self.pl.responses.info()
+        assert (info['hits'] == 0)
+        assert (info['size'] == 0)
+
+    def test_expired(self):
+        state = self._state('application/xml')
+        r1 = self.pl.process(self.md, state=state, cache=True)
+        with patch('pyff.pipes.time.time', return_value=time.time() + 3601):
+            r2 = self.pl.process(self.md, state=self._state('application/xml'), cache=True)
+        assert (r1 is not r2)
+
+    def test_not_cached_by_default(self):
+        self.pl.process(self.md, state=self._state('application/xml'))
+        assert (self.pl.responses.info()['size'] == 0)
+
+    def test_stream_cached(self):
+        pl = Plumbing(yaml.safe_load("""
+- when request:
+  - select
+  - finalize:
+      cacheDuration: PT1H
+      validUntil: P10D
+  - emit application/xml stream
+  - break
+"""), pid="test")
+        r1 = pl.process(self.md, state=self._state('application/xml'), cache=True)
+        r2 = pl.process(self.md, state=self._state('application/xml'), cache=True)
+        assert (pl.responses.info()['hits'] == 1)
+        assert (b"".join(r1) == b"".join(r2))
+
+    def test_hit_is_a_copy(self):
+        pl = Plumbing(yaml.safe_load("""
+- when request:
+  - select
+  - finalize:
+      cacheDuration: PT1H
+      validUntil: P10D
+"""), pid="test")
+        t1 = pl.process(self.md, state=self._state('application/xml'), cache=True)
+        t2 = pl.process(self.md, state=self._state('application/xml'), cache=True)
+        assert (pl.responses.info()['hits'] == 1)
+        assert (t1 is not t2)
+        assert (etree.tostring(t1) == etree.tostring(t2))
+        root(t2).set('Name', 'modified')
+        t3 = pl.process(self.md, state=self._state('application/xml'), cache=True)
+        assert (root(t3).get('Name') != 'modified')
+
+
+class ProfileTest(PipeLineTest):
+
+    def setUp(self):
+        super().setUp()
+        config.profile = True
+        profiling.histogram.reset()
+        self.md = self.load_md('wayf-edugain-metadata.xml', tid='wayf')
+
+    def tearDown(self):
+        del config.profile
+        profiling.histogram.reset()
+        super().tearDown()
+
+    def _run(self, p):
+        state = {'batch': True, 'stats': {}}
+        Plumbing(p, pid="test").process(self.md, state=state)
+        return state['stats']['pipes']
+
+    def test_steps(self):
+        pipes = self._run(["select", "stats", {"fork": ["first", "discojson"]}])
+        assert ([n['pipe'] for n in pipes] == ['select', 'stats', 'fork'])
+        select = pipes[0]
+        assert (select['plumbing'] == "test")
+        assert (select['entities_in'] == 0)
+        assert (select['entities_out'] == 77)
+        assert (select['wall'] >= 0)
+        assert (select['steps'] == [])
+        assert (select['cpu'] >= 0)
+        fork = pipes[2]
+        assert ([n['pipe'] for n in fork['steps']] == ['first', 'discojson'])
+        assert (fork['steps'][0]['entities_in'] == 77)
+        assert (fork['steps'][0]['entities_out'] == 77)
+        assert (fork['steps'][0]['plumbing'] == "test.fork")
+
+    def test_nested_when(self):
+        pipes = self._run(["select", {"when batch": ["first"]}])
+        assert (pipes[1]['pipe'] == 'when')
+        assert ([n['pipe'] for n in pipes[1]['steps']] == ['first'])
+
+    def test_histogram(self):
+        self._run(["select", {"fork": ["select"]}])
+        info = profiling.histogram.info()
+        assert (info['select']['count'] == 2)
+        assert (info['fork']['count'] == 1)
+        assert (info['select']['buckets']['+Inf'] == 2)
+        assert (info['select']['max'] <= info['select']['wall'])
+
+    def test_failed_step_recorded(self):
+        with self.assertRaises(PipeException):
+            self._run(["select", {"fork": ["select", {"xslt": {}}]}])
+        assert (profiling.histogram.info()['xslt']['count'] == 1)
+
+    def test_report(self):
+        pipes = self._run(["select", {"fork": ["first"]}])
+        r = profiling.report(pipes)
+        lines = r.splitlines()
+        assert (len(lines) == 3)
+        assert (lines[0].startswith("select"))
+        assert (lines[2].startswith("  first"))
+
+    def test_disabled(self):
+        config.profile = False
+        state = {'batch': True, 'stats': {}}
+        Plumbing(["select"], pid="test").process(self.md, state=state)
+        assert (state['stats'] == {})
+
+
+class MapTest(PipeLineTest):
+
+    def setUp(self):
+        super().setUp()
+        self.md = self.load_md('wayf-edugain-metadata.xml', tid='wayf')
+        self.output = tempfile.mkdtemp()
+        pipes._entity_memo = pipes.EntityMemo(maxsize=1000)
+
+    def tearDown(self):
+        shutil.rmtree(self.output)
+        super().tearDown()
+
+    def _run(self, p):
+        req = Plumbing.Request(Plumbing(p, pid="test"), self.md, state={'batch': True, 'stats': {}})
+        req.process(req.plumbing)
+        return req
+
+    def _attrs(self, t, name):
+        entities = root(t).iterchildren("{%s}EntityDescriptor" % NS['md'])
+        return [entity_attribute_dict(e).get(name, None) for e in entities]
+
+    def test_map_threads(self):
+        req = self._run(["select", {"map": [{"setattr": {"foo": "bar"}}]}])
+        assert (self._attrs(req.t, 'foo') == [['bar']] * 77)
+
+    def test_map_processes(self):
+        req = self._run(["select", {"map processes": [{"setattr": {"foo": "bar"}}]}])
+        assert (self._attrs(req.t, 'foo') == [['bar']] * 77)
+
+    def test_map_twice(self):
+        # the second run gets the memoized outputs of setattr (cf EntityMemo) - they must end up in the document
+        for p in (["select", {"map": [{"setattr": {"foo": "bar"}}]}],
+                  ["select", {"map processes": [{"setattr": {"foo": "bar"}}]}]):
+            for i in range(2):
+                self.md = self.load_md('wayf-edugain-metadata.xml', tid='wayf')
+                req = self._run(p)
+                assert (self._attrs(req.t, 'foo') == [['bar']] * 77)
+
+    def test_map_processes_unchanged(self):
+        req = self._run(["select", {"map processes": ["log_entity"]}])
+        assert (self._attrs(req.t, 'foo') == [None] * 77)
+
+    def test_map_processes_then(self):
+        req = self._run([{"when mark": [{"setattr": {"marked": "yes"}}]},
+                         {"when batch": ["select", {"map processes": ["then mark"]}]}])
+        assert (self._attrs(req.t, 'marked') == [['yes']] * 77)
+
+    def test_map_processes_publish(self):
+        self._run(["select", {"map processes": [{"fork": [{"publish": {"output": self.output, "hash_link": False,
+                                                                       "urlencode_filenames": True,
+                                                                       "update_store": False}}]}]}])
+        assert (len(os.listdir(self.output)) == 77)
+
+
+class PublishUnchangedTest(PipeLineTest):
+
+    def setUp(self):
+        super().setUp()
+        self.md = self.load_md('test01.xml', tid='test01')
+        self.output = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.output)
+        super().tearDown()
+
+    def _publish(self):
+        req = Plumbing.Request(Plumbing(["select", "first", {"publish": {"output": self.output, "hash_link": True,
+                                                                          "urlencode_filenames": True,
+                                                                          "update_store": False,
+                                                                          "compress": "gz"}}],
+                                        pid="test"),
+                               self.md, state={'batch': True, 'stats': {}})
+        req.process(req.plumbing)
+        return req
+
+    def test_publish_twice(self):
+        self._publish()
+        names = sorted(os.listdir(self.output))
+        assert (len(names) == 4)
+        for name in names:
+            os.utime(os.path.join(self.output, name), (1000000000, 1000000000), follow_symlinks=False)
+        self._publish()
+        assert (sorted(os.listdir(self.output)) == names)
+        for name in names:
+            assert (os.lstat(os.path.join(self.output, name)).st_mtime == 1000000000)
+        links = [n for n in names if os.path.islink(os.path.join(self.output, n))]
+        assert (len(links) == 2)
+        assert (any(n.endswith(".xml.gz") for n in links))
+
+
+class EntityMemoTest(PipeLineTest):
+
+    def setUp(self):
+        super().setUp()
+        self.wayf = parse_xml(os.path.join(self.datadir, 'metadata', 'wayf-edugain-metadata.xml'))
+        self.md = self.load_md()
+        pipes._entity_memo = pipes.EntityMemo(maxsize=1000)
+
+    def _run(self, pipeline, reset=True):
+        # setattr writes the entities it modifies to the store - start from the same store each time
+        if reset:
+            self.md.store.update(deepcopy(self.wayf), tid='wayf')
+        req = Plumbing.Request(Plumbing(pipeline, pid="test"), self.md, state={'batch': True, 'stats': {}})
+        req.process(req.plumbing)
+        return req
+
+    def _c14n(self, t):
+        return [etree.tostring(e, method='c14n', exclusive=True) for e in iter_entities(t)]
+
+    def _pipeline(self):
+        return ["select",
+                {"setattr": {"foo": "bar"}},
+                {"reginfo": {"authority": "http://example.com"}},
+                "drop_xsi_type",
+                {"xslt per_entity": {"stylesheet": "tidy.xsl"}}]
+
+    def test_identical(self):
+        pipes._entity_memo = pipes.EntityMemo(maxsize=0)
+        full = self._c14n(self._run(self._pipeline()).t)
+        assert (len(full) == 77)
+        pipes._entity_memo = pipes.EntityMemo(maxsize=1000)
+        req = self._run(self._pipeline())
+        assert (self._c14n(req.t) == full)
+        assert (req.state['stats']['memo']['setattr'] == dict(hits=0, misses=77))
+        req = self._run(self._pipeline())
+        assert (self._c14n(req.t) == full)
+        for name in ('setattr', 'reginfo', 'drop_xsi_type', 'xslt'):
+            assert (req.state['stats']['memo'][name] == dict(hits=77, misses=0))
+        assert (pipes.entity_memo().info()['hits'] == 4 * 77)
+
+    def test_changed_entity(self):
+        self._run(self._pipeline())
+        self.md.store.update(deepcopy(self.wayf), tid='wayf')
+        e = deepcopy(self.md.store.lookup('entities')[0])
+        entity_id = e.get('entityID')
+        e.set('validUntil', '2030-01-01T00:00:00Z')
+        self.md.store.update(e)
+        req = self._run(self._pipeline(), reset=False)
+        assert (req.state['stats']['memo']['setattr'] == dict(hits=76, misses=1))
+        assert (req.state['stats']['memo']['xslt'] == dict(hits=76, misses=1))
+        for ne in iter_entities(req.t):
+            assert (ne.get('validUntil') is None)  # removed by tidy.xsl
+            assert (entity_attribute_dict(ne)['foo'] == ['bar'])
+        assert (entity_id in [ne.get('entityID') for ne in iter_entities(req.t)])
+
+    def test_updates_store(self):
+        self._run(["select", {"setattr": {"foo": "bar"}}])
+        req = self._run(["select", {"setattr": {"foo": "bar"}}])
+        assert (req.state['stats']['memo']['setattr']['hits'] == 77)
+        for e in self.md.store.lookup('entities'):
+            assert (entity_attribute_dict(e)['foo'] == ['bar'])
+
+    def test_single_entity(self):
+        entity_id = 'https://birk.wayf.dk/birk.php/wayf.supportcenter.dk/its/saml2/idp/metadata.php?unit=its'
+        pipeline = [{"select": [entity_id]}, "first", {"setattr": {"foo": "bar"}}]
+        t1 = self._run(pipeline).t
+        req = self._run(pipeline)
+        assert (req.state['stats']['memo']['setattr'] == dict(hits=1, misses=0))
+        assert (root(req.t).get('entityID') == entity_id)
+        assert (self._c14n(req.t) == self._c14n(t1))
+
+    def test_single_entity_in_place(self):
+        # whoever holds on to the working document (eg map) sees the memoized output
+        entity_id = 'https://birk.wayf.dk/birk.php/wayf.supportcenter.dk/its/saml2/idp/metadata.php?unit=its'
+        self._run([{"select": [entity_id]}, "first", {"setattr": {"foo": "bar"}}])
+        self.md.store.update(deepcopy(self.wayf), tid='wayf')
+        e = deepcopy(self.md.store.lookup(entity_id)[0])
+        req = Plumbing.Request(Plumbing([{"setattr": {"foo": "bar"}}], pid="test"), self.md, t=e,
+                               state={'batch': True, 'stats': {}})
+        req.process(req.plumbing)
+        assert (req.state['stats']['memo']['setattr'] == dict(hits=1, misses=0))
+        assert (root(req.t) is e)
+        assert (entity_attribute_dict(e)['foo'] == ['bar'])
+
+
+class StreamingTest(PipeLineTest):
+
+    def setUp(self):
+        super().setUp()
+        self.md = self.load_md('wayf-edugain-metadata.xml', tid='wayf')
+
+    def tearDown(self):
+        config.streaming = False
+        super().tearDown()
+
+    def _run(self, pipeline, streaming):
+        config.streaming = streaming
+        req = Plumbing.Request(Plumbing(pipeline, pid="test"), self.md, state={'batch': True, 'stats': {}})
+        req.process(req.plumbing)
+        return req
+
+    def _compare(self, pipeline):
+        t1 = self._run(pipeline, False).t
+        t2 = self._run(pipeline, True).t
+        assert (etree.tostring(root(t2), method='c14n', exclusive=True) ==
+                etree.tostring(root(t1), method='c14n', exclusive=True))
+        return t2
+
+    def test_select(self):
+        t = self._compare(["select", {"xslt": {"stylesheet": "tidy.xsl"}}])
+        assert (len(list(iter_entities(t))) == 77)
+
+    def test_filter_sort(self):
+        entity_ids = [e.get('entityID') for e in self.md.store.lookup('entities')][:5]
+        t = self._compare(["select", {"filter": list(reversed(entity_ids))}, "sort"])
+        assert ([e.get('entityID') for e in iter_entities(t)] == sorted(entity_ids))
+        self._compare(["select", {"filter": entity_ids}, {"xslt": {"stylesheet": "tidy.xsl"}}])
+        self._compare(["select", {"filter": ["!//md:EntityDescriptor[md:IDPSSODescriptor]"]}, "first"])
+
+    def test_first(self):
+        entity_id = 'https://birk.wayf.dk/birk.php/wayf.supportcenter.dk/its/saml2/idp/metadata.php?unit=its'
+        t = self._compare([{"select": [entity_id]}, "first", {"xslt": {"stylesheet": "tidy.xsl"}}])
+        assert (root(t).get('entityID') == entity_id)
+        self._compare(["select", "first"])
+        self._compare([{"select": ['https://nonexistent.example.com']}, "first"])
+
+    def test_stream(self):
+        req = Plumbing.Request(Plumbing(["select", {"filter": ["a", "b"]}], pid="test"), self.md, state={})
+        config.streaming = True
+        entity_ids = [e.get('entityID') for e in self.md.store.lookup('entities')]
+        with patch.object(builtins, 'entitiesdescriptor') as ed:
+            req.t = builtins.select(req)
+            req.args = entity_ids[:2]
+            t = builtins._filter(req)
+            assert (not ed.called)
+        assert (isinstance(t, EntityStream))
+        assert (len(t) == 2)
+        assert (set(req.origin[e.get('entityID')] for e in t) == set(t))
+        t = t.document()
+        assert ([e.get('entityID') for e in iter_entities(t)] == entity_ids[:2])
+        for e in iter_entities(t):
+            assert (req.origin[e.get('entityID')] is not e)
+
+
+class ValidationProvenanceTest(PipeLineTest):
+
+    def setUp(self):
+        super().setUp()
+        samlmd._validation_provenance = samlmd.ValidationProvenance(maxsize=1000)
+        self.md = self.load_md()
+        t = parse_xml(os.path.join(self.datadir, 'metadata', 'wayf-edugain-metadata.xml'))
+        self.md.store.update(filter_or_validate(root(t), filter_invalid=True), tid='wayf')
+        self.xsd = samlmd.schema()
+
+    def tearDown(self):
+        super().tearDown()
+
+    def _run(self, pipeline):
+        req = Plumbing.Request(Plumbing(pipeline, pid="test"), self.md, state={'batch': True, 'stats': {}})
+        req.process(req.plumbing)
+        return req
+
+    def test_select(self):
+        with patch.object(samlmd, 'schema', return_value=Mock(wraps=self.xsd)) as xsd:
+            req = self._run(["select"])
+            assert (not xsd.return_value.validate.called)
+        assert (len(list(iter_entities(req.t))) == 77)
+        assert (samlmd.validation_provenance().info()['hits'] == 77)
+
+    def test_modified_entity(self):
+        e = deepcopy(self.md.store.lookup('entities')[0])
+        e.set('validUntil', '2030-01-01T00:00:00Z')
+        self.md.store.update(e)
+        with patch.object(samlmd, 'schema', return_value=Mock(wraps=self.xsd)) as xsd:
+            self._run(["select"])
+            assert (xsd.return_value.validate.call_count == 1)
+            self._run(["select"])
+            assert (xsd.return_value.validate.call_count == 1)
+
+        e = deepcopy(e)
+        e.set('validUntil', 'tomorrow')
+        self.md.store.update(e)
+        req = self._run(["select"])
+        assert (len(list(iter_entities(req.t))) == 76)
+        assert (e.get('entityID') not in [ne.get('entityID') for ne in iter_entities(req.t)])
+
+    def test_validate_entities(self):
+        t = self._run(["select"]).t
+        entities = list(iter_entities(t))
+        digests = dict((e, entity_digest(e)) for e in entities)
+        with patch.object(samlmd, 'validate_document', wraps=samlmd.validate_document) as vd:
+            validate_entities(t, digests=digests)
+            assert (len(list(iter_entities(vd.call_args[0][0]))) == 1)
+
+            entities[1].set('validUntil', 'tomorrow')
+            digests[entities[1]] = entity_digest(entities[1])
+            with self.assertRaises(etree.DocumentInvalid):
+                validate_entities(t, digests=digests)
+            assert (len(list(iter_entities(vd.call_args[0][0]))) == 1)
+
+            del entities[1].attrib['validUntil']
+            entities[2].set('ID', 'x')
+            entities[3].set('ID', 'x')
+            with self.assertRaises(etree.DocumentInvalid):
+                validate_entities(t, digests=digests)
+            assert (vd.call_args[0][0] is t)
@@ -0,0 +1,197 @@
+import os
+import threading
+import time
+
+import xmlsec
+from lxml import etree
+from mock import patch
+
+from pyff import signing
+from pyff.constants import NS, config
+from pyff.pipes import Plumbing
+from pyff.test import SignerTestCase
+from pyff.utils import parse_xml, root
+
+from pyff import builtins  # noqa: F401 - imported to register the pipes
+
+
+class _Lib(object):
+    # a PyKCS11 library with one token: the login state is shared by all sessions and ends with the last one
+
+    def __init__(self):
+        self.opened = []
+        self.logins = 0
+        self.logouts = 0
+        self.logged_in = False
+
+    def openSession(self, slot):
+        return _Session(self)
+
+    def open_sessions(self):
+        return [s for s in self.opened if not s.closed]
+
+
+class _Session(object):
+
+    def __init__(self, lib):
+        self.lib = lib
+        self.closed = False
+        self.active = 0
+        lib.opened.append(self)
+
+    def login(self, pin):
+        if self.lib.logged_in:
+            raise ValueError("CKR_USER_ALREADY_LOGGED_IN")
+        self.lib.logins += 1
+        self.lib.logged_in = True
+
+    def logout(self):
+        if not self.lib.logged_in:
+            raise ValueError("CKR_USER_NOT_LOGGED_IN")
+        self.lib.logouts += 1
+        self.lib.logged_in = False
+
+    def sign(self, key, data, mech):
+        assert (self.lib.logged_in)
+        self.active += 1
+        assert (self.active == 1)
+        time.sleep(0.01)
+        self.active -= 1
+        if data == b'fail':
+            raise ValueError("token error")
+        return [1, 2, 3]
+
+    def closeSession(self):
+        self.closed = True
+        if not self.lib.open_sessions():
+            self.lib.logged_in = False
+
+
+class TestPKCS11Key(SignerTestCase):
+
+    def setUp(self):
+        self.lib = _Lib()
+        self.opened = self.lib.opened
+        self._patches = [patch.object(signing.PKCS11Key, '_library',
+                                      lambda key: (self.lib, 0, 'signer', '1234', None)),
+                         patch.object(signing.PKCS11Key, '_find_key', lambda key, session: ('key', None))]
+        for p in self._patches:
+            p.start()
+
+    def tearDown(self):
+        for p in self._patches:
+            p.stop()
+        super().tearDown()
+
+    def test_sessions_reused(self):
+        k = signing.PKCS11Key("pkcs11:///usr/lib/libsofthsm.so/signer", size=3)
+        for _ in range(5):
+            assert (k.sign(b'data') == bytearray([1, 2, 3]))
+        assert (len(self.opened) == 1)
+
+    def test_concurrent_sessions_bounded(self):
+        k = signing.PKCS11Key("pkcs11:///usr/lib/libsofthsm.so/signer", size=3)
+        threads = [threading.Thread(target=k.sign, args=(b'data',)) for _ in range(12)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert (1 <= len(self.opened) <= 3)
+
+    def test_failed_session_replaced(self):
+        k = signing.PKCS11Key("pkcs11:///usr/lib/libsofthsm.so/signer", size=1)
+        with self.assertRaises(ValueError):
+            k.sign(b'fail')
+        assert (self.opened[0].closed)
+        assert (k.sign(b'data') == bytearray([1, 2, 3]))
+        assert (len(self.opened) == 2)
+
+    def test_close(self):
+        k = signing.PKCS11Key("pkcs11:///usr/lib/libsofthsm.so/signer", size=2)
+        k.close()
+        assert (all(s.closed for s in self.opened))
+        assert (self.lib.logouts == 1)
+
+    def test_login_once(self):
+        k = signing.PKCS11Key("pkcs11:///usr/lib/libsofthsm.so/signer", size=4)
+        barrier = threading.Barrier(4, timeout=10)
+
+        def _sign():
+            barrier.wait()
+            for _ in range(3):
+                k.sign(b'data')
+
+        threads = [threading.Thread(target=_sign) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert (len(self.opened) > 1)
+        assert (self.lib.logins == 1)
+        with self.assertRaises(ValueError):
+            k.sign(b'fail')
+        # a failed session doesn't log out the others
+        assert (self.lib.logged_in)
+        assert (k.sign(b'data') == bytearray([1, 2, 3]))
+        assert (self.lib.logins == 1)
+        k.close()
+        assert (self.lib.logouts == 1)
+        assert (not self.lib.open_sessions())
+
+
+class TestSigner(SignerTestCase):
+
+    def setUp(self):
+        self.md = self.load_md('wayf-edugain-metadata.xml', tid='wayf')
+
+    def tearDown(self):
+        if 'map_processes' in config.__dict__:
+            del config.map_processes
+        super().tearDown()
+
+    def test_signer_shared(self):
+        s = signing.signer(self.private_keyspec, self.public_keyspec)
+        assert (s is signing.signer(self.private_keyspec, self.public_keyspec))
+        st = os.stat(self.private_keyspec)
+        os.utime(self.private_keyspec, (st.st_atime, st.st_mtime + 10))
+        assert (s is not signing.signer(self.private_keyspec, self.public_keyspec))
+
+    def test_key_loaded_once(self):
+        s = signing.signer(self.private_keyspec, self.public_keyspec)
+        t = parse_xml(os.path.join(self.datadir, 'metadata', 'test01.xml'))
+        with patch.object(signing, '_from_keyspec', side_effect=AssertionError("key loaded again")):
+            s.sign(t)
+        xmlsec.verify(t, self.public_keyspec)
+        assert (s.info()['count'] >= 1)
+
+    def test_keys_scoped(self):
+        # xmlsec only uses the loaded keys while a Signer signs - other callers load (possibly rotated) keys
+        s = signing.signer(self.private_keyspec, self.public_keyspec)
+        s.sign(parse_xml(os.path.join(self.datadir, 'metadata', 'test01.xml')))
+        with patch.object(signing, '_from_keyspec', return_value='loaded') as from_keyspec:
+            assert (xmlsec.crypto.from_keyspec(self.private_keyspec, private=True) == 'loaded')
+            with signing._loaded_keys(s._keys):
+                assert (xmlsec.crypto.from_keyspec(self.private_keyspec, private=True) is s._private)
+            assert (from_keyspec.call_count == 1)
+
+    def _sign_each(self):
+        req = Plumbing.Request(Plumbing(["select", {"sign each": {"key": self.private_keyspec,
+                                                                   "cert": self.public_keyspec}}], pid="test"),
+                               self.md, state={'batch': True, 'stats': {}})
+        req.process(req.plumbing)
+        entities = list(root(req.t).iterchildren("{%s}EntityDescriptor" % NS['md']))
+        assert (len(entities) == 77)
+        for e in entities[:3]:
+            assert (e.find("{%s}Signature" % NS['ds']) is not None)
+            xmlsec.verify(etree.fromstring(etree.tostring(e)), self.public_keyspec)
+        return req
+
+    def test_sign_each_inline(self):
+        config.map_processes = 100
+        self._sign_each()
+
+    def test_sign_each_processes(self):
+        config.map_processes = 2
+        self._sign_each()
+        rates = [i['rate'] for i in signing.info() if i['key'] == self.private_keyspec]
+        assert (rates and rates[0] > 0)
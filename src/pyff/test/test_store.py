@@ -1,12 +1,26 @@
 from unittest import TestCase
 import os
 import fakeredis
-from pyff.constants import ATTRS
-from pyff.samlmd import iter_entities
-from pyff.store import MemoryStore, SAMLStoreBase, entity_attribute_dict, RedisWhooshStore
-from pyff.utils import resource_filename, parse_xml, root
+from pyff.constants import ATTRS, NS, config
+from pyff.samlmd import iter_entities, entitiesdescriptor, entity_digest, discojson, entity_simple_summary, \
+    entity_display_name, entity_icon_url, entity_certificates
+from pyff.repo import MDRepository
+from pyff.pipes import Plumbing
+from pyff import builtins  # noqa: F401 - imported to register the pipes
+from copy import deepcopy
+import hashlib
+import json
+import six
+import threading
+import time
+from pyff.store import MemoryStore, SAMLStoreBase, entity_attribute_dict, RedisWhooshStore, SnapshotStore, \
+    write_snapshot, _entity_predicates, DiskIconStore, IconStore, MemoryIconStore, XMLStream, TextIndex
+from pyff.utils import resource_filename, parse_xml, root, dumptree, hex_digest
+from pyff.test import reset_caches
 import tempfile
+from lxml import etree
 import shutil
+from mock import patch
 
 
 class TestRedisWhooshStore(TestCase):
@@ -294,4 +308,718 @@ class TestStoreBase(TestCase):
             base.reset()
             assert False
         except NotImplementedError:
-            pass
\ No newline at end of file
+            pass
+
+class StoreTestCase(TestCase):
+    """
+    Parses the test01 and wayf metadata and drops the process-wide caches after each test (cf reset_caches).
+    """
+
+    def setUp(self):
+        self.datadir = resource_filename('metadata', 'test/data')
+        self.test01 = parse_xml(os.path.join(self.datadir, 'test01.xml'))
+        self.wayf = parse_xml(os.path.join(self.datadir, 'wayf-edugain-metadata.xml'))
+
+    def tearDown(self):
+        reset_caches()
+
+
+class TestStoreCache(StoreTestCase):
+    def test_generation_bumped_on_update(self):
+        store = MemoryStore()
+        g0 = store.generation
+        store.update(self.test01)
+        g1 = store.generation
+        assert (g1 > g0)
+        store.reset()
+        assert (store.generation > g1)
+
+    def test_lookup_cached(self):
+        store = MemoryStore()
+        store.update(self.wayf, tid='https://metadata.wayf.dk/wayf-edugain-metadata.xml')
+        res = store.lookup("{%s}idp" % ATTRS['role'])
+        assert (store.lookup("{%s}idp" % ATTRS['role']) == res)
+        info = store.cache_info()
+        assert (info['hits'] == 1)
+        assert (info['misses'] == 1)
+        assert (info['ratio'] == 0.5)
+
+    def test_lookup_invalidated_on_update(self):
+        store = MemoryStore()
+        entity_id = root(self.test01).get('entityID')
+        assert (len(store.lookup(entity_id)) == 0)
+        store.update(self.test01)
+        assert (len(store.lookup(entity_id)) == 1)
+
+    def test_cache_not_shared(self):
+        s1 = MemoryStore()
+        s2 = MemoryStore()
+        s1.update(self.test01)
+        entity_id = root(self.test01).get('entityID')
+        assert (len(s1.lookup(entity_id)) == 1)
+        assert (len(s2.lookup(entity_id)) == 0)
+
+    def test_cached_result_copied(self):
+        store = MemoryStore()
+        store.update(self.wayf)
+        res = store.lookup('entities')
+        n = len(res)
+        res.pop()
+        assert (len(store.lookup('entities')) == n)
+        hits = store.search('wayf')
+        assert (len(hits) > 0)
+        hits[0]['title'] = 'changed'
+        assert (store.search('wayf')[0]['title'] != 'changed')
+
+    def test_redis_generation_shared(self):
+        r = fakeredis.FakeStrictRedis()
+        d1 = tempfile.mkdtemp()
+        d2 = tempfile.mkdtemp()
+        try:
+            s1 = RedisWhooshStore(directory=d1, clear=True, name="test", redis=r)
+            s2 = RedisWhooshStore(directory=d2, name="test", redis=r)
+            assert (len(s2.collections()) == 0)
+            g = s2.generation
+            s1.update(self.test01, etag="test01")
+            assert (s2.generation > g)
+            assert (len(s2.collections()) == 1)
+        finally:
+            shutil.rmtree(d1)
+            shutil.rmtree(d2)
+
+    def test_search_unhashable_query(self):
+        store = MemoryStore()
+        store.update(self.test01)
+        res = store.search(['example'])
+        assert (len(res) == 1)
+        assert (store.search(['example']) is not res)
+        assert (store.search(['example']) == res)
+
+
+class TestSnapshotStore(StoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self.dir = tempfile.mkdtemp()
+        config.snapshot_check_interval = 0
+
+    def tearDown(self):
+        del config.snapshot_check_interval
+        shutil.rmtree(self.dir)
+        super().tearDown()
+
+    def test_attach(self):
+        loader = MemoryStore()
+        loader.update(self.wayf, tid='https://metadata.wayf.dk/wayf-edugain-metadata.xml')
+        store = SnapshotStore(self.dir)
+        assert (store.size() == 0)
+        assert (write_snapshot(loader, self.dir) is not None)
+        assert (store.size() == loader.size())
+        assert (store.collections() == ['https://metadata.wayf.dk/wayf-edugain-metadata.xml'])
+        assert (len(store.lookup("{%s}idp" % ATTRS['role'])) == len(loader.lookup("{%s}idp" % ATTRS['role'])))
+        assert (len(store.lookup('https://metadata.wayf.dk/wayf-edugain-metadata.xml')) == loader.size())
+
+    def test_switch_generation(self):
+        loader = MemoryStore()
+        loader.update(self.test01)
+        store = SnapshotStore(self.dir)
+        first = write_snapshot(loader, self.dir)
+        entity_id = root(self.test01).get('entityID')
+        assert (len(store.lookup(entity_id)) == 1)
+        g = store.generation
+        loader.reset()
+        loader.update(self.wayf)
+        second = write_snapshot(loader, self.dir)
+        assert (first != second)
+        assert (len(store.lookup(entity_id)) == 0)
+        assert (store.generation > g)
+        assert (store.snapshot == second)
+
+    def test_read_only(self):
+        store = SnapshotStore(self.dir)
+        store.update(self.test01)
+        assert (store.size() == 0)
+
+
+class TestMemoryStoreGenerations(StoreTestCase):
+    def test_update_does_not_modify_published_state(self):
+        store = MemoryStore()
+        store.update(self.wayf)
+        old = store._state
+        n_idp = len(store.lookup("{%s}idp" % ATTRS['role']))
+        store.update(self.test01)
+        assert (store._state is not old)
+        assert (len(old.entities) == len(list(iter_entities(self.wayf))))
+        assert (len(store._lookup("{%s}idp" % ATTRS['role'], old)) == n_idp)
+        assert (len(store.lookup("{%s}idp" % ATTRS['role'])) == n_idp + 1)
+
+    def test_update_entity_does_not_modify_published_state(self):
+        store = MemoryStore()
+        store.update(self.wayf)
+        old = store._state
+        orig = store.lookup('entities')[0]
+        e = deepcopy(orig)
+        e.set('validUntil', '2030-01-01T00:00:00Z')
+        role = "{%s}idp" % ATTRS['role'] if orig in store.lookup("{%s}idp" % ATTRS['role']) else \
+            "{%s}sp" % ATTRS['role']
+        store.update(e)
+        entity_id = e.get('entityID')
+        assert (store.lookup(entity_id)[0] is e)
+        assert (store._lookup(entity_id, old)[0] is not e)
+        assert (e in store.lookup(role))
+        assert (e not in store._lookup(role, old))
+        assert (store.size() == len(old.entities))
+
+    def test_reset_does_not_modify_published_state(self):
+        store = MemoryStore()
+        store.update(self.test01)
+        old = store._state
+        store.reset()
+        assert (store.size() == 0)
+        assert (len(store._lookup('entities', old)) == 1)
+
+
+class TestStoreBatch(StoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self.store = MemoryStore()
+        self.store.update(self.wayf)
+
+    def _modified(self, n):
+        lst = []
+        for e in self.store.lookup('entities')[:n]:
+            e = deepcopy(e)
+            e.set('validUntil', '2030-01-01T00:00:00Z')
+            lst.append(e)
+        return lst
+
+    def test_batch(self):
+        generation = self.store.generation
+        with self.store.batch() as batch:
+            for e in self._modified(10):
+                batch.update(e)
+                assert (self.store.generation == generation)
+            assert (len(batch) == 10)
+        assert (self.store.generation == generation + 1)
+        assert (len([e for e in self.store.lookup('entities') if e.get('validUntil') is not None]) == 10)
+
+    def test_nested(self):
+        generation = self.store.generation
+        entities = self._modified(2)
+        with self.store.batch() as batch:
+            batch.update(entities[0])
+            with self.store.batch() as inner:
+                assert (inner is batch)
+                inner.update(entities[1])
+            assert (self.store.generation == generation)
+        assert (self.store.generation == generation + 1)
+        assert (self.store.lookup(entities[1].get('entityID'))[0] is entities[1])
+
+    def test_exception(self):
+        generation = self.store.generation
+        with self.assertRaises(ValueError):
+            with self.store.batch() as batch:
+                batch.update(self._modified(1)[0])
+                raise ValueError()
+        assert (self.store.generation == generation)
+        assert (self.store.batch() is not batch)
+
+    def test_threads(self):
+        batches = []
+        with self.store.batch() as batch:
+            t = threading.Thread(target=lambda: batches.append(self.store.batch()))
+            t.start()
+            t.join()
+        assert (batches[0] is not batch)
+
+    def test_setattr(self):
+        md = MDRepository(store=self.store)
+        generation = self.store.generation
+        req = Plumbing.Request(Plumbing(["select", {"setattr": {"foo": "bar"}}], pid="test"), md, state={})
+        req.process(req.plumbing)
+        assert (self.store.generation == generation + 1)
+        for e in self.store.lookup('entities'):
+            assert (entity_attribute_dict(e)['foo'] == ['bar'])
+
+
+class _ScanningMemoryStore(MemoryStore):
+    def text_candidates(self, q, prefix=False):
+        return None
+
+
+class TestTextIndex(StoreTestCase):
+    def test_search_identical(self):
+        indexed = MemoryStore()
+        scanning = _ScanningMemoryStore()
+        for store in (indexed, scanning):
+            store.update(self.wayf)
+        for q in ['wayf', 'university', 'aarhus', 'dk', 'UNI', 'https://', 'sdu.dk', 'xyzzy', 'ku ', ' aau']:
+            assert (indexed.search(q) == scanning.search(q))
+        assert (indexed.search(['kø', 'itu']) == scanning.search(['kø', 'itu']))
+        assert (indexed.search('university', entity_filter="{%s}idp" % ATTRS['role']) ==
+                scanning.search('university', entity_filter="{%s}idp" % ATTRS['role']))
+
+    def test_large_postings(self):
+        indexed = MemoryStore()
+        scanning = _ScanningMemoryStore()
+        with patch.object(TextIndex, 'LARGE', 4):
+            for store in (indexed, scanning):
+                store.update(self.wayf)
+            old = indexed._state
+            e = deepcopy(indexed.lookup('entities')[0])
+            e.set('entityID', 'https://new.example.com/idp')
+            for store in (indexed, scanning):
+                store.update(e)
+        for q in ['wayf', 'university', 'https://', 'new.example']:
+            assert (indexed.search(q) == scanning.search(q))
+        assert ('https://new.example.com/idp' in indexed.text_candidates('https://'))
+        assert ('https://new.example.com/idp' not in old.text.candidates('https://'))
+
+    def test_candidates(self):
+        store = MemoryStore()
+        store.update(self.test01)
+        entity_id = root(self.test01).get('entityID')
+        assert (store.text_candidates('xyzzy') == set())
+        assert (entity_id in store.text_candidates(entity_id[2:8]))
+        assert (store.text_candidates('a') is None)
+        assert (entity_id in store.match_candidates([entity_id[:2].upper(), entity_id[:4]], prefix=True))
+        assert (store.match_candidates(['127.0.0.1']) == set())
+        assert (store.match_candidates(['10.0.0.1']) == {entity_id})
+        store.reset()
+        assert (store.text_candidates(entity_id[2:8]) == set())
+
+
+class TestIPIndex(StoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self.entity_id = root(self.test01).get('entityID')
+        hints = next(root(self.test01).iter('{urn:oasis:names:tc:SAML:metadata:ui}DiscoHints'))
+        for net in ('2001:db8::/32', '10.1.0.0/16'):
+            hint = etree.SubElement(hints, '{urn:oasis:names:tc:SAML:metadata:ui}IPHint')
+            hint.text = net
+
+    def test_ip_lookup(self):
+        store = MemoryStore()
+        store.update(self.test01)
+        assert (str(store.ip_lookup('10.1.2.3')[self.entity_id]) == '10.0.0.0/8')
+        assert (str(store.ip_lookup('2001:db8::1')[self.entity_id]) == '2001:db8::/32')
+        assert (store.ip_lookup('192.168.1.1') == {})
+        assert (store.ip_lookup('2001:db9::1') == {})
+        store.reset()
+        assert (store.ip_lookup('10.1.2.3') == {})
+
+    def test_search_identical(self):
+        indexed = MemoryStore()
+        scanning = _ScanningMemoryStore()
+        scanning.ip_lookup = lambda q: None
+        for store in (indexed, scanning):
+            store.update(self.test01)
+        for q in ['10.1.2.3', '2001:db8::1', '192.168.1.1', 'example.com']:
+            assert (indexed.search(q) == scanning.search(q))
+        assert (indexed.search('10.1.2.3')[0]['matched'] == scanning.search('10.1.2.3')[0]['matched'])
+
+
+class TestDomainIndex(StoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self.entity_id = root(self.test01).get('entityID')
+
+    def test_domain_lookup(self):
+        # a plain domain only matches the values of the domain attribute (cf entity_attribute_dict) as it always has
+        store = MemoryStore()
+        store.update(self.test01)
+        for d, n in (('example.com', 1), ('example.net', 1), ('idp.example.com', 0), ('com', 0), ('EXAMPLE.com', 0),
+                     ('foo.example.com', 0)):
+            assert (len(store.lookup("%s=%s" % (ATTRS['domain'], d))) == n)
+            assert (len(store.lookup("{%s}%s" % (ATTRS['domain'], d))) == n)
+
+    def test_domain_lookup_unchanged(self):
+        store = MemoryStore()
+        store.update(self.wayf)
+        entities = store.lookup('entities')
+        for d in store.attribute(ATTRS['domain']):
+            expected = set(e.get('entityID') for e in entities if d in entity_attribute_dict(e)[ATTRS['domain']])
+            assert (set(e.get('entityID') for e in store.lookup("{%s}%s" % (ATTRS['domain'], d))) == expected)
+
+    def test_domain_suffix_lookup(self):
+        store = MemoryStore()
+        store.update(self.test01)
+        for d in ('.example.com', '.idp.example.com', '.example.net', '.com', '.EXAMPLE.com'):
+            e = store.lookup("%s=%s" % (ATTRS['domain'], d))
+            assert (len(e) == 1)
+            assert (e[0].get('entityID') == self.entity_id)
+        assert (len(store.lookup("%s=%s" % (ATTRS['domain'], '.foo.example.com'))) == 0)
+        assert (len(store.lookup("%s=%s" % (ATTRS['domain'], '.ample.com'))) == 0)
+        store.reset()
+        assert (len(store.lookup("%s=%s" % (ATTRS['domain'], '.example.com'))) == 0)
+
+    def test_related_ranking_identical(self):
+        indexed = MemoryStore()
+        scanning = _ScanningMemoryStore()
+        scanning.domain_vector = lambda e: SAMLStoreBase.domain_vector(scanning, e)
+        for store in (indexed, scanning):
+            store.update(self.wayf)
+        for related in ('wayf.dk', 'sdu.dk;ku.dk', 'example.com'):
+            res = indexed.search('dk', related=related)
+            assert (res == scanning.search('dk', related=related))
+            assert (len(res) > 0)
+
+
+class TestCertificateIndex(StoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self.store = MemoryStore()
+        self.store.update(self.wayf)
+
+    def test_inventory(self):
+        certs = self.store.certificates()
+        fps = dict()
+        for e in self.store.lookup('entities'):
+            for fp, cd in entity_certificates(e):
+                fps.setdefault(fp, set()).add(e.get('entityID'))
+        assert (len(certs) == len(fps))
+        for fp, entity_ids in fps.items():
+            assert (set(certs.entities(fp)) == entity_ids)
+            assert (certs.get(fp).fingerprint == fp)
+            assert (certs.get(fp).key_size > 0)
+        base = SAMLStoreBase.certificates(self.store)
+        assert (sorted(base) == sorted(certs))
+
+    def test_parsed_once(self):
+        with patch('pyff.store.certificate_info', side_effect=AssertionError("certificate parsed again")):
+            self.store.update(deepcopy(self.wayf))
+        assert (len(self.store.certificates()) > 0)
+
+    def test_expiring(self):
+        certs = self.store.certificates()
+        not_after = sorted(c.not_after for c in certs)
+        assert (len(certs.expiring(0, now=not_after[-1])) == len(not_after))
+        assert (len(certs.expiring(0, now=not_after[0] - 1)) == 0)
+        res = certs.expiring(1, now=not_after[0] - 1)
+        assert (len(res) == not_after.count(not_after[0]))
+        res = certs.expiring(3600, now=not_after[len(not_after) // 2])
+        assert ([c.not_after for c in res] == sorted(c.not_after for c in res))
+        assert (all(c.not_after <= not_after[len(not_after) // 2] + 3600 for c in res))
+
+    def test_replace(self):
+        old_certs = self.store.certificates()
+        e = deepcopy(self.store.lookup('entities')[0])
+        fp, cd = entity_certificates(e)[0]
+        cd.getparent().remove(cd)
+        self.store.update(e)
+        certs = self.store.certificates()
+        assert (e.get('entityID') not in certs.entities(fp))
+        assert (e.get('entityID') in old_certs.entities(fp))
+
+
+class TestXPathFilter(StoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self.store = MemoryStore()
+        self.store.update(self.wayf, tid='https://metadata.wayf.dk/wayf-edugain-metadata.xml')
+
+    def _aggregate(self, xp):
+        t = entitiesdescriptor(self.store.lookup('entities'), 'dummy', validate=False)
+        return sorted(e.get('entityID') for e in root(t).xpath(xp, namespaces=NS))
+
+    def _select(self, xp):
+        return sorted(e.get('entityID') for e in self.store.select("!{}".format(xp)))
+
+    def test_role_pushdown(self):
+        for xp in ("//md:EntityDescriptor[md:IDPSSODescriptor]", "//md:EntityDescriptor[md:SPSSODescriptor]"):
+            assert (self._select(xp) == self._aggregate(xp))
+            assert (len(self._select(xp)) > 0)
+
+    def test_per_entity(self):
+        xp = "//md:EntityDescriptor[md:IDPSSODescriptor and .//mdui:DisplayName[contains(text(), 'Aarhus')]]"
+        assert (_entity_predicates(xp) is not None)
+        assert (self._select(xp) == self._aggregate(xp))
+        assert (self._select("//md:EntityDescriptor") == self._aggregate("//md:EntityDescriptor"))
+        res = self.store.select("!//md:EntityDescriptor[md:SPSSODescriptor][.//mdui:Logo]")
+        assert (all(e in self.store.lookup('entities') for e in res))
+
+    def test_aggregate_fallback(self):
+        for xp in ("//md:EntityDescriptor[1]",
+                   "//md:EntityDescriptor[md:IDPSSODescriptor]/md:Organization/..",
+                   "//md:EntityDescriptor[not(@entityID = preceding-sibling::md:EntityDescriptor/@entityID)]"):
+            assert (self._select(xp) == self._aggregate(xp))
+
+    def test_entity_predicates(self):
+        assert (_entity_predicates("//md:EntityDescriptor[a][b]") == "[a][b]")
+        assert (_entity_predicates("//md:EntityDescriptor[a]/md:Foo[b]") is None)
+        assert (_entity_predicates("//md:EntityDescriptor[@x=']/x']") == "[@x=']/x']")
+        assert (_entity_predicates("//md:IDPSSODescriptor") is None)
+
+
+class TestEntityRecords(StoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self.store = MemoryStore()
+        self.store.update(self.wayf, tid='https://metadata.wayf.dk/wayf-edugain-metadata.xml')
+        self.md = MDRepository(store=self.store)
+
+    def test_records(self):
+        for e in self.store.lookup('entities'):
+            rec = self.store.entity_record(e)
+            assert (rec is self.store.entity_record(e))
+            assert (rec.digest == entity_digest(e))
+            assert (rec.discojson() == discojson(e))
+            assert (json.loads(rec.discojson_json()) == discojson(e))
+            assert (rec.summary() == entity_simple_summary(e))
+            assert (rec.display_name() == entity_display_name(e))
+
+    def test_transient_record(self):
+        e = deepcopy(self.store.lookup('entities')[0])
+        rec = self.store.entity_record(e)
+        assert (rec.digest is None)
+        assert (rec.discojson() == discojson(e))
+
+    def test_record_reuse(self):
+        e = self.store.lookup('entities')[0]
+        entity_id = e.get('entityID')
+        rec = self.store.entity_record(e)
+        self.store.update(deepcopy(e))
+        ne = self.store.lookup(entity_id)[0]
+        assert (ne is not e)
+        assert (self.store.entity_record(ne) is rec)
+
+        ne = deepcopy(ne)
+        ne.set('validUntil', '2100-01-01T00:00:00Z')
+        self.store.update(ne)
+        nrec = self.store.entity_record(self.store.lookup(entity_id)[0])
+        assert (nrec is not rec)
+        assert (nrec.digest != rec.digest)
+        assert (rec.digest not in self.store._state.records)
+
+    def test_discojson_pipe(self):
+        pipeline = [{'select': []}, 'discojson']
+        res = Plumbing(pipeline, pid="test").process(self.md, state={'batch': True, 'stats': {}})
+        expected = [discojson(e) for e in self.store.lookup('entities')]
+        expected.sort(key=lambda d: d['title'])
+        assert (res == json.dumps(expected))
+
+    def test_discojson_pipe_modified(self):
+        pipeline = [{'select': []}, {'setattr': {ATTRS['entity-category']: 'http://pyff.io/category/discoverable'}},
+                    'discojson']
+        res = json.loads(Plumbing(pipeline, pid="test").process(self.md, state={'batch': True, 'stats': {}}))
+        idps = [d for d in res if d.get('type') == 'idp']
+        assert (len(idps) > 0)
+        assert (all(d['hidden'] == 'false' for d in idps))
+
+    def test_search(self):
+        res = self.store.search("aarhus")
+        assert (len(res) > 0)
+        for d in res:
+            e = self.store.lookup(d['entityID'])[0]
+            assert ({k: v for k, v in d.items() if k not in ('matched', 'ddist')} == entity_simple_summary(e))
+
+
+class TestSerialize(StoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self.store = MemoryStore()
+        self.store.update(self.wayf, tid='https://metadata.wayf.dk/wayf-edugain-metadata.xml')
+        self.md = MDRepository(store=self.store)
+        self.entities = self.store.lookup('entities')
+        self.origin = dict((e.get('entityID'), e) for e in self.entities)
+
+    def _c14n(self, data):
+        t = parse_xml(six.BytesIO(data))
+        return [etree.tostring(e, method='c14n', exclusive=True) for e in iter_entities(t)]
+
+    def test_assemble(self):
+        t = entitiesdescriptor(self.entities, 'test', validate=False)
+        data = self.store.serialize(t, origin=self.origin)
+        assert (data != dumptree(t))
+        assert (self._c14n(data) == self._c14n(dumptree(t)))
+        assert (root(parse_xml(six.BytesIO(data))).get('Name') == 'test')
+
+    def test_single_entity(self):
+        e = deepcopy(self.entities[0])
+        data = self.store.serialize(e, origin=self.origin)
+        assert (data.startswith(b"<?xml version='1.0' encoding='UTF-8'?>\n"))
+        assert (self._c14n(data) == self._c14n(dumptree(e)))
+
+    def test_fallback(self):
+        t = entitiesdescriptor(self.entities, 'test', validate=False)
+        assert (self.store.serialize(t) == dumptree(t))
+        assert (self.store.serialize(t, origin={}) == dumptree(t))
+        del self.origin[self.entities[0].get('entityID')]
+        assert (self.store.serialize(t, origin=self.origin) == dumptree(t))
+
+    def test_emit(self):
+        pipeline = [{'select': []}, 'emit application/xml']
+        res = Plumbing(pipeline, pid="test").process(self.md, state={'batch': True, 'stats': {}, 'headers': {}})
+        t = entitiesdescriptor(self.entities, 'test', validate=False)
+        assert (self._c14n(res) == self._c14n(dumptree(t)))
+
+        pipeline = [{'select': []}, {'setattr': {'foo': 'bar'}}, 'emit application/xml']
+        res = Plumbing(pipeline, pid="test").process(self.md, state={'batch': True, 'stats': {}, 'headers': {}})
+        assert (b'foo' in res)
+
+    def test_serialize_chunks(self):
+        t = entitiesdescriptor(self.entities, 'test', validate=False)
+        assert (b''.join(self.store.serialize_chunks(t, origin=self.origin)) ==
+                self.store.serialize(t, origin=self.origin))
+        chunks = list(self.store.serialize_chunks(t))
+        assert (len(chunks) > 1)
+        assert (self._c14n(b''.join(chunks)) == self._c14n(dumptree(t)))
+        assert (root(parse_xml(six.BytesIO(b''.join(chunks)))).get('Name') == 'test')
+
+    def test_emit_stream(self):
+        pipeline = [{'select': []}, 'emit application/xml stream']
+        state = {'batch': True, 'stats': {}, 'headers': {}}
+        res = Plumbing(pipeline, pid="test").process(self.md, state=state)
+        assert (isinstance(res, XMLStream))
+        data = b''.join(res)
+        assert (data == b''.join(res))
+        assert (state['headers']['ETag'] == hashlib.sha1(data).hexdigest())
+        t = entitiesdescriptor(self.entities, 'test', validate=False)
+        assert (self._c14n(data) == self._c14n(dumptree(t)))
+
+        pipeline = [{'select': []}, {'setattr': {'foo': 'bar'}}, 'emit application/xml stream']
+        state = {'batch': True, 'stats': {}, 'headers': {}}
+        res = Plumbing(pipeline, pid="test").process(self.md, state=state)
+        assert (b'foo' in b''.join(res))
+        assert (state['headers']['ETag'].startswith('W/'))
+
+
+class TestDiskIconStore(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.store = DiskIconStore(directory=self.dir, maxbytes=100)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_update_lookup(self):
+        self.store.update('http://example.com/a.png', (b'a' * 10, 'image/png'))
+        h = DiskIconStore.key('http://example.com/a.png')
+        assert (self.store.lookup('http://example.com/a.png') == "{}/api/icons/{}".format(config.base_url, h))
+        assert (self.store.get(h) == (b'a' * 10, 'image/png', hex_digest(b'a' * 10)))
+        assert (self.store.is_valid('http://example.com/a.png'))
+        assert (self.store.lookup('http://example.com/b.png') is None)
+        assert (self.store.get('nosuchhash') is None)
+
+    def test_failed_fetch(self):
+        self.store.update('http://example.com/a.png', None, info=dict(exception=IOError("boom")))
+        assert (self.store.lookup('http://example.com/a.png') is None)
+        assert (self.store.is_valid('http://example.com/a.png'))
+
+    def test_eviction(self):
+        for i in range(5):
+            self.store.update('http://example.com/{}.png'.format(i), (b'x' * 30, 'image/png'))
+            if i == 1:
+                self.store.lookup('http://example.com/0.png')
+        assert (self.store.bytes() <= 100)
+        assert (self.store.size() == 3)
+        assert (self.store.lookup('http://example.com/0.png') is None)
+        assert (self.store.lookup('http://example.com/1.png') is None)
+        assert (self.store.lookup('http://example.com/4.png') is not None)
+        assert (len([fn for fn in os.listdir(self.dir) if not fn.endswith('.json')]) == 3)
+
+    def test_persistence(self):
+        self.store.update('http://example.com/a.png', (b'a' * 10, 'image/png'))
+        store = DiskIconStore(directory=self.dir, maxbytes=100)
+        assert (store.size() == 1)
+        assert (store.lookup('http://example.com/a.png') is not None)
+        store.reset()
+        assert (store.size() == 0)
+        assert (os.listdir(self.dir) == [])
+
+    def test_icon_handler(self):
+        from pyramid.testing import DummyRequest
+        from webob import Request
+        from pyff.api import icon_handler
+
+        self.store.update('http://example.com/a.png', (b'a' * 10, 'image/png'))
+        h = DiskIconStore.key('http://example.com/a.png')
+        request = DummyRequest(matchdict=dict(hash=h))
+        request.registry.md = MDRepository(store=MemoryStore())
+        request.registry.md.icon_store = self.store
+        response = icon_handler(request)
+        assert (response.body == b'a' * 10)
+        assert (response.content_type == 'image/png')
+        assert (response.etag == hex_digest(b'a' * 10))
+        assert (Request.blank('/', if_none_match=response.etag).get_response(response).status_int == 304)
+
+
+class _Resource(object):
+    def __init__(self, url, t, etag):
+        self.url = url
+        self.t = t
+        self.etag = etag
+
+
+class _Watched(object):
+    def __init__(self, *resources):
+        self.resources = list(resources)
+
+    def walk(self):
+        return iter(self.resources)
+
+
+class _RecordingIconStore(MemoryIconStore):
+    def __init__(self):
+        super().__init__()
+        self.fetched = []
+
+    def _load_icons(self, urls):
+        self.fetched.append(sorted(urls))
+        for u in urls:
+            self.update(u, 'data:image/png;base64,')
+
+
+class TestIconRefresh(StoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self.urls = IconStore._icon_urls(self.test01)
+        self.store = _RecordingIconStore()
+        config.load_icons_async = False
+        config.cache_ttl_icons = 3600
+
+    def tearDown(self):
+        del config.load_icons_async
+        del config.cache_ttl_icons
+        super().tearDown()
+
+    def test_incremental(self):
+        assert (len(self.urls) > 0)
+        r = _Resource('test01', self.test01, 'etag1')
+        self.store(watched=_Watched(r))
+        assert (self.store.fetched == [sorted(self.urls)])
+        self.store(watched=_Watched(r))
+        assert (len(self.store.fetched) == 1)
+
+        t = deepcopy(self.test01)
+        ico = entity_icon_url(next(e for e in iter_entities(t) if entity_icon_url(e) is not None))
+        logo = next(elt for elt in t.iter('{%s}Logo' % NS['mdui']) if elt.text.strip() == ico['url'])
+        logo.text = 'https://example.com/new-logo.png'
+        self.store(watched=_Watched(_Resource('test01', t, 'etag2')))
+        assert (self.store.fetched[-1] == ['https://example.com/new-logo.png'])
+
+    def test_expiry(self):
+        config.cache_ttl_icons = 0
+        r = _Resource('test01', self.test01, 'etag1')
+        self.store(watched=_Watched(r))
+        self.store(watched=_Watched(r))
+        assert (self.store.fetched == [sorted(self.urls), sorted(self.urls)])
+
+    def test_valid_icons_not_fetched(self):
+        for u in self.urls:
+            self.store.update(u, 'data:image/png;base64,')
+        self.store(watched=_Watched(_Resource('test01', self.test01, 'etag1')))
+        assert (self.store.fetched == [])
+
+    def test_removed_resource(self):
+        self.store.track(_Watched(_Resource('test01', self.test01, 'etag1')))
+        self.store.track(_Watched())
+        assert (self.store.due() == [])
+
+    def test_async(self):
+        config.load_icons_async = True
+        self.store(watched=_Watched(_Resource('test01', self.test01, 'etag1')))
+        for i in range(100):
+            if self.store.fetched:
+                break
+            time.sleep(0.05)
+        assert (sorted(sum(self.store.fetched, [])) == sorted(self.urls))
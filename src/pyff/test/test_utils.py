@@ -1,4 +1,6 @@
 import copy
+import gzip
+import shutil
 import tempfile
 from unittest import TestCase
 
@@ -9,9 +11,10 @@ from pyff.constants import NS
 from pyff.resource import Resource
 from pyff.samlmd import find_entity, entities_list
 from pyff.utils import resource_filename, parse_xml, root, resource_string, b2u, Lambda, schema, find_matching_files, \
-    url_get, img_to_data, is_past_ttl
+    url_get, img_to_data, is_past_ttl, safe_write, safe_symlink, PersistentDict, CountingLRUCache
 from ..merge_strategies import replace_existing, remove
 from threading import Thread, current_thread
+from mock import patch
 
 
 class TestMetadata(TestCase):
@@ -185,6 +188,74 @@ class TestLambda(TestCase):
             pass
 
 
+class TestPersistentDict(TestCase):
+
+    def test_dict(self):
+        d = PersistentDict(a=1)
+        d['b'] = 2
+        assert (d['a'] == 1)
+        assert ('b' in d)
+        assert (d.get('c') is None)
+        del d['a']
+        assert ('a' not in d)
+        assert (len(d) == 1)
+        assert (d.pop('b') == 2)
+        assert (len(d) == 0)
+        try:
+            d['a']
+            assert False
+        except KeyError:
+            pass
+
+    def test_copy(self):
+        d = PersistentDict((i, i) for i in range(1000))
+        c = d.copy()
+        for i in range(0, 1000, 2):
+            c[i] = -i
+            del d[i + 1]
+        c['x'] = 'y'
+        assert (len(d) == 500)
+        assert (len(c) == 1001)
+        assert (dict(d.items()) == dict((i, i) for i in range(0, 1000, 2)))
+        assert (all(c[i] == (-i if i % 2 == 0 else i) for i in range(1000)))
+        assert ('x' not in d)
+        assert (sorted(d) == list(range(0, 1000, 2)))
+
+
+class _ExpiringCache(CountingLRUCache):
+
+    def _expired(self, value):
+        return value == 'expired'
+
+
+class TestCountingLRUCache(TestCase):
+
+    def test_cache(self):
+        c = CountingLRUCache(maxsize=2)
+        c.put('a', 1)
+        c.put('b', 2)
+        assert (c.get('a') == 1)
+        c.put('c', 3)
+        assert (c.get('b', 'missing') == 'missing')
+        info = c.info()
+        assert (info['size'] == 2)
+        assert (info['hits'] == 1)
+        assert (info['misses'] == 1)
+
+    def test_disabled(self):
+        c = CountingLRUCache(maxsize=0)
+        c.put('a', 1)
+        assert (c.get('a') is None)
+        assert (c.info()['size'] == 0)
+
+    def test_expired(self):
+        c = _ExpiringCache(maxsize=10)
+        c.put('a', 'expired')
+        assert (c.get('a') is None)
+        assert (c.info()['size'] == 0)
+        assert (c.info()['misses'] == 1)
+
+
 class TestImage(TestCase):
 
     ext_to_mime = dict(
@@ -223,3 +294,73 @@ class TestResource(TestCase):
         r2 = Resource("https://mds.edugain.org")
 
         assert r1 == r2
+
+
+class TestSafeWrite(TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.fn = os.path.join(self.dir, "out.xml")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def _age(self, fn):
+        os.utime(fn, (1000000000, 1000000000), follow_symlinks=False)
+
+    def test_unchanged_not_written(self):
+        assert (safe_write(self.fn, "<a/>"))
+        self._age(self.fn)
+        assert (safe_write(self.fn, b"<a/>"))
+        assert (os.stat(self.fn).st_mtime == 1000000000)
+
+    def test_changed_written(self):
+        safe_write(self.fn, "<a/>")
+        self._age(self.fn)
+        assert (safe_write(self.fn, "<b/>"))
+        assert (os.stat(self.fn).st_mtime != 1000000000)
+        with open(self.fn) as fd:
+            assert (fd.read() == "<b/>")
+
+    def test_modified_on_disk(self):
+        safe_write(self.fn, "<a/>")
+        with open(self.fn, 'w') as fd:
+            fd.write("<b/>")
+        safe_write(self.fn, "<a/>")
+        with open(self.fn) as fd:
+            assert (fd.read() == "<a/>")
+
+    def test_compress(self):
+        safe_write(self.fn, "<a/>", compress=['gz'])
+        with gzip.open(self.fn + ".gz") as fd:
+            assert (fd.read() == b"<a/>")
+
+    def test_compress_missing_sibling(self):
+        safe_write(self.fn, "<a/>")
+        self._age(self.fn)
+        safe_write(self.fn, "<a/>", compress=['gz'])
+        assert (os.path.exists(self.fn + ".gz"))
+        assert (os.stat(self.fn).st_mtime == 1000000000)
+
+    def test_stale_sibling_removed(self):
+        safe_write(self.fn, "<a/>", compress=['gz'])
+        safe_write(self.fn, "<a/>")
+        assert (os.path.exists(self.fn + ".gz"))
+        safe_write(self.fn, "<b/>")
+        assert (not os.path.exists(self.fn + ".gz"))
+
+    def test_unsupported_compression(self):
+        with patch.dict(utils.COMPRESSORS, clear=True):
+            assert (safe_write(self.fn, "<a/>", compress=['br']))
+        assert (os.path.exists(self.fn))
+        assert (not os.path.exists(self.fn + ".br"))
+
+    def test_symlink(self):
+        safe_write(self.fn, "<a/>")
+        link = os.path.join(self.dir, "link.xml")
+        safe_symlink("out.xml", link)
+        self._age(link)
+        safe_symlink("out.xml", link)
+        assert (os.lstat(link).st_mtime == 1000000000)
+        safe_symlink("other.xml", link)
+        assert (os.readlink(link) == "other.xml")
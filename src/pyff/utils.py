@@ -7,8 +7,10 @@ This module contains various utilities.
 
 """
 import cgi
+import gzip
 import hashlib
 import io
+import pickle
 import random
 import tempfile
 from copy import copy
@@ -47,8 +49,11 @@ from requests.structures import CaseInsensitiveDict
 from requests.adapters import HTTPAdapter
 from requests.packages.urllib3.util.retry import Retry
 import contextlib
-import threading
+import atexit
+import multiprocessing
 from cachetools import LRUCache
+import ipaddr
+import threading
 from _collections_abc import MutableMapping
 from apscheduler.schedulers.background import BackgroundScheduler
 from apscheduler.executors.pool import ThreadPoolExecutor
@@ -63,6 +68,11 @@ try:
 except ImportError as ex:
     Image = None
 
+try:
+    import brotli
+except ImportError as ex:
+    brotli = None
+
 
 etree.set_default_parser(etree.XMLParser(resolve_entities=False))
 
@@ -173,6 +183,33 @@ Return a string representation of the tree, optionally pretty_print(ed) (default
                           pretty_print=pretty_print)
 
 
+def iter_dumptree(t, chunk_size=65536):
+    """
+Serialize t like dumptree (without pretty printing) incrementally. The children of the root element are serialized
+one at a time, each with the namespace declarations it needs, and the output is yielded in chunks of roughly
+chunk_size bytes.
+
+:param t: An ElementTree or element to serialize
+:param chunk_size: The size of the chunks to yield
+    """
+    r = root(t)
+    buf = io.BytesIO()
+    with etree.xmlfile(buf, encoding='UTF-8') as xf:
+        xf.write_declaration()
+        with xf.element(r.tag, attrib=dict(r.attrib), nsmap=r.nsmap):
+            if r.text:
+                xf.write(r.text)
+            for c in r:
+                xf.write(c)
+                xf.flush()
+                if buf.tell() >= chunk_size:
+                    yield buf.getvalue()
+                    buf.seek(0)
+                    buf.truncate()
+    if buf.tell() > 0:
+        yield buf.getvalue()
+
+
 def iso_now():
     """
 Current time in ISO format
@@ -295,35 +332,50 @@ def ensure_dir(fn):
         os.makedirs(d)
 
 
-def safe_write(fn, data, mkdirs=False):
-    """Safely write data to a file with name fn
-    :param fn: a filename
-    :param data: some string data to write
-    :param mkdirs: create directories along the way (False by default)
-    :return: True or False depending on the outcome of the write
-    """
-    tmpn = None
-    try:
-        fn = os.path.expanduser(fn)
-        dirname, basename = os.path.split(fn)
-        kwargs = dict(delete=False, prefix=".%s" % basename, dir=dirname)
-        if six.PY3:
-            kwargs['encoding'] = "utf-8"
-            mode = 'w+'
-        else:
-            mode = 'w+b'
+_written = LRUCache(maxsize=10000)
+_written_lock = threading.Lock()
 
-        if mkdirs:
-            ensure_dir(fn)
 
-        if isinstance(data, six.binary_type):
-            data = data.decode('utf-8')
+def _stamp(st):
+    return st.st_mtime_ns, st.st_size, st.st_ino
 
-        with tempfile.NamedTemporaryFile(mode, **kwargs) as tmp:
-            if six.PY2:
-                data = data.encode('utf-8')
 
-            log.debug("safe writing {} chrs into {}".format(len(data), fn))
+def _unchanged(fn, digest, size):
+    try:
+        st = os.stat(fn)
+    except OSError:
+        return False
+    if st.st_size != size:
+        return False
+    with _written_lock:
+        known = _written.get(fn, None)
+    if known is not None and known[0] == _stamp(st):
+        return known[1] == digest
+    with io.open(fn, 'rb') as fd:
+        d = hashlib.sha256(fd.read()).digest()
+    with _written_lock:
+        _written[fn] = (_stamp(st), d)
+    return d == digest
+
+
+def _gzip(data):
+    buf = io.BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb', mtime=0) as gz:
+        gz.write(data)
+    return buf.getvalue()
+
+
+COMPRESSORS = {'gz': _gzip}
+if brotli is not None:
+    COMPRESSORS['br'] = brotli.compress
+
+
+def _write_file(fn, data):
+    tmpn = None
+    try:
+        dirname, basename = os.path.split(fn)
+        with tempfile.NamedTemporaryFile('w+b', delete=False, prefix=".%s" % basename, dir=dirname) as tmp:
+            log.debug("safe writing {} bytes into {}".format(len(data), fn))
             tmp.write(data)
             tmpn = tmp.name
         if os.path.exists(tmpn) and os.stat(tmpn).st_size > 0:
@@ -331,9 +383,6 @@ def safe_write(fn, data, mkdirs=False):
             # made these file readable by all
             os.chmod(fn, 0o644)
             return True
-    except Exception as ex:
-        log.debug(traceback.format_exc())
-        log.error(ex)
     finally:
         if tmpn is not None and os.path.exists(tmpn):
             try:
@@ -343,6 +392,68 @@ def safe_write(fn, data, mkdirs=False):
     return False
 
 
+def _write_compressed(fn, data, compress, changed):
+    for ext, compressor in COMPRESSORS.items():
+        cfn = "{}.{}".format(fn, ext)
+        if ext in compress:
+            if changed or not os.path.exists(cfn):
+                _write_file(cfn, compressor(data))
+        elif changed and os.path.exists(cfn):
+            os.unlink(cfn)  # don't leave a stale precompressed copy behind
+
+
+def safe_write(fn, data, mkdirs=False, compress=None):
+    """Safely write data to a file with name fn. Nothing is written if the file already has the same content so
+    the modification time of unchanged files is preserved.
+    :param fn: a filename
+    :param data: some string data to write
+    :param mkdirs: create directories along the way (False by default)
+    :param compress: a list of compressed formats ('gz' and/or 'br') to also write next to the file as fn.gz and
+    fn.br for web servers that serve precompressed files. Stale compressed copies are removed when fn changes.
+    :return: True or False depending on the outcome of the write
+    """
+    if compress is None:
+        compress = []
+    for ext in compress:
+        if ext not in COMPRESSORS:
+            log.warn("unable to write {}.{}: unsupported compression (is brotli installed?)".format(fn, ext))
+    try:
+        fn = os.path.expanduser(fn)
+        if not isinstance(data, six.binary_type):
+            data = data.encode('utf-8')
+        digest = hashlib.sha256(data).digest()
+
+        if mkdirs:
+            ensure_dir(fn)
+
+        if _unchanged(fn, digest, len(data)):
+            log.debug("{} is unchanged".format(fn))
+            _write_compressed(fn, data, compress, changed=False)
+            return True
+
+        _write_compressed(fn, data, compress, changed=True)
+        if _write_file(fn, data):
+            with _written_lock:
+                _written[fn] = (_stamp(os.stat(fn)), digest)
+            return True
+    except Exception as ex:
+        log.debug(traceback.format_exc())
+        log.error(ex)
+    return False
+
+
+def safe_symlink(target, link_name):
+    """Make link_name a symbolic link to target unless it already is one.
+    :param target: the target of the link
+    :param link_name: the name of the link
+    """
+    if os.path.islink(link_name) and os.readlink(link_name) == target:
+        return
+    if os.path.lexists(link_name):
+        os.unlink(link_name)
+    os.symlink(target, link_name)
+
+
 site_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "site")
 env = Environment(loader=PackageLoader(__package__, 'templates'), extensions=['jinja2.ext.i18n'])
 getattr(env, 'install_gettext_callables')(language.gettext, language.ngettext, newstyle=True)
@@ -475,6 +586,24 @@ def xslt_transform(t, stylesheet, params=None):
         raise ex
 
 
+def compiled_xpath(xp):
+    """
+    Return a compiled etree.XPath object for the expression xp using the pyFF namespace map. Compiled expressions
+    are cached per thread (like XSLT transforms) since etree.XPath objects are not thread safe.
+
+    :param xp: an XPath expression
+    :return: an etree.XPath object that returns elements without smart strings
+    """
+    if not hasattr(thread_data, 'xpath'):
+        thread_data.xpath = LRUCache(maxsize=config.cache_size)
+
+    xpe = thread_data.xpath.get(xp, None)
+    if xpe is None:
+        xpe = etree.XPath(xp, namespaces=NS, smart_strings=False)
+        thread_data.xpath[xp] = xpe
+    return xpe
+
+
 def valid_until_ts(elt, default_ts):
     ts = default_ts
     valid_until = elt.get("validUntil", None)
@@ -569,18 +698,41 @@ def ddist(a, b):
     return len(a)
 
 
-def avg_domain_distance(d1, d2):
+def domain_vector(domains):
+    """
+    Precompute the ';'-separated list of domains for :py:func:`avg_domain_vector_distance` as a tuple of
+    (length, reversed labels) pairs.
+    """
+    return tuple((len(d), tuple(reversed(d.split('.')))) for d in domains.split(';'))
+
+
+def _vdist(a, b):
+    if a[0] > b[0]:
+        return _vdist(b, a)
+
+    for i, (x, y) in enumerate(zip(a[1], b[1])):
+        if x != y:
+            return i
+    return len(a[1])
+
+
+def avg_domain_vector_distance(v1, v2):
+    """
+    The same as :py:func:`avg_domain_distance` but for domain lists already converted by :py:func:`domain_vector`
+    """
     dd = 0
     n = 0
-    for a in d1.split(';'):
-        for b in d2.split(';'):
-            d = ddist(a, b)
-            # log.debug("ddist %s %s -> %d" % (a, b, d))
-            dd += d
+    for a in v1:
+        for b in v2:
+            dd += _vdist(a, b)
             n += 1
     return int(dd / n)
 
 
+def avg_domain_distance(d1, d2):
+    return avg_domain_vector_distance(domain_vector(d1), domain_vector(d2))
+
+
 def sync_nsmap(nsmap, elt):
     fix = []
     for ns in elt.nsmap:
@@ -665,6 +817,19 @@ def is_text(x):
     return isinstance(x, six.string_types) or isinstance(x, six.text_type)
 
 
+def is_ip_address(q):
+    """
+    Returns True if the (discovery) query q is an IPv4 or IPv6 address
+    """
+    if ':' not in q and '.' not in q:
+        return False
+    try:
+        ipaddr.IPAddress(q)
+        return True
+    except ValueError:
+        return False
+
+
 def chunks(l, n):
     """Yield successive n-sized chunks from l."""
     for i in range(0, len(l), n):
@@ -749,30 +914,43 @@ def safe_b64d(s):
 # data:&lt;class 'type'&gt;;base64,
 # data:<class 'type'>;base64,
 
-def img_to_data(data, content_type):
-    """Convert a file (specified by a path) into a data URI."""
-    mime_type, options = cgi.parse_header(content_type)
-    data64 = None
-    if len(data) > config.icon_maxsize:
-        return None
+def convert_image(data, content_type, max_dimension=0):
+    """Convert image data to PNG unless it is already PNG or SVG, optionally scaling it down to fit within
+    max_dimension x max_dimension pixels. The original data is returned if PIL is not available or fails.
 
+    :param data: the image data
+    :param content_type: the Content-Type of the image
+    :param max_dimension: the maximum width and height - 0 (the default) to never scale
+    :return: a tuple (data, mime_type)
+    """
+    mime_type, options = cgi.parse_header(content_type)
     if Image is not None:
         try:
             im = Image.open(io.BytesIO(data))
-            if im.format not in ('PNG', 'SVG'):
+            too_big = max_dimension > 0 and (im.size[0] > max_dimension or im.size[1] > max_dimension)
+            if im.format not in ('PNG', 'SVG') or too_big:
+                if too_big:
+                    im.thumbnail((max_dimension, max_dimension))
                 out = io.BytesIO()
                 im.save(out, format="PNG")
-                data64 = safe_b64e(out.getvalue())
-                assert data64
-                mime_type = "image/png"
+                converted = out.getvalue()
+                assert converted
+                return converted, "image/png"
         except BaseException as ex:
             log.warn(ex)
             import traceback
             log.debug(traceback.format_exc())
 
-    if data64 is None or len(data64) == 0:
-        data64 = safe_b64e(data)
-    return 'data:{};base64,{}'.format(mime_type, data64)
+    return data, mime_type
+
+
+def img_to_data(data, content_type):
+    """Convert a file (specified by a path) into a data URI."""
+    if len(data) > config.icon_maxsize:
+        return None
+
+    data, mime_type = convert_image(data, content_type)
+    return 'data:{};base64,{}'.format(mime_type, safe_b64e(data))
 
 
 def short_id(data):
@@ -835,6 +1013,53 @@ def non_blocking_lock(lock=threading.Lock(), exception_class=ResourceException,
         lock.release()
 
 
+_process_pool = None
+_process_pool_lock = threading.Lock()
+
+
+def process_pool_size():
+    return config.map_processes or os.cpu_count() or 1
+
+
+def _process_pool_init(settings, modules):
+    from importlib import import_module
+
+    config.__dict__.update(settings)
+    for mn in modules:
+        import_module(mn)
+
+
+def _picklable(v):
+    try:
+        pickle.dumps(v)
+        return True
+    except Exception:
+        return False
+
+
+def process_pool():
+    """
+    Return the persistent pool of worker processes (of size map_processes, by default one per cpu) used by the
+    map and sign pipes. The pool is created on first use. Where available the workers are started by a forkserver:
+    by then this process usually runs other threads (the scheduler, request handlers, thread pools) and a child
+    forked from it may inherit locks held by those threads. Each worker applies the settings made in this process
+    and imports pyff.builtins and config.modules so that the same pipes are registered.
+    """
+    global _process_pool
+    with _process_pool_lock:
+        if _process_pool is None:
+            ctx = multiprocessing
+            if 'forkserver' in multiprocessing.get_all_start_methods():
+                ctx = multiprocessing.get_context('forkserver')
+                ctx.set_forkserver_preload(['pyff.builtins'])
+            settings = dict((k, v) for k, v in config.__dict__.items() if _picklable(v))
+            modules = ['pyff.builtins'] + [mn for mn in (config.modules or []) if mn != 'pyff.builtins']
+            _process_pool = ctx.Pool(processes=process_pool_size(), initializer=_process_pool_init,
+                                     initargs=(settings, modules))
+            atexit.register(_process_pool.terminate)
+        return _process_pool
+
+
 def make_default_scheduler():
     if config.scheduler_job_store == 'redis':
         jobstore = RedisJobStore(host=config.redis_host, port=config.redis_port)
@@ -847,6 +1072,61 @@ def make_default_scheduler():
                                job_defaults={'misfire_grace_time': config.update_frequency})
 
 
+class CountingLRUCache(object):
+    """
+    A thread-safe bounded (LRU) cache that counts hits and misses - the base of the store, response and entity
+    caches. A maxsize of 0 disables the cache. Subclasses can override :py:meth:`_expired` to drop entries that are
+    found but no longer valid: those count as misses.
+
+    :param maxsize: the maximum number of entries
+    """
+
+    def __init__(self, maxsize):
+        self._cache = LRUCache(maxsize=maxsize)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def maxsize(self):
+        return self._cache.maxsize
+
+    def _expired(self, value):
+        return False
+
+    def get(self, key, default=None):
+        with self._lock:
+            v = self._cache.get(key, sentinel)
+            if v is not sentinel and self._expired(v):
+                del self._cache[key]
+                v = sentinel
+            if v is sentinel:
+                self.misses += 1
+                return default
+            self.hits += 1
+            return v
+
+    def put(self, key, value):
+        with self._lock:
+            try:
+                self._cache[key] = value
+            except ValueError:  # the cache is disabled (maxsize=0)
+                pass
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+    def info(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return dict(size=len(self._cache),
+                        maxsize=self._cache.maxsize,
+                        hits=self.hits,
+                        misses=self.misses,
+                        ratio=float(self.hits) / lookups if lookups > 0 else 0.0)
+
+
 class LRUProxyDict(MutableMapping):
 
     def __init__(self, proxy, *args, **kwargs):
@@ -882,6 +1162,154 @@ class LRUProxyDict(MutableMapping):
         return len(self._proxy)
 
 
+class _Leaf(object):
+    __slots__ = ('owner', 'items')
+
+    def __init__(self, owner, items):
+        self.owner = owner
+        self.items = items
+
+
+class _Node(object):
+    __slots__ = ('owner', 'slots')
+
+    def __init__(self, owner, slots):
+        self.owner = owner
+        self.slots = slots
+
+
+class PersistentDict(MutableMapping):
+    """
+    A dict with a constant time :py:meth:`copy`: the items are kept in a hash trie (32-way nodes with small dicts as
+    leaves) which is shared by the copies. A modification copies the nodes on the path to the modified key the first
+    time it touches them - nodes created or copied by this dict since the last copy are owned and modified in place -
+    so neither the original nor the copy ever sees the changes of the other. Modifying a dict that is being read by
+    other threads isn't safe, but modifying a copy of it is.
+    """
+
+    # each level of the trie uses 5 bits of the hash: h & 31 picks one of the 32 slots of a node
+    _LEAF_SIZE = 16
+    _MAX_SHIFT = 60
+
+    def __init__(self, *args, **kwargs):
+        self._owner = object()
+        self._root = _Leaf(self._owner, dict())
+        self._len = 0
+        if args or kwargs:
+            self.update(*args, **kwargs)
+
+    def copy(self):
+        c = PersistentDict()
+        c._root = self._root
+        c._len = self._len
+        self._owner = object()  # the nodes are now shared
+        return c
+
+    def _own(self, node):
+        if node.owner is self._owner:
+            return node
+        if type(node) is _Leaf:
+            return _Leaf(self._owner, dict(node.items))
+        return _Node(self._owner, list(node.slots))
+
+    def get(self, key, default=None):
+        h = hash(key)
+        node = self._root
+        while type(node) is _Node:
+            node = node.slots[h & 31]
+            if node is None:
+                return default
+            h >>= 5
+        return node.items.get(key, default)
+
+    def __getitem__(self, key):
+        v = self.get(key, sentinel)
+        if v is sentinel:
+            raise KeyError(key)
+        return v
+
+    def __contains__(self, key):
+        return self.get(key, sentinel) is not sentinel
+
+    def _split(self, leaf, shift):
+        node = _Node(self._owner, [None] * 32)
+        for k, v in leaf.items.items():
+            i = (hash(k) >> shift) & 31
+            child = node.slots[i]
+            if child is None:
+                child = node.slots[i] = _Leaf(self._owner, dict())
+            child.items[k] = v
+        return node
+
+    def __setitem__(self, key, value):
+        owner = self._owner
+        h = hash(key)
+        node = self._root
+        if node.owner is not owner:
+            node = self._root = self._own(node)
+        parent = None
+        i = 0
+        shift = 0
+        while type(node) is _Node:
+            i = (h >> shift) & 31
+            child = node.slots[i]
+            if child is None:
+                child = node.slots[i] = _Leaf(owner, dict())
+            elif child.owner is not owner:
+                child = node.slots[i] = self._own(child)
+            parent, node = node, child
+            shift += 5
+        if key not in node.items:
+            self._len += 1
+        node.items[key] = value
+        if len(node.items) > self._LEAF_SIZE and shift <= self._MAX_SHIFT:
+            node = self._split(node, shift)
+            if parent is None:
+                self._root = node
+            else:
+                parent.slots[i] = node
+
+    def __delitem__(self, key):
+        h = hash(key)
+        if key not in self:
+            raise KeyError(key)
+        node = self._root = self._own(self._root)
+        shift = 0
+        while type(node) is _Node:
+            i = (h >> shift) & 31
+            child = node.slots[i] = self._own(node.slots[i])
+            node = child
+            shift += 5
+        del node.items[key]
+        self._len -= 1
+
+    def _leaves(self):
+        stack = [self._root]
+        while stack:
+            node = stack.pop()
+            if type(node) is _Leaf:
+                yield node.items
+            else:
+                stack.extend(child for child in node.slots if child is not None)
+
+    def __iter__(self):
+        for items in self._leaves():
+            for k in list(items):
+                yield k
+
+    def values(self):
+        return [v for items in self._leaves() for v in items.values()]
+
+    def items(self):
+        return [kv for items in self._leaves() for kv in items.items()]
+
+    def __len__(self):
+        return self._len
+
+    def __repr__(self):
+        return "PersistentDict({!r})".format(dict(self.items()))
+
+
 def find_matching_files(d, extensions):
     for top, dirs, files in os.walk(d):
         for dn in dirs: